@@ -1,15 +1,36 @@
-from io import BytesIO
+import cProfile
+import functools
+import hashlib
+import heapq
+import importlib
+import io
+import multiprocessing
+import pstats
+import signal
+import time
 import os
+import uuid
 import json
-from flask import Flask, jsonify, request
+import threading
+import zlib
+from flask import Flask, Response, abort, g, jsonify, request
 import networkx as nx
-import osmnx as ox
-import geopandas as gpd
-import momepy
 from shapely import geometry
 import numpy as np
-from sklearn.cluster import KMeans
+from scipy.spatial import cKDTree
 from flask_cors import CORS
+from store import GraphStore, content_hash
+from indexed_graph import IndexedGraph, node_named, nodes_typed
+import graph_cache
+from results import result_cache_from_env, result_key
+import results
+import jobs
+from csr import EARTH_RADIUS, csr_graph
+import streets
+from metrics import stage
+import metrics
+from tiles import TileIndex, pixel_degrees, tile_bounds, valid_tile
+from shards import ShardSet
 
 
 def simplify(graph):
@@ -18,167 +39,532 @@ def simplify(graph):
     return vertices, edges
 
 
-def graph_to_json(graph):
-    nodes, edges = momepy.nx_to_gdf(graph, points=True, lines=True)
-    sedges = edges.loc[:, ['Type', 'geometry']].to_json()
-    snodes = nodes.loc[nodes['Type'] != 'JUNC', [
-        'Type', 'Name', 'ECC', 'PS', 'geometry']].to_json()
+def _value(v):
+    # NaN attributes from the shapefiles are null in GeoJSON
+    return None if isinstance(v, float) and v != v else v
+
+
+def node_feature(n, d):
+    return {'geometry': {'coordinates': [n[0], n[1]], 'type': 'Point'},
+            'properties': {k: _value(d.get(k)) for k in ('ECC', 'Name', 'PS', 'Type')},
+            'type': 'Feature'}
+
+
+def edge_feature(n1, n2, d):
+    coords = d['geometry'].coords if 'geometry' in d else (n1, n2)
+    return {'geometry': {'coordinates': [[c[0], c[1]] for c in coords], 'type': 'LineString'},
+            'properties': {'Type': _value(d.get('Type'))}, 'type': 'Feature'}
+
+
+def node_features(graph):
+    for i, (n, d) in enumerate(graph.nodes(data=True)):
+        if d.get('Type') == 'JUNC':
+            continue
+        yield {**node_feature(n, d), 'id': str(i)}
+
+
+def edge_features(graph):
+    for i, (n1, n2, d) in enumerate(graph.edges(data=True)):
+        yield {**edge_feature(n1, n2, d), 'id': str(i)}
+
 
-    return {'nodes': json.loads(snodes), 'edges': json.loads(sedges)}
+def graph_to_json(graph):
+    return {'nodes': {'type': 'FeatureCollection', 'features': list(node_features(graph))},
+            'edges': {'type': 'FeatureCollection', 'features': list(edge_features(graph))}}
+
+
+def iter_graph_json(graph, extra=None, chunk_size=2**16):
+    """ graph_to_json(graph) merged with extra, written straight to bytes in
+    the canonical form of store.content_hash (sorted keys, no spaces) """
+    def dumps(obj):
+        return json.dumps(obj, sort_keys=True, separators=(',', ':'))
+
+    collections = {'edges': edge_features, 'nodes': node_features}
+    extra = extra or {}
+    buffer = []
+    size = 0
+    for i, key in enumerate(sorted([*collections, *extra])):
+        buffer.append(('{' if i == 0 else ',') + f'"{key}":')
+        if key in collections:
+            buffer.append('{"features":[')
+            for j, feature in enumerate(collections[key](graph)):
+                part = (',' if j else '') + dumps(feature)
+                buffer.append(part)
+                size += len(part)
+                if size >= chunk_size:
+                    yield ''.join(buffer).encode('utf-8')
+                    buffer, size = [], 0
+            buffer.append('],"type":"FeatureCollection"}')
+        else:
+            buffer.append(dumps(extra[key]))
+    buffer.append('}')
+    yield ''.join(buffer).encode('utf-8')
+
+
+def gzip_chunks(chunks):
+    z = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+class InvalidGraph(ValueError):
+    pass
+
+
+def _features(jdata, key, geometry_type):
+    """ validated features of the jdata[key] FeatureCollection """
+    collection = jdata.get(key) if isinstance(jdata, dict) else None
+    if not isinstance(collection, dict) or not isinstance(collection.get('features'), list):
+        raise InvalidGraph(f"'{key}' must be a GeoJSON FeatureCollection")
+    for i, feature in enumerate(collection['features']):
+        geom = feature.get('geometry') if isinstance(feature, dict) else None
+        if not isinstance(geom, dict) or geom.get('type') != geometry_type:
+            raise InvalidGraph(f'{key} feature {i} is not a {geometry_type}')
+        coords = geom.get('coordinates')
+        if geometry_type == 'Point':
+            coords = [coords]
+        if not isinstance(coords, list) or len(coords) < (2 if geometry_type == 'LineString' else 1) or \
+                not all(isinstance(c, list) and len(c) >= 2 for c in coords):
+            raise InvalidGraph(f'{key} feature {i} has invalid coordinates')
+        if not isinstance(feature.get('properties') or {}, dict):
+            raise InvalidGraph(f'{key} feature {i} has invalid properties')
+    return collection['features']
 
 
 def json_to_graph(jdata):
-    node_bytes = json.dumps(jdata['nodes']).encode('utf-8')
-    wnjson = BytesIO(node_bytes)
-    points = gpd.read_file(wnjson).drop('id', axis=1)
-    edge_bytes = json.dumps(jdata['edges']).encode('utf-8')
-    wejson = BytesIO(edge_bytes)
-    lines = gpd.read_file(wejson).drop('id', axis=1)
-    return quick_graph(points, lines)
-
-
-def quick_graph(points_df=None, lines_df=None):
-    if points_df is None:
-        points_df = gpd.read_file('database/points.shp')
-    if lines_df is None:
-        lines_df = gpd.read_file('database/lines.shp')
-
-    graph = momepy.gdf_to_nx(lines_df, approach='primal')
-
-    G = nx.Graph()
-
-    G.add_edges_from([(n1, n2, d) for n1, n2, d in graph.edges(data=True)])
-
-    vs = np.column_stack([points_df.loc[:, 'geometry'].x,
-                         points_df.loc[:, 'geometry'].y])
-    for n, d in G.nodes(data=True):
-        ai = np.argwhere(vs == np.array(n))
-        if len(ai) >= 1:
-            i = ai[0][0]
-            d['Type'] = points_df.loc[i, 'Type']
-            d['Name'] = points_df.loc[i, 'Name']
-            d['ECC'] = points_df.loc[i, 'ECC']
-            d['PS'] = points_df.loc[i, 'PS']
-            d['geometry'] = points_df.loc[i, 'geometry']
+    """ graph of the {'nodes': points, 'edges': lines} FeatureCollections
+    graph_to_json writes, built straight from the parsed features """
+    with stage('parse'):
+        point_features = _features(jdata, 'nodes', 'Point')
+        line_features = _features(jdata, 'edges', 'LineString')
+
+        line_props = [f.get('properties') or {} for f in line_features]
+        fields = list(dict.fromkeys(k for p in line_props for k in p))
+        try:
+            lines = [([(float(c[0]), float(c[1])) for c in f['geometry']['coordinates']],
+                      {k: p.get(k) for k in fields}) for f, p in zip(line_features, line_props)]
+            xy = np.array([f['geometry']['coordinates'][:2] for f in point_features],
+                          dtype=np.float64).reshape(-1, 2)
+        except (TypeError, ValueError):
+            raise InvalidGraph('Coordinates must be numbers')
+
+        point_props = [f.get('properties') or {} for f in point_features]
+        columns = {k: [p.get(k) for p in point_props] for k in ('Type', 'Name', 'ECC', 'PS')}
+        G = lines_graph(lines)
+    with stage('join'):
+        join_points(G, xy, columns)
+    return G
+
+
+def lines_graph(lines):
+    """ graph of [(coords, attributes)] polylines with the line ends as
+    nodes, built the way momepy.gdf_to_nx(approach='primal') does """
+    multi = nx.MultiGraph()
+    for coords, attrs in lines:
+        line = geometry.LineString(coords)
+        multi.add_edge(tuple(coords[0]), tuple(coords[-1]),
+                       **attrs, geometry=line, mm_len=line.length)
+
+    G = IndexedGraph()
+    G.add_edges_from(multi.edges(data=True))
+    return G
+
+
+def match_points(nodes, points, tolerance=None):
+    """ index of the point at each node location, -1 where there is none """
+    if tolerance is None:
+        lookup = {}
+        for i, xy in enumerate(map(tuple, points.tolist())):
+            lookup.setdefault(xy, i)
+        return np.array([lookup.get(n, -1) for n in nodes], dtype=np.int64)
+
+    if len(points) == 0:
+        return np.full(len(nodes), -1, dtype=np.int64)
+    # the nearest point within tolerance. Of the few nearest queried, the
+    # first row among those equally near (e.g. coincident ones) wins
+    k = min(4, len(points))
+    dists, idx = cKDTree(points).query(
+        np.array(nodes, dtype=float).reshape(-1, 2), k=k, distance_upper_bound=tolerance)
+    dists = dists.reshape(len(nodes), k)
+    tied = ~np.isinf(dists) & (dists == dists[:, :1])
+    found = np.where(tied, idx.reshape(len(nodes), k), len(points)).min(axis=1)
+    return np.where(found < len(points), found, -1)
+
+
+def join_points(G, xy, columns, geoms=None, tolerance=None):
+    """ give every node the Type, Name, ECC and PS columns of the point at
+    its location, nodes without one become JUNCs """
+    nodes = list(G.nodes)
+    matches = match_points(nodes, xy, tolerance=tolerance)
+
+    types = columns['Type']
+    names = columns['Name']
+    eccs = columns['ECC']
+    pss = columns['PS']
+    attrs = []
+    for n, i in zip(nodes, matches.tolist()):
+        if i >= 0:
+            attrs.append((n, {'Type': types[i], 'Name': names[i], 'ECC': eccs[i], 'PS': pss[i],
+                              'geometry': geoms[i] if geoms is not None else geometry.Point(*xy[i])}))
         else:
-            d['Type'] = 'JUNC'
-            d['Name'] = None
-            d['ECC'] = None
-            d['PS'] = None
-            d['geometry'] = geometry.Point(*n)
+            attrs.append((n, {'Type': 'JUNC', 'Name': None, 'ECC': None,
+                              'PS': None, 'geometry': geometry.Point(*n)}))
+    G.add_nodes_from(attrs)
+
+
+def quick_graph(points_df=None, lines_df=None, tolerance=None):
+    with stage('read'):
+        if points_df is None or lines_df is None:
+            import geopandas as gpd
+        if points_df is None:
+            points_df = gpd.read_file('database/points.shp')
+        if lines_df is None:
+            lines_df = gpd.read_file('database/lines.shp')
+
+    with stage('parse'):
+        records = lines_df.drop(columns=lines_df.geometry.name).to_dict('records')
+        G = lines_graph([(list(line.coords), attrs)
+                         for line, attrs in zip(lines_df.geometry.tolist(), records)])
+
+    with stage('join'):
+        vs = np.column_stack([points_df.geometry.x.to_numpy(),
+                              points_df.geometry.y.to_numpy()])
+        columns = {k: points_df[k].tolist() for k in ('Type', 'Name', 'ECC', 'PS')}
+        join_points(G, vs, columns, geoms=points_df.geometry.tolist(), tolerance=tolerance)
 
     return G
 
 
+BASE_SOURCES = ('database/points.shp', 'database/lines.shp')
+BASE_CACHE = 'database/graph.cache'
+BASE_BODY = 'database/graph.json.gz'
+
+_base = {'mtimes': None}
+_base_lock = threading.Lock()
+
+
+def _build_base(mtimes):
+    """ (graph, etag, body) of database/*.shp, body None when the graph
+    comes from BASE_CACHE, which keeps the etag of the body it was built
+    with """
+    try:
+        meta = graph_cache.read_meta(BASE_CACHE)[0]['meta']
+        if meta.get('mtimes') == mtimes and 'etag' in meta:
+            return graph_cache.load_graph(BASE_CACHE)[0], meta['etag'], None
+    except (ValueError, KeyError, OSError):
+        pass
+    G = quick_graph()
+    body = b''.join(iter_graph_json(G))
+    # same digest as store.content_hash of the parsed body
+    etag = hashlib.sha1(body).hexdigest()
+    graph_cache.save_graph(BASE_CACHE, G, meta={'mtimes': mtimes, 'etag': etag})
+    return G, etag, body
+
+
+def base():
+    """ the graph of database/*.shp and its etag, rebuilt only when one of
+    the shapefiles changes. base_body() adds the serialized response """
+    mtimes = [os.path.getmtime(p) for p in BASE_SOURCES]
+    if _base['mtimes'] != mtimes:
+        with _base_lock:
+            if _base['mtimes'] != mtimes:
+                G, etag, body = _build_base(mtimes)
+                for key in ('body', 'gzip', 'arrays'):
+                    _base.pop(key, None)
+                _base.update(graph=G, etag=etag, mtimes=mtimes)
+                if body is not None:
+                    _base['body'] = body
+    return _base
+
+
+def _saved_body(etag):
+    """ (body, gzip) of BASE_BODY if it holds the response with that etag,
+    else (None, None) """
+    try:
+        with open(BASE_BODY, 'rb') as f:
+            gz = f.read()
+        body = zlib.decompress(gz, 31)
+    except (OSError, zlib.error):
+        return None, None
+    if hashlib.sha1(body).hexdigest() != etag:
+        return None, None
+    return body, gz
+
+
+def base_body():
+    """ base() with the graph serialized as 'body' and gzipped as 'gzip',
+    made on first use and kept in BASE_BODY for the next start """
+    qg = base()
+    if 'gzip' not in qg:
+        with _base_lock:
+            if 'gzip' not in qg:
+                body, gz = qg.get('body'), None
+                if body is None:
+                    body, gz = _saved_body(qg['etag'])
+                if body is None:
+                    body = b''.join(iter_graph_json(qg['graph']))
+                if gz is None:
+                    gz = b''.join(gzip_chunks([body]))
+                    tmp = f'{BASE_BODY}.{os.getpid()}.tmp'
+                    with open(tmp, 'wb') as f:
+                        f.write(gz)
+                    os.replace(tmp, BASE_BODY)
+                qg.update(body=body, gzip=gz)
+    return qg
+
+
+def base_graph():
+    return base()['graph']
+
+
+SHARD_DIR = 'database/shards'
+
+network_shards = ShardSet(SHARD_DIR)
+_shards_lock = threading.Lock()
+
+
+def shards():
+    """ the per Exchange shards of database/*.shp, split off the base graph
+    only when one of the shapefiles changes """
+    mtimes = [os.path.getmtime(p) for p in BASE_SOURCES]
+    if network_shards.meta.get('mtimes') != mtimes:
+        with _shards_lock:
+            if network_shards.meta.get('mtimes') != mtimes:
+                network_shards.build(base_graph(), meta={'mtimes': mtimes})
+    return network_shards
+
+
+def preload():
+    """ import what the routes otherwise import on first use and build the
+    base graph, for a gunicorn master to share with its workers """
+    for name in ('geopandas', 'osmnx', 'scipy.sparse.csgraph', 'sklearn.cluster'):
+        importlib.import_module(name)
+    base_body()
+    shards()
+
+
 def nodes_with_attribute(nodes, key, value, listed=False):
+    matches = [n for n, d in nodes if d[key] == value]
     if not listed:
-        return [n for n, d in nodes if d[key] == value][0]
+        if not matches:
+            raise nx.NodeNotFound(f'No node with {key} {value}')
+        return matches[0]
     else:
-        return [n for n, d in nodes if d[key] == value]
+        return matches
+
+
+type_levels = {'Exchange': 0, 'PRM': 1,
+               'SEC': 2, 'PLR': 3, 'Drop point': 4}
+
+untypes = {
+    'Drop point': ['PLR', 'C4'],
+    'PLR': ['SEC', 'C3'],
+    'SEC': ['PRM', 'C2'],
+    'PRM': ['Exchange', 'C1']
+}
+
+# children each node type is planned for
+capacities = {'PLR': 60, 'SEC': 4, 'PRM': 2}
+
+
+def nearest_typed(graph, sources, ntypes, within=None):
+    """ multi-source BFS from sources that only walks through JUNC nodes
+    (and only over the within nodes, when given), maps every node reached
+    to the nearest of the sources and to the node it was reached from """
+    owner = {s: s for s in sources}
+    pred = {s: None for s in sources}
+    frontier = list(sources)
+    while frontier:
+        _frontier = []
+        for u in frontier:
+            o = owner[u]
+            for v in graph[u]:
+                if v in owner or (within is not None and v not in within):
+                    continue
+                owner[v] = o
+                pred[v] = u
+                if ntypes[v] == 'JUNC':
+                    _frontier.append(v)
+        frontier = _frontier
+    return owner, pred
+
+
+def hierarchy(graph):
+    """ parent and children of every typed node in the Exchange -> PRM ->
+    SEC -> PLR -> Drop point tree, a child hangs off the parent it reaches
+    through junctions only. pred[child type] leads from a child back to its
+    parent through those junctions. Cached on IndexedGraphs until the
+    graph changes. """
+    derived = getattr(graph, 'derived', {})
+    if 'hierarchy' in derived:
+        return derived['hierarchy']
+
+    # the searches run on the CSR arrays, the same as nearest_typed would
+    csr = csr_graph(graph)
+    nodes = csr.nodes
+    ntypes = nx.get_node_attributes(graph, 'Type')
+    junctions = csr.typed('JUNC')
+    parent = {}
+    children = {}
+    preds = {}
+    for key, (mtype, _) in untypes.items():
+        owner, pred = csr.bfs(np.flatnonzero(csr.typed(mtype)), through=junctions)
+        reached = np.flatnonzero(owner >= 0)
+        preds[key] = {nodes[i]: nodes[p] if p >= 0 else None
+                      for i, p in zip(reached.tolist(), pred[reached].tolist())}
+        linked = np.flatnonzero(csr.typed(key) & (owner >= 0))
+        for sn, mn in zip(linked.tolist(), owner[linked].tolist()):
+            parent[nodes[sn]] = nodes[mn]
+            children.setdefault(nodes[mn], []).append(nodes[sn])
+
+    h = {'parent': parent, 'children': children, 'pred': preds, 'types': ntypes}
+    derived['hierarchy'] = h
+    return h
+
+
+def link_path(h, child):
+    """ nodes from child up to its parent, junctions included """
+    pred = h['pred'][h['types'][child]]
+    path = [child]
+    while pred[path[-1]] is not None:
+        path.append(pred[path[-1]])
+    return path
 
 
 def reduce(graph=None):
     if graph is None:
-        graph = quick_graph()
+        graph = base_graph()
     vertices, edges = simplify(graph)
-    G = nx.Graph()
-    ntypes = nx.get_node_attributes(graph, 'Type')
-    edges = []
-
-    untypes = {
-        'Drop point': ['PLR', 'C4'],
-        'PLR': ['SEC', 'C3'],
-        'SEC': ['PRM', 'C2'],
-        'PRM': ['Exchange', 'C1']
-    }
-    classification = {
-        key: [n for n, d in vertices if d['Type'] == key] for key in untypes.keys()
-    }
+    G = IndexedGraph()
+    h = hierarchy(graph)
 
     edges = []
-    for key, value in classification.items():
-        masters = nodes_with_attribute(
-            vertices, key='Type', value=untypes[key][0], listed=True)
-        for sn in value:
-            for mn in masters:
-                spath = nx.shortest_path(graph, source=mn, target=sn)
-                if len([n for n in spath if ntypes[n] != 'JUNC']) == 2:
-                    edges.append((mn, sn,
-                                  {'Type': untypes[key][1], 'geometry': geometry.LineString((mn, sn))}))
-                    break
+    for key in untypes.keys():
+        for sn in nodes_typed(graph, key):
+            mn = h['parent'].get(sn)
+            if mn is not None:
+                edges.append((mn, sn,
+                              {'Type': untypes[key][1], 'geometry': geometry.LineString((mn, sn))}))
 
     G.add_nodes_from(vertices)
     G.add_edges_from(edges)
     return G
 
 
-def optimal_centrality(max_attachments=None, relocate='PLR', ngraph=None):
+def capacitated_assignment(locs, centers, capacity):
+    """ label every location with a center holding at most capacity of them,
+    most constrained locations (small gap to their second choice) first """
+    k = len(centers)
+    tree = cKDTree(centers)
+    dists, order = tree.query(locs, k=min(k, 16))
+    dists = dists.reshape(len(locs), -1)
+    order = order.reshape(len(locs), -1)
+    regret = dists[:, 1] - dists[:, 0] if k > 1 else np.zeros(len(locs))
+
+    load = np.zeros(k, dtype=np.int64)
+    labels = np.empty(len(locs), dtype=np.int64)
+    for j in np.argsort(-regret, kind='stable'):
+        free = order[j][load[order[j]] < capacity]
+        if len(free) == 0:
+            # every close center is full, take the nearest one with room
+            room = np.flatnonzero(load < capacity)
+            free = room[[np.argmin(((centers[room] - locs[j])**2).sum(axis=1))]]
+        labels[j] = free[0]
+        load[free[0]] += 1
+    return labels
+
+
+def capacitated_kmeans(locs, k, capacity, iterations=10):
+    from sklearn.cluster import MiniBatchKMeans
+
+    centers = MiniBatchKMeans(n_clusters=k, n_init=3,
+                              random_state=42).fit(locs).cluster_centers_
+    for _ in range(iterations):
+        labels = capacitated_assignment(locs, centers, capacity)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centers)
+        np.add.at(sums, labels, locs)
+        _centers = np.where(counts[:, None] > 0,
+                            sums / np.maximum(counts, 1)[:, None], centers)
+        if np.allclose(_centers, centers):
+            break
+        centers = _centers
+    return labels, centers
+
+
+def optimal_centrality(max_attachments=None, relocate='PLR', ngraph=None, method='kmeans'):
+    """ method: 'kmeans', 'minibatch' (MiniBatchKMeans, for large networks)
+    or 'capacity' (no centrality gets more than max_attachments) """
 
     gmap = {
-        'PLR': ['Drop point', 'SEC', 'C4', 'C3', 60],
-        'SEC': ['PLR', 'PRM', 'C3', 'C2', 4],
-        'PRM': ['SEC', 'Exchange', 'C2', 'C1', 2],
+        'PLR': ['Drop point', 'SEC', 'C4', 'C3', capacities['PLR']],
+        'SEC': ['PLR', 'PRM', 'C3', 'C2', capacities['SEC']],
+        'PRM': ['SEC', 'Exchange', 'C2', 'C1', capacities['PRM']],
     }
 
     if ngraph is None:
         ngraph = reduce()
 
-    nodes = [n[0] for n in ngraph.nodes(
-        data=True) if n[1]['Type'] == gmap[relocate][0]]
+    nodes = nodes_typed(ngraph, gmap[relocate][0])
     locs = np.array(nodes)
 
     if max_attachments is None:
         max_attachments = gmap[relocate][4]
 
-    if len(nodes) < max_attachments:
+    # for capacity max_attachments is a hard cap, kept as asked
+    if len(nodes) < max_attachments and method != 'capacity':
         max_attachments = max(int(len(nodes)/8), 1)
     k = int(len(nodes)/max_attachments)
 
-    kmeans = KMeans(
-        init="random",
-        n_clusters=k,
-        n_init=10,
-        max_iter=300,
-        random_state=42
-    )
+    if method == 'kmeans':
+        from sklearn.cluster import KMeans
+        kmeans = KMeans(
+            init="random",
+            n_clusters=k,
+            n_init=10,
+            max_iter=300,
+            random_state=42
+        ).fit(locs)
+        labels, centers = kmeans.labels_, kmeans.cluster_centers_
+    elif method == 'minibatch':
+        from sklearn.cluster import MiniBatchKMeans
+        kmeans = MiniBatchKMeans(
+            n_clusters=k,
+            n_init=3,
+            batch_size=1024,
+            random_state=42
+        ).fit(locs)
+        labels, centers = kmeans.labels_, kmeans.cluster_centers_
+    elif method == 'capacity':
+        k = -(-len(nodes) // max_attachments)
+        labels, centers = capacitated_kmeans(locs, k, max_attachments)
+    else:
+        raise ValueError(f'Unknown clustering method {method}')
 
-    kmeans.fit(locs)
+    ngraph.remove_nodes_from(nodes_typed(ngraph, relocate))
 
-    ngraph.remove_nodes_from(
-        [n[0] for n in ngraph.nodes(data=True) if n[1]['Type'] == relocate])
+    members = [[] for _ in range(len(centers))]
+    for j, i in enumerate(labels.tolist()):
+        members[i].append(nodes[j])
 
-    for i in range(kmeans.n_clusters):
-        center = kmeans.cluster_centers_[i]
+    for i, center in enumerate(centers.tolist()):
+        if not members[i]:
+            continue
         cnode = (center[0], center[1])
         ngraph.add_node(cnode, Type=f'{relocate}', Name=f'{relocate}{i}', geometry=geometry.Point(
             center[0], center[1]))
-        for j in np.where(kmeans.labels_ == i)[0]:
-            coords = locs[j]
-            for node in nodes:
-                if coords[0] in node and coords[1] in node:
-                    ngraph.add_edge(cnode, node, Type=gmap[relocate][2], geometry=geometry.LineString(
-                        [[node[0], node[1]], [cnode[0], cnode[1]]]))
-
-    parents = [n[0] for n in ngraph.nodes(
-        data=True) if n[1]['Type'] == gmap[relocate][1]]
-
-    def dist(o, d):
-        return np.sqrt((o[0]-d[0])**2 + (o[1]-d[1])**2)
-
-    def min_dist_parent(n):
-        min_dist = 100000
-        parent = None
-        for p in parents:
-            if dist(n, p) < min_dist:
-                min_dist = dist(n, p)
-                parent = p
-        return parent
-
-    centralities = [n[0] for n in ngraph.nodes(
-        data=True) if n[1]['Type'] == f'{relocate}']
-    for centrality in centralities:
-        parent = min_dist_parent(centrality)
-        if parent is not None:
+        ngraph.add_edges_from([(cnode, node, {'Type': gmap[relocate][2], 'geometry': geometry.LineString(
+            [[node[0], node[1]], [cnode[0], cnode[1]]])}) for node in members[i]])
+
+    parents = nodes_typed(ngraph, gmap[relocate][1])
+    centralities = nodes_typed(ngraph, relocate)
+    if parents and centralities:
+        _, nearest_parent = cKDTree(np.array(parents)).query(np.array(centralities))
+        for centrality, p in zip(centralities, nearest_parent.tolist()):
+            parent = parents[p]
             ngraph.add_edge(centrality, parent, Type=gmap[relocate][3], geometry=geometry.LineString(
                 [[parent[0], parent[1]], [centrality[0], centrality[1]]]))
 
@@ -186,71 +572,217 @@ def optimal_centrality(max_attachments=None, relocate='PLR', ngraph=None):
 
 
 def get_bounds(vertices, edges):
-    vb = gpd.GeoSeries([n[1]['geometry'] for n in vertices]).total_bounds
-    eb = gpd.GeoSeries([n[2]['geometry'] for n in edges]).total_bounds
-    mns = np.array([vb, eb]).min(axis=0)
-    mxs = np.array([vb, eb]).max(axis=0)
-    bounds = np.concatenate([mns[:2], mxs[2:]]).tolist()
+    vb = np.array([n[1]['geometry'].bounds for n in vertices]).reshape(-1, 4)
+    eb = np.array([n[2]['geometry'].bounds for n in edges]).reshape(-1, 4)
+    b = np.concatenate([vb, eb])
+    bounds = np.concatenate([b[:, :2].min(axis=0), b[:, 2:].max(axis=0)]).tolist()
     return bounds
 
 
 def get_osm(vertices, edges):
+    import osmnx as ox
+
     bounds = get_bounds(vertices, edges)
     minx, miny, maxx, maxy = bounds
     osm_graph = ox.graph.graph_from_bbox(
         north=maxy, south=miny, east=maxx, west=minx, network_type='walk')
-    ox.io.save_graphml(osm_graph, filepath='database/osm.graphml',
+    ox.io.save_graphml(osm_graph, filepath=streets.OSM_GRAPHML,
                        gephi=False, encoding='utf-8')
     return osm_graph
 
 
 def osm(vertices, edges):
-    if os.path.isfile('database/osm.graphml'):
-        osm_graph = ox.load_graphml('database/osm.graphml')
+    """ the cached StreetGraph, downloaded from Overpass on first use unless
+    OSM_OFFLINE is set (build the cache with `python streets.py import`) """
+    street_graph = streets.street_graph()
+    if street_graph is None:
+        if os.environ.get('OSM_OFFLINE'):
+            raise FileNotFoundError(
+                f'No street graph at {streets.OSM_GRAPHML}, run `python streets.py import <file.osm>`')
+        get_osm(vertices, edges)
+        street_graph = streets.street_graph()
+    return street_graph
+
+
+def line_length(coords):
+    """ metres along a polyline of lon/lat coordinates """
+    lon, lat = np.radians(np.asarray(coords, dtype=float)).T
+    a = np.sin(np.diff(lat)/2)**2 + np.cos(lat[:-1]) * \
+        np.cos(lat[1:])*np.sin(np.diff(lon)/2)**2
+    return float(2*EARTH_RADIUS*np.arcsin(np.sqrt(a)).sum())
+
+
+def edge_length(d):
+    # osmnx edges already carry their length in metres
+    if 'length' in d:
+        return d['length']
+    return line_length(d['geometry'].coords)
+
+
+def shortest_path_tree(graph, source, targets, weight=None):
+    """ predecessors from one search out of source, breadth first or by
+    edge length when weight='length', stopping once all targets are reached """
+    pred = {source: None}
+    remaining = set(targets)
+    remaining.discard(source)
+    if weight is None:
+        frontier = [source]
+        while frontier and remaining:
+            _frontier = []
+            for u in frontier:
+                for v in graph[u]:
+                    if v not in pred:
+                        pred[v] = u
+                        remaining.discard(v)
+                        _frontier.append(v)
+            frontier = _frontier
     else:
-        osm_graph = get_osm(vertices, edges)
-    return osm_graph
+        multi = graph.is_multigraph()
+        dist = {source: 0}
+        settled = set()
+        heap = [(0, 0, source)]
+        pushes = 1
+        while heap and remaining:
+            du, _, u = heapq.heappop(heap)
+            if u in settled:
+                continue
+            settled.add(u)
+            remaining.discard(u)
+            for v, d in graph[u].items():
+                if v in settled:
+                    continue
+                w = min(edge_length(k) for k in d.values()) if multi else edge_length(d)
+                if du + w < dist.get(v, np.inf):
+                    dist[v] = du + w
+                    pred[v] = u
+                    heapq.heappush(heap, (du + w, pushes, v))
+                    pushes += 1
+    if remaining:
+        raise nx.NetworkXNoPath(
+            f'No path between {source} and {next(iter(remaining))}')
+    return pred
+
+
+def steiner_paths(graph, source, targets):
+    """ approximate Steiner tree joining source and targets by edge length
+    (Takahashi-Matsuyama): grow the tree by the cheapest path to the closest
+    remaining target. Distances to the tree are kept up to date by searching
+    out of each newly added path only, returns nodes and (u, v) edges """
+    multi = graph.is_multigraph()
+    dist = {}
+    pred = {}
+    in_tree = set()
+    pushes = 0
+
+    def grow(seeds):
+        nonlocal pushes
+        heap = []
+        for s in seeds:
+            in_tree.add(s)
+            dist[s] = 0
+            pred[s] = None
+            heap.append((0, pushes, s))
+            pushes += 1
+        heapq.heapify(heap)
+        while heap:
+            du, _, u = heapq.heappop(heap)
+            if du > dist[u]:
+                continue
+            for v, d in graph[u].items():
+                w = min(edge_length(k) for k in d.values()) if multi else edge_length(d)
+                if du + w < dist.get(v, np.inf):
+                    dist[v] = du + w
+                    pred[v] = u
+                    heapq.heappush(heap, (du + w, pushes, v))
+                    pushes += 1
+
+    grow([source])
+    nodes = [source]
+    edges = []
+    remaining = set(targets) - in_tree
+    while remaining:
+        target = min(remaining, key=lambda t: dist.get(t, np.inf))
+        if target not in dist:
+            raise nx.NetworkXNoPath(f'No path between {source} and {target}')
+        path = []
+        n = target
+        while n not in in_tree:
+            path.append(n)
+            edges.append((pred[n], n))
+            n = pred[n]
+        nodes.extend(path)
+        remaining.difference_update(path)
+        grow(path)
+    return nodes, edges
+
+
+def _shortest_path(graph, destination_name, origin_name='E0', is_osm_graph=False, weight=None):
+    return shortest_path(graph, [destination_name], origin_name=origin_name,
+                         is_osm_graph=is_osm_graph, weight=weight)
+
+
+def csr_path_tree(graph, source, targets, weight=None):
+    """ shortest_path_tree searched on the CSR arrays of the graph """
+    csr = csr_graph(graph)
+    nodes = csr.nodes
+    s = csr.index(source)
+    ts = [csr.index(t) for t in targets]
+    if weight is None:
+        _, pred = csr.bfs([s], targets=ts)
+    else:
+        pred = csr.dijkstra(s)
+    missing = [t for t in ts if t != s and pred[t] < 0]
+    if missing:
+        raise nx.NetworkXNoPath(f'No path between {source} and {nodes[missing[0]]}')
+    return PredArray(csr, pred)
 
 
-def _shortest_path(graph, destination_name, origin_name='E0', is_osm_graph=False):
-    if not is_osm_graph:
-        source = [n[0] for n in graph.nodes(
-            data=True) if n[1]['Name'] == origin_name][0]
-        target = [n[0] for n in graph.nodes(
-            data=True) if n[1]['Name'] == destination_name][0]
-    else:
-        source = origin_name
-        target = destination_name
+class PredArray:
+    """ a CSR predecessor array read as the {node: predecessor} dict of
+    shortest_path_tree """
+
+    def __init__(self, csr, pred):
+        self.csr = csr
+        self.pred = pred
+
+    def __getitem__(self, n):
+        p = int(self.pred[self.csr.index(n)])
+        return self.csr.nodes[p] if p >= 0 else None
 
-    path_nodes_names = nx.shortest_path(graph, source, target)
 
+def shortest_path(graph, destination_names, origin_name='E0', is_osm_graph=False, return_graph=False, weight=None):
     if not is_osm_graph:
-        path_nodes = [(n, graph.nodes[n]) for n in path_nodes_names]
+        source = node_named(graph, origin_name)
+        targets = [node_named(graph, name) for name in destination_names]
+        pred = csr_path_tree(graph, source, targets, weight=weight)
     else:
-        path_nodes = path_nodes_names
+        source = origin_name
+        targets = list(destination_names)
+        pred = shortest_path_tree(graph, source, targets, weight=weight)
 
-    path_edges = graph.edges(path_nodes_names, data=True)
+    # walk each target back up the tree until it joins an emitted path
+    path_nodes = []
     filtered_path_edges = []
-    for n1, n2, d in path_edges:
-        if n1 in path_nodes_names and n2 in path_nodes_names:
+    seen = set()
+    for target in targets:
+        n = target
+        while n not in seen:
+            seen.add(n)
+            p = pred[n]
             if not is_osm_graph:
-                filtered_path_edges.append((n1, n2, d))
+                path_nodes.append((n, graph.nodes[n]))
+                if p is not None:
+                    filtered_path_edges.append((p, n, graph.edges[p, n]))
             else:
-                filtered_path_edges.append((n1, n2))
-    return path_nodes, filtered_path_edges
-
-
-def shortest_path(graph, destination_names, origin_name='E0', is_osm_graph=False, return_graph=False):
-    path_nodes = []
-    filtered_path_edges = []
-    for destination_name in destination_names:
-        n, e = _shortest_path(graph, destination_name,
-                              origin_name=origin_name, is_osm_graph=is_osm_graph)
-        path_nodes.extend(n)
-        filtered_path_edges.extend(e)
+                path_nodes.append(n)
+                if p is not None:
+                    filtered_path_edges.append((p, n))
+            if p is None:
+                break
+            n = p
 
     if return_graph:
-        shgraph = nx.Graph()
+        shgraph = IndexedGraph()
         shgraph.add_edges_from(filtered_path_edges)
         shgraph.add_nodes_from(path_nodes)
         return shgraph
@@ -265,50 +797,56 @@ def unique(x):
     return y
 
 
-def node_connections(graph, name, upto=None, return_graph=False):
-    type_levels = {'Exchange': 0, 'PRM': 1,
-                   'SEC': 2, 'PLR': 3, 'Drop point': 4}
-    ntypes = nx.get_node_attributes(graph, 'Type')
-    nnames = nx.get_node_attributes(graph, 'Name')
-    onode = [n[0] for n in graph.nodes(data=True) if n[1]['Name'] == name][0]
-    to_type = ntypes[onode]
-    from_type = list(type_levels.keys())[min(type_levels[to_type]+1, 4)]
-
-    spaths = []
-    from_type_nodes = [n for n, d in graph.nodes(
-        data=True) if d['Type'] == from_type]
-    for ftnode in from_type_nodes:
-        spath = nx.shortest_path(graph, onode, ftnode)
-        is_true = True
-        for snode in spath:
-            if ntypes[snode] == 'JUNC' or nnames[snode] == name:
-                continue
-            if type_levels[ntypes[snode]] <= type_levels[to_type] or type_levels[ntypes[snode]] > type_levels[from_type]:
-                is_true = False
-                break
-        if is_true:
-            spaths.extend(spath)
+def downstream(graph, onode, depth=1):
+    """ nodes and edges of the links hanging below onode, depth levels down """
+    h = hierarchy(graph)
+    nodes = [onode]
+    seen = {onode}
+    edges = []
+    level = [onode]
+    for _ in range(depth):
+        _level = []
+        for p in level:
+            for c in h['children'].get(p, ()):
+                _level.append(c)
+                # walk up until the path joins one already emitted
+                pred = h['pred'][h['types'][c]]
+                n = c
+                while n not in seen:
+                    seen.add(n)
+                    nodes.append(n)
+                    edges.append((pred[n], n))
+                    n = pred[n]
+        level = _level
+    return [(n, graph.nodes[n]) for n in nodes], [(u, v, graph.edges[u, v]) for u, v in edges]
+
+
+def upstream(graph, onode, upto):
+    """ path from the node named upto down to onode, through the hierarchy
+    when upto is an ancestor of onode """
+    h = hierarchy(graph)
+    target = node_named(graph, upto)
+    path = [onode]
+    while path[-1] != target and path[-1] in h['parent']:
+        path.extend(link_path(h, path[-1])[1:])
+    if path[-1] != target:
+        return shortest_path(graph, destination_names=[
+                             graph.nodes[onode]['Name']], origin_name=upto)
+    return ([(n, graph.nodes[n]) for n in path],
+            [(u, v, graph.edges[u, v]) for u, v in zip(path[1:], path[:-1])])
 
-    spaths = unique(spaths)
-    path_nodes = [(n, graph.nodes[n]) for n in spaths]
-    path_edges = graph.edges(spaths, data=True)
-    path_edges = unique(path_edges)
-    filtered_path_edges = []
-    for n1, n2, d in path_edges:
-        if n1 in spaths and n2 in spaths:
-            filtered_path_edges.append((n1, n2, d))
-    path_edges = filtered_path_edges
+
+def node_connections(graph, name, upto=None, return_graph=False):
+    onode = node_named(graph, name)
+    path_nodes, path_edges = downstream(graph, onode, depth=1)
 
     if upto is not None:
-        v, e = shortest_path(graph, destination_names=[
-                             nnames[onode]], origin_name=upto)
+        v, e = upstream(graph, onode, upto)
         path_nodes.extend(v)
         path_edges.extend(e)
-        path_nodes = unique(path_nodes)
-        path_edges = unique(path_edges)
 
     if return_graph:
-        ncgraph = nx.Graph()
+        ncgraph = IndexedGraph()
         ncgraph.add_edges_from(path_edges)
         ncgraph.add_nodes_from(path_nodes)
         return ncgraph
@@ -317,85 +855,95 @@ def node_connections(graph, name, upto=None, return_graph=False):
 
 
 def circuits(graph, name, from_type, upto=None, return_graph=False):
-    type_levels = {'Exchange': 0, 'PRM': 1,
-                   'SEC': 2, 'PLR': 3, 'Drop point': 4}
     ntypes = nx.get_node_attributes(graph, 'Type')
-    nnames = nx.get_node_attributes(graph, 'Name')
-    onode = [n[0] for n in graph.nodes(data=True) if n[1]['Name'] == name][0]
+    onode = node_named(graph, name)
     to_type = ntypes[onode]
 
     level_diff = type_levels[from_type]-type_levels[to_type]
     if level_diff > 1:
-        ns = []
-        es = []
-        pnames = [name]
-        _pnames = []
-        for i in range(level_diff):
-            for pname in pnames:
-                n, e = node_connections(graph, pname)
-                ns.extend(n)
-                es.extend(e)
-                gpnode = [gpn[0] for gpn in graph.nodes(
-                    data=True) if gpn[1]['Name'] == pname][0]
-                ptype = list(type_levels.keys())[
-                    min(type_levels[ntypes[gpnode]]+1, 4)]
-                _pnames.extend([nnames[pn]
-                               for pn, pd in n if pd['Type'] == ptype])
-            pnames.clear()
-            pnames.extend(_pnames)
+        ns, es = downstream(graph, onode, depth=level_diff)
 
         if upto is not None:
-            v, e = shortest_path(graph, destination_names=[
-                                 nnames[onode]], origin_name=upto)
+            v, e = upstream(graph, onode, upto)
             ns.extend(v)
             es.extend(e)
-            ns = unique(ns)
-            es = unique(es)
 
         if return_graph:
-            ncgraph = nx.Graph()
+            ncgraph = IndexedGraph()
             ncgraph.add_edges_from(es)
             ncgraph.add_nodes_from(ns)
             return ncgraph
+        return ns, es
     else:
         return node_connections(graph, name, upto=upto, return_graph=return_graph)
 
 
-def reverse_partial_reduction(rgraph, reverse_level_name, return_graph=False):
+def snap_to_segments(points, starts, ends):
+    """ nearest segment of every point, found through an STRtree over the
+    segments, and the fraction along it (clipped to 0..1) of the point's
+    projection """
+    import geopandas as gpd
+
+    lines = gpd.GeoSeries([geometry.LineString([a, b])
+                          for a, b in zip(starts.tolist(), ends.tolist())])
+    query = gpd.GeoSeries(gpd.points_from_xy(points[:, 0], points[:, 1]))
+    qi, si = lines.sindex.nearest(query, return_all=False)
+    near = np.empty(len(points), dtype=np.int64)
+    near[qi] = si
+
+    a, b = starts[near], ends[near]
+    ab = b - a
+    norm = (ab**2).sum(axis=1)
+    t = np.divide(((points - a)*ab).sum(axis=1), norm,
+                  out=np.zeros(len(points)), where=norm > 0)
+    return near, np.clip(t, 0, 1)
+
+
+def prune_junctions(graph):
+    """ drop dangling JUNC nodes until none is left """
+    leaves = [n for n, d in graph.nodes(data=True)
+              if d['Type'] == 'JUNC' and graph.degree(n) < 2]
+    while leaves:
+        n = leaves.pop()
+        if n not in graph:
+            continue
+        neighbours = list(graph[n])
+        graph.remove_node(n)
+        leaves.extend([m for m in neighbours
+                       if graph.nodes[m]['Type'] == 'JUNC' and graph.degree(m) < 2])
+
+
+def reverse_partial_reduction(rgraph, reverse_level_name, return_graph=False, routing='hops'):
+    """ routing: 'hops' (fewest street segments), 'tree' (shortest path tree
+    by length) or 'steiner' (one shared tree of minimal approximate length,
+    or the 'tree' routing where that lays less cable). The length of cable
+    laid is left in graph.graph['cable_length'] """
     rG = rgraph.copy()
     rGvertices, rGedges = simplify(rG)
-    osm_graph = osm(rGvertices, rGedges)
+    street_graph = osm(rGvertices, rGedges)
+    osm_graph = street_graph.graph
 
     osmx = nx.get_node_attributes(osm_graph, 'x')
     osmy = nx.get_node_attributes(osm_graph, 'y')
 
-    new_nodes = []
-    new_edges = []
-    to_be_removed_edges = []
-
-    def nearest_node_id(point):
-        nn = ox.nearest_nodes(osm_graph, point[0], point[1])
-        return nn
-
-    def route_ids(destinations, origin):
-        osm_destination_ids = []
-        for dnode, ddata in destinations:
-            if ddata['Name'] == nnames[origin]:
-                continue
-            osm_destination_ids.append(nearest_node_id(dnode))
-
-        osm_destination_ids = unique(osm_destination_ids)
+    def route_ids(destinations, origin, routing):
+        points = [dnode for dnode, ddata in destinations
+                  if ddata['Name'] != nnames[origin]]
+        osm_destination_ids = list(
+            dict.fromkeys(street_graph.nearest_nodes(points)))
+        osm_origin_id = street_graph.nearest_nodes([origin])[0]
 
+        if routing == 'steiner':
+            return steiner_paths(osm_graph, osm_origin_id, osm_destination_ids)
         v, e = shortest_path(osm_graph, destination_names=osm_destination_ids,
-                             origin_name=nearest_node_id(origin), is_osm_graph=True)
+                             origin_name=osm_origin_id, is_osm_graph=True,
+                             weight='length' if routing == 'tree' else None)
 
         return v, e
 
-    origin = [n for n, d in rGvertices if d['Name'] == reverse_level_name][0]
+    origin = node_named(rG, reverse_level_name)
     nnames = nx.get_node_attributes(rG, 'Name')
     ntypes = nx.get_node_attributes(rG, 'Type')
-    type_levels = {'Exchange': 0, 'PRM': 1,
-                   'SEC': 2, 'PLR': 3, 'Drop point': 4}
     edge_types = {'Exchange': 'C1', 'PRM': 'C2', 'SEC': 'C3', 'PLR': 'C4'}
     reverse_level_name_type = ntypes[origin]
     from_type_level = min(type_levels[reverse_level_name_type]+1, 4)
@@ -404,165 +952,1033 @@ def reverse_partial_reduction(rgraph, reverse_level_name, return_graph=False):
     new_edge_type = edge_types[reverse_level_name_type]
 
     destinations, _ = node_connections(rG, name=reverse_level_name, upto=None)
-    to_be_removed_edges.extend([(origin, dnode) for dnode, _ in destinations])
-    to_be_removed_edges.extend([(dnode, origin) for dnode, _ in destinations])
-    rG.remove_edges_from(to_be_removed_edges)
-
-    v_ids = []
-    e_ids = []
-
-    v_id, e_id = route_ids(destinations, origin)
-
-    v_ids.extend(v_id)
-    e_ids.extend(e_id)
-    v_ids = unique(v_ids)
-    e_ids = unique(e_ids)
-
-    new_nodes.extend([((osmx[v_id], osmy[v_id]), {
-                     'Type': 'JUNC', 'Name': None, 'geometry': geometry.Point(osmx[v_id], osmy[v_id])}) for v_id in v_ids])
-    new_edges.extend([
-        (
-            (osmx[e_id[0]], osmy[e_id[0]]),
-            (osmx[e_id[1]], osmy[e_id[1]]),
-            {
-                'Type': new_edge_type,
-                'geometry': geometry.LineString([[osmx[e_id[0]], osmy[e_id[0]]], [osmx[e_id[1]], osmy[e_id[1]]]])
-            }
-        ) for e_id in e_ids
-    ])
-
-    def nearest(node):
-        n, d = node
-        dist1 = [d['geometry'].distance(line['geometry'])
-                 for _, _, line in new_edges]
-        min_dist1 = np.min(dist1)
-        dist2 = [d['geometry'].distance(point['geometry'])
-                 for _, point in new_nodes]
-        min_dist2 = np.min(dist2)
-
-        if min_dist1 < min_dist2:
-            feature = new_edges[np.argmin(dist1)]
-            return feature, 0
-        else:
-            feature = new_nodes[np.argmin(dist2)]
-            return feature, 1
-
-    for n, d in destinations:
-        near, near_type = nearest((n, d))
-        if near_type == 1:
-            near_node, near_d = near
-            new_edges.append((
-                n,
-                near_node,
-                {
-                    'Type': new_edge_type,
-                    'geometry': geometry.LineString([[n[0], n[1]], [near_node[0], near_node[1]]])
-                }
-            ))
-
+    rG.remove_edges_from([(origin, dnode) for dnode, _ in destinations])
+
+    def lay(v_ids, e_ids):
+        """ the JUNC nodes and cables of a route, every destination linked
+        to it """
+        v_ids = unique(v_ids)
+        e_ids = unique(e_ids)
+        new_nodes = [((osmx[v_id], osmy[v_id]), {
+                     'Type': 'JUNC', 'Name': None, 'geometry': geometry.Point(osmx[v_id], osmy[v_id])}) for v_id in v_ids]
+        new_edges = []
+        segments = [((osmx[e_id[0]], osmy[e_id[0]]), (osmx[e_id[1]], osmy[e_id[1]]))
+                    for e_id in e_ids]
+
+        if not segments:
+            # every destination maps onto the origin's street node
+            new_edges.extend([link(n, new_nodes[0][0]) for n, d in destinations])
+            segments_cut = {}
         else:
-            nn1, nn2, nd = near
-            nn1x, nn1y = nn1
-            nn2x, nn2y = nn2
-            nnx, nny = n
-            m = (nn2y - nn1y)/(nn2x-nn1x)
-            py = (nnx*m + nny*m**2 - nn2x*m + nn2y)/(1+m**2)
-            px = nnx - (py-nny)*m
-
-            new_nodes.append(((px, py), {
-                             'Type': 'JUNC', 'Name': None, 'geometry': geometry.Point(px, py)}))
-
-            new_edges.append((
-                nn1,
-                (px, py),
-                {
-                    'Type': new_edge_type,
-                    'geometry': geometry.LineString([[nn1[0], nn1[1]], [px, py]])
-                }
-            ))
-
-            new_edges.append((
-                nn2,
-                (px, py),
-                {
-                    'Type': new_edge_type,
-                    'geometry': geometry.LineString([[nn2[0], nn2[1]], [px, py]])
-                }
-            ))
-
-            new_edges.append((
-                n,
-                (px, py),
-                {
-                    'Type': new_edge_type,
-                    'geometry': geometry.LineString([[n[0], n[1]], [px, py]])
-                }
-            ))
-
-            to_be_removed_edges.append((nn1, nn2))
+            # snap every destination onto the route at the foot of its
+            # perpendicular, or the segment end when it falls outside
+            starts = np.array([a for a, _ in segments])
+            ends = np.array([b for _, b in segments])
+            near, fractions = snap_to_segments(
+                np.array([n for n, _ in destinations]), starts, ends)
+            segments_cut = {}
+            for (n, d), i, t in zip(destinations, near.tolist(), fractions.tolist()):
+                nn1, nn2 = segments[i]
+                if t <= 0:
+                    new_edges.append(link(n, nn1))
+                elif t >= 1:
+                    new_edges.append(link(n, nn2))
+                else:
+                    p = (nn1[0] + t*(nn2[0]-nn1[0]), nn1[1] + t*(nn2[1]-nn1[1]))
+                    new_nodes.append((p, {'Type': 'JUNC', 'Name': None,
+                                          'geometry': geometry.Point(*p)}))
+                    new_edges.append(link(n, p))
+                    segments_cut.setdefault(i, []).append((t, p))
+
+        # route segments with destinations on them are split at every foot
+        for i, (nn1, nn2) in enumerate(segments):
+            chain = [nn1] + [p for _, p in sorted(segments_cut.get(i, []))] + [nn2]
+            chain = list(dict.fromkeys(chain))
+            new_edges.extend([link(p1, p2) for p1, p2 in zip(chain[:-1], chain[1:])])
+        return new_nodes, new_edges
+
+    def link(n1, n2):
+        return (n1, n2, {'Type': new_edge_type, 'geometry': geometry.LineString([n1, n2])})
+
+    def laid_length(graph, new_edges):
+        laid = {frozenset((n1, n2)) for n1, n2, _ in new_edges}
+        return sum(edge_length(graph.edges[tuple(e)]) for e in laid if len(e) == 2 and graph.has_edge(*e))
+
+    def cable_length(new_nodes, new_edges):
+        """ cable a route lays, pruned on a graph of its own """
+        G = IndexedGraph()
+        G.add_nodes_from(destinations)
+        G.add_nodes_from(new_nodes)
+        G.add_edges_from(new_edges)
+        prune_junctions(G)
+        return laid_length(G, new_edges)
+
+    new_nodes, new_edges = lay(*route_ids(destinations, origin, routing))
+    if routing == 'steiner':
+        # the Steiner tree is a heuristic whose links to the destinations
+        # now and then make it lay more cable than the shortest path tree
+        tree = lay(*route_ids(destinations, origin, 'tree'))
+        if cable_length(*tree) < cable_length(new_nodes, new_edges):
+            new_nodes, new_edges = tree
 
     rG.add_nodes_from(new_nodes)
     rG.add_edges_from(new_edges)
-    rG.remove_edges_from(to_be_removed_edges)
+    prune_junctions(rG)
+    rG.graph['cable_length'] = laid_length(rG, new_edges)
 
     if return_graph:
-        for _ in range(6):
-            to_be_removed_nodes = [n for n, d in rG.nodes(
-                data=True) if d['Type'] == 'JUNC' and len(rG.edges(n)) < 2]
-            rG.remove_nodes_from(to_be_removed_nodes)
         return rG
 
     return rG.nodes(data=True), rG.edges(data=True)
 
 
-def hl_discrepancies(graph):
-    nnames = nx.get_node_attributes(graph, 'Name')
-    return {
-        'Duplicates': [(nnames[n]) for n, d in graph.nodes(data=True) if d['Type'] == 'Drop point' and len(list(graph.edges(n))) > 1],
-        'Disconnected': [(nnames[n]) for n, d in graph.nodes(data=True) if d['Type'] == 'Drop point' and len(list(graph.edges(n))) < 1]
-    }
-
+def drop_status(graph, n):
+    """ the hl_discrepancies list a drop point belongs in, if any """
+    degree = graph.degree(n)
+    if degree > 1:
+        return 'Duplicates'
+    if degree < 1:
+        return 'Disconnected'
+    return None
 
-def e2e(graph, caller, reciever, return_graph=True):
-    kkgraph = graph.copy()
-    v, e = shortest_path(kkgraph, [reciever], origin_name=caller)
 
-    for i, j, k in e:
-        k['Type'] = 'Call'
+def hl_discrepancies(graph):
+    """ names of the drop points on more than one / no cable, cached on
+    IndexedGraphs and patched by edit_graph """
+    derived = getattr(graph, 'derived', {})
+    if 'discrepancies' in derived:
+        return derived['discrepancies']
+
+    csr = csr_graph(graph)
+    drops = csr.typed('Drop point')
+    report = {
+        'Duplicates': [graph.nodes[csr.nodes[i]]['Name'] for i in np.flatnonzero(drops & (csr.degree > 1))],
+        'Disconnected': [graph.nodes[csr.nodes[i]]['Name'] for i in np.flatnonzero(drops & (csr.degree < 1))]
+    }
+    derived['discrepancies'] = report
+    return report
+
+
+def rollups(graph):
+    """ for every typed node, by Name: its parent, its children against
+    its capacity, how many nodes of each type its subtree holds and the
+    ECC and PS values found there. One pass up the hierarchy, level by
+    level, cached on IndexedGraphs until the graph changes """
+    derived = getattr(graph, 'derived', {})
+    if 'rollups' in derived:
+        return derived['rollups']
+
+    h = hierarchy(graph)
+    levels = sorted(type_levels, key=type_levels.get)
+    nodes = [n for ntype in levels for n in nodes_typed(graph, ntype)]
+    data = [graph.nodes[n] for n in nodes]
+    names = [d['Name'] if d['Name'] is not None else f'{n[0]},{n[1]}' for n, d in zip(nodes, data)]
+    index = {n: i for i, n in enumerate(nodes)}
+    parent = np.array([index.get(h['parent'].get(n), -1) for n in nodes], dtype=np.int64)
+    level = np.array([type_levels[d['Type']] for d in data], dtype=np.int64)
+
+    # one column per type, then per ECC and per PS value
+    values = {key: sorted({str(v) for d in data for v in [_value(d.get(key))] if v is not None})
+              for key in ('ECC', 'PS')}
+    columns = [('Type', t) for t in levels] + [(key, v) for key in values for v in values[key]]
+    column = {c: j for j, c in enumerate(columns)}
+    own = np.zeros((len(nodes), len(columns)), dtype=np.int64)
+    for i, d in enumerate(data):
+        own[i, column['Type', d['Type']]] = 1
+        for key in values:
+            v = _value(d.get(key))
+            if v is not None:
+                own[i, column[key, str(v)]] = 1
+
+    # children are one level below their parent, so adding each level
+    # into the one above, deepest first, sums whole subtrees
+    total = own.copy()
+    for lvl in range(len(levels) - 1, 0, -1):
+        rows = np.flatnonzero((level == lvl) & (parent >= 0))
+        np.add.at(total, parent[rows], total[rows])
+    below = total - own
+    children = np.bincount(parent[parent >= 0], minlength=len(nodes)).tolist()
+
+    report = {}
+    overloaded = []
+    for i, (d, p, counts) in enumerate(zip(data, parent.tolist(), below.tolist())):
+        ntype = d['Type']
+        capacity = capacities.get(ntype)
+        counts = dict(zip(columns, counts))
+        report[names[i]] = {
+            'Type': ntype,
+            'parent': names[p] if p >= 0 else None,
+            'children': children[i],
+            'capacity': capacity,
+            'subtree': {t: counts['Type', t] for t in levels[type_levels[ntype] + 1:]},
+            **{key: {v: counts[key, v] for v in values[key] if counts[key, v]} for key in values}}
+        if capacity is not None and children[i] > capacity:
+            overloaded.append(names[i])
+    result = {'nodes': report, 'overloaded': overloaded, 'capacities': capacities}
+    derived['rollups'] = result
+    return result
+
+
+def _found(items, limit, count=None):
+    return {'count': len(items) if count is None else count, 'items': items[:limit]}
+
+
+def _grouped(labels, ids):
+    """ {label: ids with that label} """
+    ids = ids[np.argsort(labels[ids], kind='stable')]
+    cuts = np.flatnonzero(np.diff(labels[ids])) + 1
+    return {int(labels[group[0]]): group for group in np.split(ids, cuts) if len(group)}
+
+
+def _near_pairs(xy, uv, tolerance, limit, chunk=4096):
+    """ the first limit (a, b) pairs, a < b, of points within tolerance
+    of each other that no uv edge joins, and the count of all of them.
+    The pairs are counted rather than listed, a wide tolerance over a
+    dense network makes millions of them """
+    tree = cKDTree(xy)
+    n = len(xy)
+    # ordered pairs, each point with itself included
+    count = (int(tree.count_neighbors(tree, tolerance)) - n) // 2
+    # a short cable between the two is not a duplicate
+    uv = np.sort(uv[uv[:, 0] != uv[:, 1]], axis=1)
+    short = ((xy[uv[:, 0]] - xy[uv[:, 1]]) ** 2).sum(axis=1) <= tolerance ** 2
+    count -= int(short.sum())
+    linked = set(map(tuple, uv[short].tolist()))
+
+    pairs = []
+    for start in range(0, n, chunk):
+        if len(pairs) >= limit:
+            break
+        near = tree.query_ball_point(xy[start:start + chunk], tolerance, return_sorted=True)
+        for a, bs in enumerate(near, start=start):
+            pairs += [(a, b) for b in bs if b > a and (a, b) not in linked]
+    return pairs[:limit], count
+
+
+def validate(graph, origin='E0', tolerance=0.5, limit=1000):
+    """ every check on the network at once, each as {'count', 'items'}
+    with at most limit items:
+        duplicates / disconnected: drop points on more than one / no cable
+        orphans: typed nodes that reach no node of their parent type
+        cycles: groups of cables that close a loop
+        wrong_level: cables whose Type does not match the nodes they join
+        over_capacity: nodes with more children than capacities allows
+        near_duplicates: unconnected nodes within tolerance metres
+        unreachable: parts of the network not connected to origin, all
+            of them when origin is None
+    Computed on the CSR arrays, no check walks the graph node by node """
+    csr = csr_graph(graph)
+    h = hierarchy(graph)
+    nodes = csr.nodes
+    names = csr.node_column('Name')
+
+    def node_item(i):
+        return {'Name': names[i], 'Type': h['types'][nodes[i]], 'coords': list(nodes[i])}
+
+    found = {key: _found(value, limit) for key, value in hl_discrepancies(graph).items()}
+    found = {'duplicates': found['Duplicates'], 'disconnected': found['Disconnected']}
+
+    orphans = [i for key in untypes for i in np.flatnonzero(csr.typed(key)).tolist()
+               if nodes[i] not in h['parent']]
+    found['orphans'] = _found([node_item(i) for i in orphans[:limit]], limit, len(orphans))
+
+    def sample(ids):
+        # named nodes first
+        ids = ids.tolist()
+        return [node_item(i) for i in ([i for i in ids if names[i] is not None] or ids)[:10]]
+
+    # independent loops of each connected part, shown by the nodes left
+    # after peeling off its tree parts
+    labels = csr.components()
+    parts = np.bincount(labels)
+    loops = np.bincount(labels[csr.uv[:, 0]], minlength=len(parts)) - parts + 1
+    looped = np.flatnonzero(loops > 0)
+    core = csr.two_core()
+    groups = _grouped(labels, np.flatnonzero(core & np.isin(labels, looped[:limit])))
+    found['cycles'] = _found([{'loops': int(loops[label]), 'nodes': sample(groups[label])}
+                              for label in looped[:limit].tolist()], limit, len(looped))
+
+    # cable type against the types of both of its ends, junctions fit any.
+    # Nodes without a type are column -1, which fits nothing
+    codes = {t: i for i, t in enumerate(csr.type_names)}
+    cables = sorted(ctype for _, ctype in untypes.values())
+    fits = np.zeros((len(cables) + 1, len(csr.type_names) + 1), dtype=bool)
+    for child, (parent, ctype) in untypes.items():
+        row = cables.index(ctype)
+        for ntype in (child, parent, 'JUNC'):
+            if ntype in codes:
+                fits[row, codes[ntype]] = True
+    ctypes = csr.edge_column('Type')
+    rows = np.array([cables.index(t) if t in cables else len(cables) for t in ctypes], dtype=np.int64)
+    ends = csr.types[csr.uv]
+    wrong = np.flatnonzero(~fits[rows, ends[:, 0]] | ~fits[rows, ends[:, 1]])
+    found['wrong_level'] = _found([
+        {'Type': ctypes[e], 'ends': [node_item(u) for u in csr.uv[e].tolist()]}
+        for e in wrong[:limit].tolist()], limit, len(wrong))
+
+    r = rollups(graph)
+    found['over_capacity'] = _found([
+        {'Name': name, **{k: r['nodes'][name][k] for k in ('Type', 'children', 'capacity')}}
+        for name in r['overloaded']], limit)
+
+    # degrees scaled to metres around the mean latitude
+    xy = csr.xy * np.radians(1) * EARTH_RADIUS
+    if len(xy):
+        xy[:, 0] *= np.cos(np.radians(csr.xy[:, 1].mean()))
+    pairs, count = _near_pairs(xy, csr.uv, tolerance, limit)
+    found['near_duplicates'] = _found([
+        {'metres': float(np.hypot(*(xy[a] - xy[b]))), 'nodes': [node_item(a), node_item(b)]}
+        for a, b in pairs], limit, count)
+
+    # largest parts first
+    unreachable = np.argsort(-parts, kind='stable')
+    if origin is not None:
+        unreachable = unreachable[unreachable != labels[csr.index(node_named(graph, origin))]]
+    groups = _grouped(labels, np.flatnonzero(np.isin(labels, unreachable[:limit])))
+    found['unreachable'] = _found([{'nodes': int(parts[label]), 'sample': sample(groups[label])}
+                                   for label in unreachable[:limit].tolist()], limit, len(unreachable))
+
+    return {'nodes': len(nodes), 'edges': len(csr.uv), 'checks': found}
+
+
+def e2e(graph, caller, reciever, return_graph=True, weight=None):
+    v, e = shortest_path(graph, [reciever], origin_name=caller, weight=weight)
+    # relabel copies of the path edges, not the graph's own attributes
+    e = [(i, j, {**k, 'Type': 'Call'}) for i, j, k in e]
 
     if return_graph:
-        G = nx.Graph()
+        G = IndexedGraph()
         G.add_nodes_from(v)
         G.add_edges_from(e)
         return G
     return v, e
 
 
-def withinpoly(qgraph, gpoly):
+def node_points(graph):
+    """ nodes, their coordinates as one (n, 2) array and a mask of the
+    typed (non JUNC) ones, cached on IndexedGraphs """
+    derived = getattr(graph, 'derived', {})
+    if 'points' not in derived:
+        nodes = list(graph.nodes)
+        derived['points'] = {
+            'nodes': nodes,
+            'xy': np.array(nodes, dtype=np.float64).reshape(-1, 2),
+            'typed': np.array([d['Type'] != 'JUNC' for _, d in graph.nodes(data=True)], dtype=bool),
+        }
+    return derived['points']
+
+
+def node_tree(graph):
+    """ KD-tree over the node coordinates in local metres """
+    points = node_points(graph)
+    if 'tree' not in points:
+        xy = np.radians(points['xy'])
+        lat0 = xy[:, 1].mean() if len(xy) else 0
+        points['scale'] = EARTH_RADIUS*np.array([np.cos(lat0), 1.0])
+        points['tree'] = cKDTree(xy*points['scale'])
+    return points['tree'], points['scale']
+
+
+def polygons_arg(gpoly):
+    """ one polygon [[x, y], ...] or a list of them """
+    if np.ndim(gpoly[0][0]) == 0:
+        gpoly = [gpoly]
+    return [geometry.Polygon(p) for p in gpoly]
+
+
+def nodes_within(graph, polygons=(), bbox=None, center=None, radius=None):
+    """ mask over node_points(graph) of the nodes inside any of the
+    polygons, the [minx, miny, maxx, maxy] bbox or radius metres of center """
+    points = node_points(graph)
+    xy = points['xy']
+    mask = np.zeros(len(xy), dtype=bool)
+
+    for polygon in polygons:
+        minx, miny, maxx, maxy = polygon.bounds
+        candidates = np.flatnonzero((xy[:, 0] >= minx) & (xy[:, 0] <= maxx) &
+                                    (xy[:, 1] >= miny) & (xy[:, 1] <= maxy))
+        if len(candidates):
+            import geopandas as gpd
+            inside = gpd.GeoSeries(gpd.points_from_xy(
+                xy[candidates, 0], xy[candidates, 1])).within(polygon).to_numpy()
+            mask[candidates[inside]] = True
+
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        mask |= ((xy[:, 0] >= minx) & (xy[:, 0] <= maxx) &
+                 (xy[:, 1] >= miny) & (xy[:, 1] <= maxy))
+
+    if center is not None and radius is not None:
+        tree, scale = node_tree(graph)
+        mask[tree.query_ball_point(np.radians(center)*scale, radius)] = True
+
+    return mask
+
+
+def withinpoly(qgraph, gpoly=None, bbox=None, center=None, radius=None):
     nnames = nx.get_node_attributes(qgraph, 'Name')
-    gpoly = geometry.Polygon(gpoly)
-    nodes = [(n, d) for n, d in qgraph.nodes(
-        data=True) if d['geometry'].within(gpoly)]
-    # edges = [(n1, n2, d) for n1, n2, d in qgraph.edges(data=True)
-    #          if (n1, n2) in qgraph.edges([n for n, _ in nodes])]
-    # edges = unique(edges)
-    # G = nx.Graph()
-    # G.add_nodes_from(nodes)
-    # G.add_edges_from(edges)
-    return [nnames[node] for node,d in nodes if d['Type']!='JUNC']
+    polygons = polygons_arg(gpoly) if gpoly else []
+    mask = nodes_within(qgraph, polygons, bbox=bbox, center=center, radius=radius)
+    points = node_points(qgraph)
+    nodes = points['nodes']
+    return [nnames[nodes[i]] for i in np.flatnonzero(mask & points['typed']).tolist()]
+
+
+# tiles below this zoom show overview_graph
+OVERVIEW_ZOOM = 16
+
+
+def _oriented(coords, start):
+    """ coords running from the end nearest to start """
+    coords = list(coords)
+    first, last = coords[0], coords[-1]
+    if (first[0] - start[0])**2 + (first[1] - start[1])**2 > \
+            (last[0] - start[0])**2 + (last[1] - start[1])**2:
+        coords.reverse()
+    return coords
+
+
+def overview_graph(graph):
+    """ graph for low zoom tiles: drop points hanging off a PLR are folded
+    into the PLR's 'Drops' count, and so are their C4 cables where no other
+    drop point hangs off them. Every chain of junctions between two other
+    nodes is merged into one edge. Cached on IndexedGraphs until the graph
+    changes """
+    derived = getattr(graph, 'derived', {})
+    if 'overview' in derived:
+        return derived['overview']
+
+    h = hierarchy(graph)
+    ntypes = h['types']
+    drops = {}
+    for n in nodes_typed(graph, 'Drop point'):
+        plr = h['parent'].get(n)
+        if plr is not None:
+            drops[plr] = drops.get(plr, 0) + 1
+    cables = nx.Graph([(u, v) for u, v, d in graph.edges(data=True)
+                       if d.get('Type') == untypes['Drop point'][1]])
+    foldable = set()
+    for part in nx.connected_components(cables):
+        if all(ntypes.get(n) in ('JUNC', 'PLR') or n in h['parent'] for n in part):
+            foldable |= part
+    folded = {_edge_key(u, v) for u, v in cables.edges if u in foldable}
+
+    kept = nx.Graph()
+    kept.add_edges_from((u, v, d) for u, v, d in graph.edges(data=True)
+                        if _edge_key(u, v) not in folded)
+
+    def through(n):
+        # a junction joining two cables of the same type
+        if ntypes.get(n) != 'JUNC' or kept.degree(n) != 2:
+            return False
+        a, b = kept[n].values()
+        return a.get('Type') == b.get('Type')
+
+    G = IndexedGraph()
+    for n, d in graph.nodes(data=True):
+        if ntypes.get(n) == 'JUNC' and (n not in kept or through(n)) or \
+                ntypes.get(n) == 'Drop point' and n in h['parent'] and n not in kept:
+            continue
+        G.add_node(n, **d, **({'Drops': drops[n]} if n in drops else {}))
+
+    seen = set()
+    for u in list(G):
+        if u not in kept:
+            continue
+        for v in kept[u]:
+            if _edge_key(u, v) in seen:
+                continue
+            seen.add(_edge_key(u, v))
+            d = kept.edges[u, v]
+            coords = _oriented(d['geometry'].coords if 'geometry' in d else (u, v), u)
+            prev, cur, mark = u, v, 0
+            while through(cur):
+                nxt = next(w for w in kept[cur] if w != prev)
+                seen.add(_edge_key(cur, nxt))
+                e = kept.edges[cur, nxt]
+                mark = len(coords)
+                coords += _oriented(e['geometry'].coords if 'geometry' in e else (cur, nxt), cur)[1:]
+                prev, cur = cur, nxt
+            if prev != u and (cur == u or G.has_edge(u, cur)):
+                # a second chain between the same two nodes keeps its last junction
+                G.add_node(prev, **graph.nodes[prev])
+                G.add_edge(u, prev, Type=d.get('Type'), geometry=geometry.LineString(coords[:mark]))
+                G.add_edge(prev, cur, Type=d.get('Type'), geometry=geometry.LineString(coords[mark - 1:]))
+            else:
+                G.add_edge(u, cur, Type=d.get('Type'), geometry=geometry.LineString(coords))
+    # rings of junctions only have no end to start from
+    for u, v, d in kept.edges(data=True):
+        if _edge_key(u, v) not in seen:
+            G.add_edge(u, v, **d)
+            for n in (u, v):
+                G.nodes[n].update(graph.nodes[n])
+
+    derived['overview'] = G
+    return G
+
+
+def graph_tile(graph, z, x, y):
+    """ GeoJSON nodes and edges of the graph in tile z/x/y. Below
+    OVERVIEW_ZOOM those of overview_graph, edges simplified to the tile's
+    pixel size """
+    overview = z < OVERVIEW_ZOOM
+    source = overview_graph(graph) if overview else graph
+    if 'tiles' not in source.derived:
+        source.derived['tiles'] = TileIndex(csr_graph(source))
+    index = source.derived['tiles']
+    nodes, edges = index.query(*tile_bounds(z, x, y))
+    prefix = 'o' if overview else ''
+    tolerance = pixel_degrees(z)
+
+    node_list = []
+    for i in nodes.tolist():
+        n = index.nodes[i]
+        d = source.nodes[n]
+        if d.get('Type') == 'JUNC':
+            continue
+        feature = {**node_feature(n, d), 'id': f'{prefix}{i}'}
+        if 'Drops' in d:
+            feature['properties']['Drops'] = d['Drops']
+        node_list.append(feature)
+    edge_list = []
+    for i in edges.tolist():
+        u, v = index.edge(i)
+        d = source.edges[u, v]
+        if overview and 'geometry' in d:
+            d = {**d, 'geometry': d['geometry'].simplify(tolerance, preserve_topology=False)}
+        edge_list.append({**edge_feature(u, v, d), 'id': f'{prefix}{i}'})
+    return {'nodes': {'type': 'FeatureCollection', 'features': node_list},
+            'edges': {'type': 'FeatureCollection', 'features': edge_list},
+            'tile': [z, x, y], 'lod': 'overview' if overview else 'detail'}
+
+
+def _xy(value):
+    try:
+        x, y = value
+        return (float(x), float(y))
+    except (TypeError, ValueError):
+        raise InvalidGraph(f'Bad coordinates {value!r}')
+
+
+def node_ref(graph, ref):
+    """ the node named ref, or the one at the [x, y] coordinates ref """
+    if isinstance(ref, str):
+        return node_named(graph, ref)
+    n = _xy(ref)
+    if n not in graph:
+        raise nx.NodeNotFound(f'No node at {list(n)}')
+    return n
+
+
+def _edge_key(u, v):
+    return (u, v) if u <= v else (v, u)
+
+
+class GraphEdit:
+    """ edit ops applied in place to an IndexedGraph. Keeps what changed
+    so the cached hierarchy and discrepancy report can be patched instead
+    of rebuilt, and an undo log to roll back a batch that fails half way """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.undo = []
+        self.touched = set()
+        self.nodes = {'added': set(), 'removed': set()}
+        self.edges = {'added': set(), 'removed': set()}
+        # drop point -> (Name, drop_status) before the edit
+        self.drops = {}
+
+    @staticmethod
+    def _mark(changes, key, added):
+        if added:
+            changes['added'].add(key)
+        elif key in changes['added']:
+            changes['added'].discard(key)
+        else:
+            changes['removed'].add(key)
+
+    def _touch(self, n):
+        if n in self.touched:
+            return
+        self.touched.add(n)
+        d = self.graph.nodes[n]
+        if d.get('Type') == 'Drop point':
+            self.drops[n] = (d.get('Name'), drop_status(self.graph, n))
+
+    def add_node(self, n, attrs):
+        if n in self.graph:
+            raise InvalidGraph(f'There is already a node at {list(n)}')
+        if attrs.get('Name') is not None and attrs['Name'] in self.graph._names:
+            raise InvalidGraph(f"There is already a node named {attrs['Name']}")
+        self.graph.add_node(n, **attrs)
+        self.undo.append(lambda: self.graph.remove_node(n))
+        self.touched.add(n)
+        self._mark(self.nodes, n, True)
+
+    def remove_node(self, n):
+        self._touch(n)
+        for v in list(self.graph[n]):
+            self.remove_edge(n, v)
+        attrs = self.graph.nodes[n]
+        self.graph.remove_node(n)
+        self.undo.append(lambda: self.graph.add_node(n, **attrs))
+        self._mark(self.nodes, n, False)
+
+    def add_edge(self, u, v, attrs):
+        if u == v or self.graph.has_edge(u, v):
+            raise InvalidGraph(f'Cannot add an edge between {list(u)} and {list(v)}')
+        self._touch(u)
+        self._touch(v)
+        self.graph.add_edge(u, v, **attrs)
+        self.undo.append(lambda: self.graph.remove_edge(u, v))
+        self._mark(self.edges, _edge_key(u, v), True)
+
+    def remove_edge(self, u, v):
+        if not self.graph.has_edge(u, v):
+            raise nx.NodeNotFound(f'No edge between {list(u)} and {list(v)}')
+        self._touch(u)
+        self._touch(v)
+        attrs = self.graph.edges[u, v]
+        self.graph.remove_edge(u, v)
+        self.undo.append(lambda: self.graph.add_edge(u, v, **attrs))
+        self._mark(self.edges, _edge_key(u, v), False)
+
+    def move_node(self, n, to):
+        """ nodes are keyed by their coordinates, so a move re-creates the
+        node and its edges with the line ends at n moved to `to` """
+        attrs = {**self.graph.nodes[n], 'geometry': geometry.Point(*to)}
+        edges = list(self.graph[n].items())
+        self.remove_node(n)
+        self.add_node(to, attrs)
+        for v, d in edges:
+            coords = list(d['geometry'].coords)
+            if coords[0] == n:
+                coords[0] = to
+            else:
+                coords[-1] = to
+            line = geometry.LineString(coords)
+            self.add_edge(to, v, {**d, 'geometry': line, 'mm_len': line.length})
+
+    def apply(self, op):
+        kind = op.get('op') if isinstance(op, dict) else None
+        if kind == 'add_node':
+            ntype = op.get('Type', 'JUNC')
+            if ntype != 'JUNC' and ntype not in type_levels:
+                raise InvalidGraph(f'Unknown node Type {ntype}')
+            n = _xy(op.get('coords'))
+            self.add_node(n, {'Type': ntype, 'Name': op.get('Name'), 'ECC': op.get('ECC'),
+                              'PS': op.get('PS'), 'geometry': geometry.Point(*n)})
+        elif kind == 'move_node':
+            self.move_node(node_ref(self.graph, op.get('node')), _xy(op.get('to')))
+        elif kind == 'remove_node':
+            self.remove_node(node_ref(self.graph, op.get('node')))
+        elif kind == 'add_edge':
+            u, v = node_ref(self.graph, op.get('from')), node_ref(self.graph, op.get('to'))
+            line = geometry.LineString([u] + [_xy(c) for c in op.get('coordinates', [])] + [v])
+            self.add_edge(u, v, {'Type': op.get('Type'), 'geometry': line, 'mm_len': line.length})
+        elif kind == 'remove_edge':
+            self.remove_edge(node_ref(self.graph, op.get('from')), node_ref(self.graph, op.get('to')))
+        else:
+            raise InvalidGraph(f'Unknown edit op {op!r}')
+
+    def rollback(self):
+        while self.undo:
+            self.undo.pop()()
+
+
+def _junctions_from(graph, starts, ntypes, region):
+    """ add to region the neighbours of starts and every node reachable
+    from them through junctions """
+    frontier = list(starts)
+    while frontier:
+        u = frontier.pop()
+        for v in graph[u]:
+            if v not in region:
+                region.add(v)
+                if ntypes[v] == 'JUNC':
+                    frontier.append(v)
+
+
+def patch_hierarchy(graph, h, touched, removed):
+    """ bring hierarchy h up to date after nodes / edges around touched
+    changed and the removed nodes went away. Only the junction runs next to
+    the change are searched again: a child's parent depends on nothing but
+    the junction runs it sits on and the parents around those. Returns the
+    {child: (old parent, new parent)} links that changed """
+    ntypes, parent, children = h['types'], h['parent'], h['children']
+    changed = {}
+    for n in removed:
+        ntypes.pop(n, None)
+        for pred in h['pred'].values():
+            pred.pop(n, None)
+        p = parent.pop(n, None)
+        if p is not None:
+            children[p].remove(n)
+            changed[n] = (p, None)
+        for c in children.pop(n, []):
+            parent.pop(c)
+            changed[c] = (n, None)
+    touched = [n for n in touched if n in graph]
+    for n in touched:
+        ntypes[n] = graph.nodes[n]['Type']
+
+    # the junction runs around the change, whose children may move ...
+    region = set(touched)
+    _junctions_from(graph, touched, ntypes, region)
+    retry = {n for n in region if ntypes[n] != 'JUNC'} | \
+        {c for c, (_, p) in changed.items() if c in graph and p is None}
+    # ... and every other run those children touch, with its parents
+    _junctions_from(graph, retry, ntypes, region)
+
+    for key, (mtype, _) in untypes.items():
+        # sources in the graph's node order, as hierarchy() seeds its BFS,
+        # so equally far parents are chosen the same way
+        masters = [n for n in nodes_typed(graph, mtype) if n in region]
+        owner, rpred = nearest_typed(graph, masters, ntypes, within=region)
+        pred = h['pred'][key]
+        for c in retry:
+            if ntypes[c] != key:
+                continue
+            old, new = parent.get(c), owner.get(c)
+            if old == new:
+                continue
+            if old is not None:
+                children[old].remove(c)
+            if new is not None:
+                parent[c] = new
+                children.setdefault(new, []).append(c)
+            else:
+                del parent[c]
+            changed[c] = (changed.get(c, (old,))[0], new)
+        for v in region:
+            vtype = ntypes[v]
+            if vtype in ('JUNC', mtype) or (vtype == key and v in retry):
+                if v in rpred:
+                    pred[v] = rpred[v]
+                else:
+                    pred.pop(v, None)
+    return {c: link for c, link in changed.items() if link[0] != link[1]}
+
+
+def edit_copy(graph):
+    """ graph.fork() with graph's hierarchy and discrepancy report, which
+    edit_graph patches, copied along """
+    G = graph.fork()
+    h = graph.derived.get('hierarchy')
+    if h is not None:
+        G.derived['hierarchy'] = {
+            'parent': dict(h['parent']),
+            'children': {p: list(cs) for p, cs in h['children'].items()},
+            'pred': {key: dict(pred) for key, pred in h['pred'].items()},
+            'types': dict(h['types'])}
+    report = graph.derived.get('discrepancies')
+    if report is not None:
+        G.derived['discrepancies'] = {status: list(names) for status, names in report.items()}
+    return G
+
+
+def edit_graph(graph, ops):
+    """ apply the edit ops to graph in place, all or none of them, and
+    return what changed: nodes and edges, parent links of the reduced
+    graph and hl_discrepancies entries. The graph's cached hierarchy and
+    discrepancy report are patched rather than dropped """
+    h = hierarchy(graph)
+    report = graph.derived.get('discrepancies')
+    edit = GraphEdit(graph)
+    try:
+        for op in ops:
+            edit.apply(op)
+    except Exception:
+        edit.rollback()
+        graph.derived['hierarchy'] = h
+        if report is not None:
+            graph.derived['discrepancies'] = report
+        raise
+
+    links = patch_hierarchy(graph, h, edit.touched, edit.nodes['removed'])
+    graph.derived['hierarchy'] = h
+
+    names = {'Duplicates': {'added': [], 'removed': []},
+             'Disconnected': {'added': [], 'removed': []}}
+    after = {n: (graph.nodes[n]['Name'], drop_status(graph, n)) for n in edit.touched
+             if n in graph and graph.nodes[n]['Type'] == 'Drop point'}
+    for n in set(edit.drops) | set(after):
+        before, now = edit.drops.get(n, (None, None)), after.get(n, (None, None))
+        if before == now:
+            continue
+        if before[1] is not None:
+            names[before[1]]['removed'].append(before[0])
+        if now[1] is not None:
+            names[now[1]]['added'].append(now[0])
+    if report is not None:
+        for status, change in names.items():
+            for name in change['removed']:
+                report[status].remove(name)
+            report[status].extend(change['added'])
+        graph.derived['discrepancies'] = report
+
+    reduced = {'added': [], 'removed': []}
+    for c, (old, new) in links.items():
+        if old is not None:
+            reduced['removed'].append([list(old), list(c)])
+        if new is not None:
+            reduced['added'].append(edge_feature(new, c, {'Type': untypes[h['types'][c]][1]}))
+
+    return {
+        'nodes': {'added': [node_feature(n, graph.nodes[n]) for n in edit.nodes['added']],
+                  'removed': [list(n) for n in edit.nodes['removed']]},
+        'edges': {'added': [edge_feature(u, v, graph.edges[u, v]) for u, v in edit.edges['added']],
+                  'removed': [[list(u), list(v)] for u, v in edit.edges['removed']]},
+        'reduced': reduced,
+        'discrepancies': names,
+    }
 
 
 app = Flask(__name__)
 CORS(app)
 
+graph_store = GraphStore(
+    max_bytes=int(os.environ.get('GRAPH_STORE_MAX_MB', 512)) * 2**20,
+    max_items=int(os.environ.get('GRAPH_STORE_MAX_ITEMS', 64)))
+
+result_cache = result_cache_from_env()
+
+
+JOB_KINDS = {
+    'reduce': lambda G, p: reduce(G),
+    'op_cen': lambda G, p: optimal_centrality(
+        max_attachments=p.get('max_attachments'), relocate=p.get('relocate', 'PLR'),
+        ngraph=G, method=p.get('method', 'kmeans')),
+    'reverse_reduction': lambda G, p: reverse_partial_reduction(
+        G, p['origin'], return_graph=True, routing=p.get('routing', 'hops')),
+    'circuits': lambda G, p: circuits(
+        G, p['origin'], p.get('from_type', 'Drop point'), upto=p.get('upto'), return_graph=True),
+    'sh_pth': lambda G, p: shortest_path(
+        G, p['destinations'], p.get('origin', 'E0'), return_graph=True, weight=p.get('weight')),
+    'e2e': lambda G, p: e2e(G, p['caller'], p['reciever'], return_graph=True, weight=p.get('weight')),
+    'validate': lambda G, p: validate(G, p.get('origin', 'E0'), p.get('tolerance', 0.5), p.get('limit', 1000)),
+}
+
+
+# kinds whose result over the whole network is the results over its shards
+SHARDED_KINDS = ('reduce', 'op_cen', 'validate')
+SHARD_WORKERS = int(os.environ.get('SHARD_WORKERS', 0)) or os.cpu_count() or 1
+# kinds run on the joined results of another kind over the shards. op_cen
+# takes the reduced graph and sizes its clusters on the whole network
+SHARD_STAGES = {'op_cen': 'reduce'}
+
+
+def _run_shard(kind, params, shard):
+    """ the job on one shard in a worker of run_sharded, encoded as job
+    results are. validate's origin defaults to the shard's Exchange """
+    G = network_shards.load(shard['id'])
+    exchanges = shard['exchanges']
+    return results._encode(JOB_KINDS[kind](G, {'origin': exchanges[0] if exchanges else None, **params}))
+
+
+def run_sharded(kind, params):
+    """ the job on each of params['shards'], SHARD_WORKERS at a time. A
+    worker process loads one shard and exits after it, under the memory
+    limit of the job, so no worker ever holds more than a shard. Graph
+    results are joined into one graph, others go out as
+    {'shards': {name: result}}. The SHARD_STAGES kinds run in the job
+    process on the joined graph """
+    todo = params['shards']
+    rest = {k: v for k, v in params.items() if k != 'shards'}
+    if kind in SHARD_STAGES:
+        return JOB_KINDS[kind](run_sharded(SHARD_STAGES[kind], params), rest)
+    # the job's own SIGTERM handler is not for its workers
+    with multiprocessing.get_context('fork').Pool(
+            max(1, min(SHARD_WORKERS, len(todo))), maxtasksperchild=1,
+            initializer=signal.signal, initargs=(signal.SIGTERM, signal.SIG_DFL)) as pool:
+        encoded = pool.map(functools.partial(_run_shard, kind, rest), todo, chunksize=1)
+    values = [results._decode(*value) for value in encoded]
+    if values and all(isinstance(value, nx.Graph) for value in values):
+        G = IndexedGraph()
+        for value in values:
+            G.add_nodes_from(value.nodes(data=True))
+            G.add_edges_from(value.edges(data=True))
+        G.graph['shards'] = [shard['name'] for shard in todo]
+        return G
+    return {'shards': {shard['name']: value for shard, value in zip(todo, values)}}
+
+
+def run_job(kind, params, graph):
+    """ graph None runs the job on the network's shards """
+    if graph is None:
+        return run_sharded(kind, params)
+    return JOB_KINDS[kind](graph, params)
+
+
+job_queue = jobs.job_queue_from_env(run_job)
+
+
+def shard_entry(jdata):
+    """ the shards() entry of {'shard': name}, or of the shard holding the
+    node of {'shard_of': name} """
+    network = shards()
+    if 'shard' in jdata:
+        name, missing = jdata['shard'], f"Unknown shard {jdata['shard']}"
+    else:
+        name, missing = network.locate(jdata['shard_of']), f"No shard holds {jdata['shard_of']}"
+    entry = network.shards().get(name)
+    if entry is None:
+        abort(404, description=missing)
+    return entry
+
+
+def is_shard(jdata):
+    return 'shard' in jdata or 'shard_of' in jdata
+
+
+def graph_id(jdata):
+    if is_shard(jdata):
+        return shard_entry(jdata)['id']
+    return jdata['graph_id'] if 'graph_id' in jdata else content_hash(jdata)
+
+
+def load_graph(jdata, gid=None):
+    """ jdata is either a graph {'nodes':{}, 'edges':{}}, {'graph_id': id}
+    of a graph previously uploaded or returned by one of the endpoints, or
+    one shard of the network: {'shard': name} or {'shard_of': node name}.
+    Only that shard is read, and only when the store does not hold it. gid
+    is graph_id(jdata) when the caller has it already """
+    if gid is None:
+        gid = graph_id(jdata)
+    G = graph_store.get(gid)
+    if G is None:
+        if is_shard(jdata):
+            with stage('read'):
+                G = network_shards.load(gid)
+        elif 'graph_id' in jdata:
+            # graphs that endpoints answered with go by their result key,
+            # another worker may hold them in the shared result cache
+            G, _ = result_cache.get(gid)
+            if not isinstance(G, nx.Graph):
+                abort(404, description=f"Unknown graph_id {gid}")
+        else:
+            G = json_to_graph(jdata)
+        graph_store.put(gid, G)
+    metrics.graph_size(G, 'in')
+    return G
+
+
+def memoized(gdata, params, compute):
+    """ compute(graph of gdata), or the result_cache entry of this endpoint
+    for the same graph and params. The graph is only loaded on a miss. The
+    key is the request's result_key, graph_response's id for the result """
+    gid = graph_id(gdata)
+    key = result_key(gid, request.endpoint, params)
+    value, tier = result_cache.get(key)
+    if value is None:
+        G = load_graph(gdata, gid)
+        with stage('algorithm'):
+            value = compute(G)
+        result_cache.put(key, value)
+    g.result_cache = tier or 'miss'
+    g.result_key = key
+    return value
+
+
+GRAPH_ARRAYS = 'application/vnd.softel.graph-arrays'
+
+
+def wants_arrays():
+    return request.accept_mimetypes.best_match(['application/json', GRAPH_ARRAYS]) == GRAPH_ARRAYS
+
+
+def wants_gzip():
+    return 'gzip' in request.accept_encodings
+
+
+def graph_response(graph, extra=None, gid=None):
+    """ the graph as GeoJSON streamed straight from the serializer (gzip
+    when accepted), or in the graph_cache columnar layout for clients
+    sending Accept: GRAPH_ARRAYS. It goes into the store under gid, by
+    default the result_key of a memoized request, else a new id, which
+    goes out in X-Graph-Id """
+    metrics.graph_size(graph, 'out')
+    if gid is None:
+        gid = g.get('result_key') or uuid.uuid4().hex
+    graph_store.put(gid, graph)
+    if wants_arrays():
+        with stage('serialize'):
+            body = graph_cache.graph_bytes(graph, meta=extra)
+        return Response(body, mimetype=GRAPH_ARRAYS, headers={'X-Graph-Id': gid, 'Vary': 'Accept'})
+
+    chunks = metrics.streamed(iter_graph_json(graph, extra=extra), 'serialize')
+    headers = {'X-Graph-Id': gid, 'Vary': 'Accept, Accept-Encoding'}
+    if wants_gzip():
+        headers['Content-Encoding'] = 'gzip'
+        chunks = gzip_chunks(chunks)
+    return Response(chunks, mimetype='application/json', headers=headers)
+
 
 @app.after_request
 def add_header(response):
     response.headers['Access-Control-Allow-Origin'] = '*'
-    response.headers['Access-Control-Allow-Headers'] = 'Access-Control-Allow-Origin, X-Requested-With, Content-Type, Accept'
+    response.headers['Access-Control-Allow-Headers'] = 'Access-Control-Allow-Origin, X-Requested-With, Content-Type, Accept, If-None-Match'
+    response.headers['Access-Control-Expose-Headers'] = 'X-Graph-Id, X-Result-Cache, ETag, Server-Timing'
+    response.headers['Timing-Allow-Origin'] = '*'
+    if 'result_cache' in g:
+        response.headers['X-Result-Cache'] = g.result_cache
+    return response
+
+
+@app.before_request
+def start_timers():
+    g.started = time.perf_counter()
+    # ?profile=1 answers with the request's cProfile stats instead, when
+    # the server runs with PROFILE_REQUESTS set
+    if request.args.get('profile') and os.environ.get('PROFILE_REQUESTS'):
+        g.profile = cProfile.Profile()
+        g.profile.enable()
+    if request.is_json:
+        # parsed once here, the views get the cached body
+        with stage('decode'):
+            request.get_json(silent=True)
+
+
+@app.after_request
+def record_timings(response):
+    total = time.perf_counter() - g.started
+    metrics.request_seconds.observe(total, route=metrics.route(),
+                                    method=request.method, status=response.status_code)
+    timing = metrics.server_timing(total)
+    if 'profile' in g:
+        g.profile.disable()
+        out = io.StringIO()
+        stats = pstats.Stats(g.profile, stream=out).sort_stats(request.args.get('sort', 'cumulative'))
+        stats.print_stats(request.args.get('limit', 60, type=int))
+        response = Response(out.getvalue(), mimetype='text/plain')
+    response.headers['Server-Timing'] = timing
     return response
 
 
+@app.errorhandler(InvalidGraph)
+def invalid_graph(e):
+    return {'error': str(e)}, 400
+
+
+@app.errorhandler(FileNotFoundError)
+def data_missing(e):
+    return {'error': str(e)}, 503
+
+
+@app.errorhandler(nx.NodeNotFound)
+@app.errorhandler(nx.NetworkXNoPath)
+def node_not_found(e):
+    return {'error': str(e)}, 404
+
+
+def weight_arg():
+    """ ?weight=hops (default) or ?weight=length to route on metres of cable """
+    weight = request.args.get('weight', 'hops')
+    if weight not in ('hops', 'length'):
+        abort(400, description=f'Unknown weight {weight}')
+    return None if weight == 'hops' else 'length'
+
+
 @app.route("/")
 @app.route("/home")
 @app.route("/index")
@@ -570,75 +1986,331 @@ def index():
     return "API Working"
 
 
+@app.route("/api/graph/session", methods=['POST'])
+def upload_graph():
+    jdata = request.get_json()
+    gid = content_hash(jdata)
+    if gid not in graph_store:
+        graph_store.put(gid, json_to_graph(jdata))
+    G = graph_store.get(gid)
+    return {'graph_id': gid, 'nodes': G.number_of_nodes(), 'edges': G.number_of_edges()}
+
+
+@app.route("/api/graph/session/<string:gid>", methods=['GET'])
+def download_graph(gid):
+    return graph_response(load_graph({'graph_id': gid}), gid=gid)
+
+
+@app.route("/api/graph/session/<string:gid>", methods=['DELETE'])
+def drop_graph(gid):
+    if not graph_store.discard(gid):
+        abort(404, description=f"Unknown graph_id {gid}")
+    return {'graph_id': gid}
+
+
+_edit_lock = threading.Lock()
+
+
+@app.route("/api/graph/session/<string:gid>", methods=['PATCH'])
+def edit_session_graph(gid):
+    """ jdata = {'ops': [
+        {'op': 'add_node', 'coords': [x, y], 'Type': 'PLR', 'Name': .., 'ECC': .., 'PS': ..},
+        {'op': 'move_node', 'node': name or [x, y], 'to': [x, y]},
+        {'op': 'remove_node', 'node': name or [x, y]},
+        {'op': 'add_edge', 'from': name or [x, y], 'to': name or [x, y], 'Type': 'C4',
+         'coordinates': [[x, y], ...] between the two},
+        {'op': 'remove_edge', 'from': name or [x, y], 'to': name or [x, y]}]}
+
+    The edit is made on a copy stored under the returned graph_id, gid
+    keeps the graph as it was for the requests reading it meanwhile. The
+    response carries the diff instead of the whole graph """
+    jdata = request.get_json()
+    ops = jdata.get('ops') if isinstance(jdata, dict) else None
+    if not isinstance(ops, list):
+        raise InvalidGraph("'ops' must be a list of edit ops")
+    with _edit_lock:
+        G = edit_copy(load_graph({'graph_id': gid}))
+        with stage('algorithm'):
+            diff = edit_graph(G, ops)
+        new_gid = graph_store.put(content_hash({'graph_id': gid, 'ops': ops}), G)
+    return {'graph_id': new_gid, 'diff': diff}
+
+
+@app.route("/api/graph/session", methods=['GET'])
+def graph_store_stats():
+    return graph_store.stats()
+
+
+@app.route("/api/graph/results", methods=['GET'])
+def result_cache_stats():
+    return result_cache.stats()
+
+
+@app.route("/metrics", methods=['GET'])
+def prometheus_metrics():
+    store, results = graph_store.stats(), result_cache.stats()
+    gauges = {
+        'softel_graph_store_graphs': ('Graphs held in the graph store.', store['graphs']),
+        'softel_graph_store_bytes': ('Approximate bytes of the graphs in the graph store.', store['bytes']),
+        'softel_result_cache_bytes': ('Approximate bytes of the results held in memory.',
+                                      results['memory']['bytes']),
+    }
+    counters = {f'softel_result_cache_{key}_total': (f'Result cache {key.replace("_", " ")}.', results[key])
+                for key in ('memory_hits', 'disk_hits', 'misses')}
+    return Response(metrics.render(gauges, counters), mimetype='text/plain; version=0.0.4')
+
+
+def job_state(job):
+    if job is None:
+        abort(404, description='Unknown job')
+    end = job['finished'] or time.time()
+    return {**job, 'elapsed': end - job['started'] if job['started'] else None}
+
+
+@app.route("/api/jobs/<string:kind>", methods=['POST'])
+def submit_job(kind):
+    """ jdata = {'gdata': {'nodes':{}, 'edges':{}} or {'graph_id': id} or
+                          {'shards': 'all' or [names]},
+                 'params': {..}, 'timeout': seconds, 'max_memory_mb': MB}
+    params are the route / query arguments of the synchronous endpoint,
+    e.g. {'origin': 'E0', 'routing': 'tree'} for reverse_reduction.
+    Over shards, SHARDED_KINDS only, the job runs on each shard in
+    parallel with max_memory_mb the limit of every shard worker """
+    if kind not in JOB_KINDS:
+        abort(404, description=f'Unknown job kind {kind}')
+    jdata = request.get_json()
+    gdata = jdata['gdata']
+    params = jdata.get('params') or {}
+    if 'shards' in gdata:
+        if kind not in SHARDED_KINDS:
+            abort(400, description=f'{kind} jobs do not run over shards')
+        known = shards().shards()
+        names = list(known) if gdata['shards'] == 'all' else gdata['shards']
+        unknown = [name for name in names if name not in known]
+        if unknown:
+            abort(404, description=f'Unknown shards {unknown}')
+        G, params = None, {**params, 'shards': [known[name] for name in names]}
+    else:
+        G = load_graph(gdata)
+    timeout, max_memory = jdata.get('timeout'), jdata.get('max_memory_mb')
+    if any(limit is not None and not (isinstance(limit, (int, float)) and limit > 0)
+           for limit in (timeout, max_memory)):
+        abort(400, description='timeout and max_memory_mb must be positive numbers')
+    job = job_queue.submit(kind, params, G, timeout=timeout,
+                           max_memory=max_memory * 2**20 if max_memory else None)
+    return job_state(job), 202, {'Location': f"/api/jobs/{job['id']}"}
+
+
+@app.route("/api/jobs", methods=['GET'])
+def list_jobs():
+    return {'jobs': [job_state(job) for job in job_queue.registry.list()]}
+
+
+@app.route("/api/jobs/<string:job_id>", methods=['GET'])
+def get_job(job_id):
+    return job_state(job_queue.get(job_id))
+
+
+@app.route("/api/jobs/<string:job_id>/events", methods=['GET'])
+def job_events(job_id):
+    """ server-sent events, one per change of the job state until it ends """
+    job = job_state(job_queue.get(job_id))
+
+    def events(job):
+        last = None
+        while True:
+            state = {k: v for k, v in job.items() if k != 'elapsed'}
+            if state != last:
+                yield f'data: {json.dumps(job)}\n\n'
+                last = state
+            if job['status'] not in jobs.ACTIVE:
+                return
+            time.sleep(0.5)
+            job = job_queue.get(job_id)
+            if job is None:
+                return
+            job = job_state(job)
+
+    return Response(events(job), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
+@app.route("/api/jobs/<string:job_id>/result", methods=['GET'])
+def job_result(job_id):
+    job = job_state(job_queue.get(job_id))
+    if job['status'] != 'done':
+        return {'error': f"Job is {job['status']}", 'job': job}, 409
+    value = jobs.read_result(job_queue.registry, job)
+    if isinstance(value, nx.Graph):
+        return graph_response(value, extra=value.graph or None, gid=f"job-{job['id']}")
+    return value
+
+
+@app.route("/api/jobs/<string:job_id>", methods=['DELETE'])
+def cancel_job(job_id):
+    """ cancels a queued or running job, forgets a finished one """
+    job = job_state(job_queue.registry.get(job_id))
+    if job['status'] in jobs.ACTIVE:
+        return job_state(job_queue.cancel(job_id))
+    job_queue.registry.remove(job_id)
+    return job
+
+
 @app.route("/api/graph/quick_graph", methods=['GET'])
 def run_func1():
-    G = quick_graph()
-    return graph_to_json(G)
+    qg = base_body()
+    graph_store.put(qg['etag'], qg['graph'])
+    if wants_arrays():
+        if 'arrays' not in qg:
+            qg['arrays'] = graph_cache.graph_bytes(qg['graph'])
+        etag, body, mimetype, encoding = f'{qg["etag"]}-arrays', qg['arrays'], GRAPH_ARRAYS, None
+    elif wants_gzip():
+        etag, body, mimetype, encoding = f'{qg["etag"]}-gzip', qg['gzip'], 'application/json', 'gzip'
+    else:
+        etag, body, mimetype, encoding = qg['etag'], qg['body'], 'application/json', None
+    headers = {'ETag': f'"{etag}"', 'X-Graph-Id': qg['etag'],
+               'Cache-Control': 'no-cache', 'Vary': 'Accept, Accept-Encoding'}
+    if encoding is not None:
+        headers['Content-Encoding'] = encoding
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    return Response(body, mimetype=mimetype, headers=headers)
+
+
+@app.route("/api/graph/shards", methods=['GET'])
+def list_shards():
+    """ the network's per Exchange shards, only the one holding node
+    ?node= if given. Response format {
+        'shards': {name: {'name', 'id', 'nodes', 'edges', 'exchanges',
+                          'bbox': [minx, miny, maxx, maxy]}}
+    }. {'shard': name} stands for a shard wherever a gdata goes """
+    node = request.args.get('node')
+    if node is not None:
+        entry = shard_entry({'shard_of': node})
+        return {'shards': {entry['name']: entry}}
+    return {'shards': shards().shards()}
+
+
+@app.route("/api/graph/shards/<string:name>", methods=['GET'])
+def get_shard(name):
+    return graph_response(load_graph({'shard': name}), gid=shard_entry({'shard': name})['id'])
+
+
+@app.route("/api/graph/tiles/<int:z>/<int:x>/<int:y>", methods=['GET'])
+def graph_tiles(z, x, y):
+    """ the nodes and edges of the quick_graph network, or of the stored
+    ?graph_id=, inside tile z/x/y. Tiles are kept in the result cache """
+    if not valid_tile(z, x, y):
+        abort(404, description=f'No tile {z}/{x}/{y}')
+    gid = request.args.get('graph_id')
+    if gid is None:
+        qg = base()
+        gid = qg['etag']
+        graph_store.put(gid, qg['graph'])
+        # the network behind quick_graph changes with the shapefiles
+        cache_control = 'no-cache'
+    else:
+        # a graph_id always names the same graph
+        cache_control = 'max-age=86400'
+    etag = f'{gid}-{z}-{x}-{y}'
+    headers = {'ETag': f'"{etag}"', 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+    if etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    tile = memoized({'graph_id': gid}, {'z': z, 'x': x, 'y': y}, lambda G: graph_tile(G, z, x, y))
+    with stage('serialize'):
+        body = json.dumps(tile, separators=(',', ':')).encode('utf-8')
+        if wants_gzip():
+            headers['Content-Encoding'] = 'gzip'
+            body = b''.join(gzip_chunks([body]))
+    return Response(body, mimetype='application/json', headers=headers)
 
 
 @app.route("/api/graph/reduce", methods=['POST'])
 def run_func2():
     jdata = request.get_json()
-    G = json_to_graph(jdata)
-    rG = reduce(G)
-    return graph_to_json(rG)
+    rG = memoized(jdata, {}, reduce)
+    return graph_response(rG)
 
 
 @app.route("/api/graph/op_cen/<string:relocate>/<int:max_attachments>", methods=['POST'])
 def run_func3(relocate, max_attachments):
     if max_attachments==10000:
         max_attachments = None
+    method = request.args.get('method', 'kmeans')
+    if method not in ('kmeans', 'minibatch', 'capacity'):
+        abort(400, description=f'Unknown clustering method {method}')
     jdata = request.get_json()
-    rG = json_to_graph(jdata)
-    crG = optimal_centrality(
-        max_attachments=max_attachments, relocate=relocate, ngraph=rG)
-    return graph_to_json(crG)
+    # optimal_centrality edits the graph in place, keep the stored one intact
+    crG = memoized(jdata, {'relocate': relocate, 'max_attachments': max_attachments, 'method': method},
+                   lambda G: optimal_centrality(max_attachments=max_attachments, relocate=relocate,
+                                                ngraph=G.copy(), method=method))
+    return graph_response(crG)
 
 
 @app.route("/api/graph/sh_pth/<string:origin>", methods=['POST'])
 def run_func4(origin):
-    # jdata = {gdata: {'nodes':{}, 'edges':{}}, 'destinations':[]}
+    # jdata = {gdata: {'nodes':{}, 'edges':{}} or {'graph_id': id}, 'destinations':[]}
     jdata = request.get_json()
     gdata = jdata['gdata']
     dest_names = jdata['destinations']
-    G = json_to_graph(gdata)
-    spG = shortest_path(G, dest_names, origin, return_graph=True)
-    return graph_to_json(spG)
+    weight = weight_arg()
+    spG = memoized(gdata, {'origin': origin, 'destinations': dest_names, 'weight': weight},
+                   lambda G: shortest_path(G, dest_names, origin, return_graph=True, weight=weight))
+    return graph_response(spG)
 
 
 @app.route("/api/graph/allcircuits/<string:origin>", methods=['POST'])
 def run_func5(origin):
     jdata = request.get_json()
-    G = json_to_graph(jdata)
-    acG = circuits(G, origin, 'Drop point', upto='E0', return_graph=True)
-    return graph_to_json(acG)
+    acG = memoized(jdata, {'origin': origin},
+                   lambda G: circuits(G, origin, 'Drop point', upto='E0', return_graph=True))
+    return graph_response(acG)
 
 
 @app.route("/api/graph/circuits/<string:origin>/<string:from_type>/<string:upto>", methods=['POST'])
 def run_func6(origin, from_type, upto):
     jdata = request.get_json()
-    G = json_to_graph(jdata)
-    acG = circuits(G, origin, from_type, upto=upto, return_graph=True)
-    return graph_to_json(acG)
+    acG = memoized(jdata, {'origin': origin, 'from_type': from_type, 'upto': upto},
+                   lambda G: circuits(G, origin, from_type, upto=upto, return_graph=True))
+    return graph_response(acG)
+
+
+@app.route("/api/graph/circuits", methods=['POST'])
+def run_func6_bulk():
+    # jdata = {gdata: {'nodes':{}, 'edges':{}} or {'graph_id': id}, 'origins':[],
+    #          'from_type': 'Drop point', 'upto': 'E0' or null}
+    jdata = request.get_json()
+    origins = jdata['origins']
+    from_type = jdata.get('from_type', 'Drop point')
+    upto = jdata.get('upto')
+    return memoized(jdata['gdata'], {'origins': origins, 'from_type': from_type, 'upto': upto},
+                    lambda G: {'circuits': {origin: graph_to_json(circuits(G, origin, from_type, upto=upto,
+                                                                           return_graph=True))
+                                            for origin in origins}})
 
 
 @app.route("/api/graph/reverse_reduction/<string:origin>", methods=['POST'])
 def run_func7(origin):
     jdata = request.get_json()
-    rG = json_to_graph(jdata)
-    rrG = reverse_partial_reduction(rG, origin, return_graph=True)
-    return graph_to_json(rrG)
+    routing = request.args.get('routing', 'hops')
+    if routing not in ('hops', 'tree', 'steiner'):
+        abort(400, description=f'Unknown routing {routing}')
+    rrG = memoized(jdata, {'origin': origin, 'routing': routing},
+                   lambda G: reverse_partial_reduction(G, origin, return_graph=True, routing=routing))
+    return graph_response(rrG, extra={'cable_length': rrG.graph['cable_length']})
 
 
 @app.route("/api/graph/withinpoly", methods=['POST'])
 def run_func8():
-    # jdata = {gdata: {'nodes':{}, 'edges':{}}, 'gpoly':[[],[],[],[]]}
+    # jdata = {gdata: {'nodes':{}, 'edges':{}} or {'graph_id': id}, 'gpoly':[[],[],[],[]] or [[[],[],[]], ...],
+    #          'bbox': [minx, miny, maxx, maxy], 'center': [x, y], 'radius': metres}
     jdata = request.get_json()
     gdata = jdata['gdata']
-    gpoly = jdata['gpoly']
+    gpoly = jdata.get('gpoly')
 
-    G = json_to_graph(gdata)
-    node_names = withinpoly(G, gpoly)
+    G = load_graph(gdata)
+    with stage('algorithm'):
+        node_names = withinpoly(G, gpoly, bbox=jdata.get('bbox'),
+                                center=jdata.get('center'), radius=jdata.get('radius'))
     return {'nnames':node_names}
 
 
@@ -649,16 +2321,47 @@ def run_func9():
         'Disc': [nodes]
     }"""
     jdata = request.get_json()
-    G = json_to_graph(jdata)
-    return hl_discrepancies(G)
+    G = load_graph(jdata)
+    with stage('algorithm'):
+        return hl_discrepancies(G)
+
+
+@app.route("/api/graph/rollups", methods=['POST'])
+def run_rollups():
+    """ response format {
+        'nodes': {name: {'Type', 'parent', 'children', 'capacity',
+                         'subtree': {type: count}, 'ECC': {value: count}, 'PS': {value: count}}},
+        'overloaded': [names of nodes with more children than capacity],
+        'capacities': {type: capacity}
+    }"""
+    jdata = request.get_json()
+    return memoized(jdata, {}, rollups)
+
+
+@app.route("/api/graph/validate", methods=['POST'])
+def run_validate():
+    """ ?origin=E0, ?tolerance= metres for near duplicates (default 0.5),
+    ?limit= items listed per check (default 1000). Response format {
+        'nodes': n, 'edges': n,
+        'checks': {check: {'count': n, 'items': [..]}}
+    }"""
+    origin = request.args.get('origin', 'E0')
+    tolerance = request.args.get('tolerance', 0.5, type=float)
+    limit = request.args.get('limit', 1000, type=int)
+    if not 0 <= tolerance <= 100 or limit < 0:
+        abort(400, description='tolerance must be 0 to 100 metres and limit not negative')
+    jdata = request.get_json()
+    return memoized(jdata, {'origin': origin, 'tolerance': tolerance, 'limit': limit},
+                    lambda G: validate(G, origin, tolerance, limit))
 
 
 @app.route("/api/graph/e2e/<string:caller>/<string:reciever>", methods=['POST'])
 def run_func10(caller, reciever):
     jdata = request.get_json()
-    G = json_to_graph(jdata)
-    eG = e2e(G, caller, reciever, return_graph=True)
-    return graph_to_json(eG)
+    weight = weight_arg()
+    eG = memoized(jdata, {'caller': caller, 'reciever': reciever, 'weight': weight},
+                  lambda G: e2e(G, caller, reciever, return_graph=True, weight=weight))
+    return graph_response(eG)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,327 @@
+""" wall time and peak memory of the graph functions and endpoints, on the
+bundled database/*.shp network and on synthetic ones of the given sizes
+
+    python benchmark.py [--sizes 2000 20000] [--repeat 3] [--json out.json]
+                        [--compare baseline.json] [--tolerance 0.25]
+
+Startup is measured in fresh interpreters: importing app, preloading as
+the gunicorn master does, and a forked worker's first requests with and
+without the preload. Each other case runs in a forked process, its peak is how far that process'
+resident set grew while running it. With --compare the exit status is 1
+when a case got slower than in the baseline by more than the tolerance.
+"""
+import argparse
+import gc
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+
+import networkx as nx
+import numpy as np
+
+import app
+import graph_cache
+import streets
+import synthetic
+from csr import CSRGraph
+from results import ResultCache
+from store import GraphStore
+
+
+def timed(func, *args, repeat=3, **kwargs):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def rss():
+    """ resident set size in bytes, Linux only """
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def built(func, *args):
+    """ func(*args) and how much the resident set grew building it """
+    gc.collect()
+    before = rss()
+    result = func(*args)
+    gc.collect()
+    return result, rss() - before
+
+
+def measure(setup, func, repeat=3):
+    """ {'seconds': best time of func(*setup()) over repeat runs, 'peak_mb'}
+    or {'error': ..., 'peak_mb'}, run in a forked process. setup is not
+    timed, the peak is counted from the resident set after the first one """
+    gc.collect()
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        out = {}
+        try:
+            best = None
+            for i in range(repeat):
+                args = setup()
+                if i == 0:
+                    gc.collect()
+                    # a fork starts with fewer resident pages than its parent
+                    out['base'] = rss()
+                start = time.perf_counter()
+                func(*args)
+                elapsed = time.perf_counter() - start
+                best = elapsed if best is None else min(best, elapsed)
+            out['seconds'] = best
+        except Exception as e:
+            out['error'] = f'{type(e).__name__}: {e}'
+        with os.fdopen(write, 'wb') as f:
+            pickle.dump(out, f)
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read, 'rb') as f:
+        out = pickle.load(f)
+    _, _, usage = os.wait4(pid, 0)
+    # ru_maxrss is in kB on Linux
+    out['peak_mb'] = max(0, usage.ru_maxrss * 1024 - out.pop('base', 0)) / 2**20
+    return out
+
+
+def cold():
+    """ empty graph and result stores, so endpoints parse and compute """
+    app.graph_store = GraphStore(app.graph_store.max_bytes, app.graph_store.max_items)
+    app.result_cache = ResultCache(app.result_cache.memory.max_bytes)
+    return ()
+
+
+def fresh(graph):
+    """ graph without the hierarchy and arrays derived from it """
+    graph.derived.clear()
+    return (graph,)
+
+
+def function_cases(G, points=None, lines=None, plr=None):
+    """ label: (setup, func) of the functions behind the endpoints """
+    rG = app.reduce(G)
+    cases = {}
+    if points is not None:
+        cases['quick_graph'] = (lambda: (points, lines), app.quick_graph)
+    cases.update({
+        'graph_to_json': (lambda: (G,), app.graph_to_json),
+        'reduce': (lambda: fresh(G), app.reduce),
+        'optimal_centrality': (lambda: (rG.copy(),), lambda g: app.optimal_centrality(ngraph=g)),
+        'circuits': (lambda: fresh(G),
+                     lambda g: app.circuits(g, 'E0', 'Drop point', upto='E0', return_graph=True)),
+        'hl_discrepancies': (lambda: fresh(G), app.hl_discrepancies),
+    })
+    if plr is not None:
+        cases['reverse_partial_reduction'] = (
+            lambda: fresh(rG), lambda g: app.reverse_partial_reduction(g, plr, return_graph=True))
+    return cases
+
+
+def endpoint_cases(G, bundled=False, plr=None):
+    """ label: (setup, func) of requests to the endpoints, each with the
+    whole graph in its body and nothing cached """
+    client = app.app.test_client()
+    body = json.dumps(app.graph_to_json(G))
+    rbody = json.dumps(app.graph_to_json(app.reduce(G)))
+
+    def request(method, url, data=None):
+        def send():
+            response = client.open(url, method=method, data=data, content_type='application/json')
+            response.get_data()
+            if response.status_code != 200:
+                raise RuntimeError(f'{method} {url} answered {response.status_code}')
+        return send
+
+    cases = {
+        'POST reduce': request('POST', '/api/graph/reduce', body),
+        'POST op_cen/PLR': request('POST', '/api/graph/op_cen/PLR/10000', rbody),
+        'POST allcircuits/E0': request('POST', '/api/graph/allcircuits/E0', body),
+        'POST hl_discrepancies': request('POST', '/api/graph/hl_discrepancies', body),
+    }
+    if plr is not None:
+        cases['POST reverse_reduction'] = request('POST', f'/api/graph/reverse_reduction/{plr}', rbody)
+    if bundled:
+        cases['GET quick_graph'] = request('GET', '/api/graph/quick_graph')
+    return {label: (cold, func) for label, func in cases.items()}
+
+
+def compare_engines(G, repeat=3):
+    """ the nx graph against its CSRGraph: memory, and the searches behind
+    hierarchy, shortest_path and hl_discrepancies on each """
+    arrays, meta = graph_cache.graph_to_arrays(G)
+    nxG, nx_bytes = built(graph_cache.arrays_to_graph, arrays, meta)
+    # the CSRGraph holds on to the arrays it is built from
+    csr, csr_bytes = built(CSRGraph, arrays, meta)
+    csr_bytes += sum(a.nbytes for a in arrays.values())
+    print(f'  {"engine memory":28} nx {nx_bytes / 2**20:8.1f} MB  csr {csr_bytes / 2**20:8.1f} MB')
+
+    ntypes = nx.get_node_attributes(nxG, 'Type')
+    junctions = csr.typed('JUNC')
+
+    def nx_searches():
+        for mtype, _ in app.untypes.values():
+            app.nearest_typed(nxG, app.nodes_typed(nxG, mtype), ntypes)
+
+    def csr_searches():
+        for mtype, _ in app.untypes.values():
+            csr.bfs(np.flatnonzero(csr.typed(mtype)), through=junctions)
+
+    source = app.node_named(nxG, 'E0')
+    targets = app.nodes_typed(nxG, 'Drop point')
+    s, ts = csr.index(source), [csr.index(t) for t in targets]
+
+    def nx_discrepancies():
+        return [n for n in app.nodes_typed(nxG, 'Drop point') if app.drop_status(nxG, n)]
+
+    def csr_discrepancies():
+        return np.flatnonzero(csr.typed('Drop point') & (csr.degree != 1))
+
+    for label, nx_func, csr_func in [
+            ('hierarchy', nx_searches, csr_searches),
+            ('bfs tree', lambda: app.shortest_path_tree(nxG, source, targets),
+             lambda: csr.bfs([s], targets=ts)),
+            ('length tree', lambda: app.shortest_path_tree(nxG, source, targets, weight='length'),
+             lambda: csr.dijkstra(s)),
+            ('discrepancy', nx_discrepancies, csr_discrepancies)]:
+        t_nx, _ = timed(nx_func, repeat=repeat)
+        t_csr, _ = timed(csr_func, repeat=repeat)
+        print(f'  {"engine " + label:28} nx {t_nx:8.4f}s  csr {t_csr:8.4f}s  x{t_nx / t_csr:.1f}')
+
+
+def run_network(label, G, repeat, points=None, lines=None, plr=None, bundled=False):
+    print(f'{label}: {G.number_of_nodes()} nodes, {G.number_of_edges()} edges')
+    cases = {**function_cases(G, points, lines, plr=plr),
+             **endpoint_cases(G, bundled=bundled, plr=plr)}
+    report = {}
+    for case, (setup, func) in cases.items():
+        out = report[case] = measure(setup, func, repeat=repeat)
+        if 'error' in out:
+            print(f'  {case:28} {out["error"]}')
+        else:
+            print(f'  {case:28} {out["seconds"]:9.4f}s  {out["peak_mb"]:8.1f} MB peak')
+    compare_engines(G, repeat=repeat)
+    return report
+
+
+# run by a fresh interpreter, argv[1] is 'lazy' or 'preload'
+STARTUP = r"""
+import gc, json, os, sys, time
+
+def mb(key):
+    with open('/proc/self/smaps_rollup') as f:
+        fields = {l.split(':')[0]: int(l.split()[1]) for l in f if l.endswith('kB\n')}
+    if key == 'Uss':
+        return (fields['Private_Clean'] + fields['Private_Dirty']) / 1024
+    return fields[key] / 1024
+
+start = time.perf_counter()
+import app
+out = {'import app': {'seconds': time.perf_counter() - start, 'peak_mb': mb('Rss')}}
+if sys.argv[1] == 'preload':
+    start = time.perf_counter()
+    app.preload()
+    gc.freeze()
+    out['preload'] = {'seconds': time.perf_counter() - start, 'peak_mb': mb('Rss')}
+
+read, write = os.pipe()
+if os.fork() == 0:
+    # a gunicorn worker's first requests, memory is what the worker does
+    # not share with the master
+    client = app.app.test_client()
+    start = time.perf_counter()
+    gid = client.get('/api/graph/quick_graph').headers['X-Graph-Id']
+    reduced = client.post('/api/graph/reduce', json={'graph_id': gid})
+    client.post('/api/graph/op_cen/PLR/10000', json={'graph_id': reduced.headers['X-Graph-Id']})
+    first = {'seconds': time.perf_counter() - start, 'peak_mb': mb('Uss')}
+    os.write(write, json.dumps(first).encode())
+    os._exit(0)
+os.close(write)
+out[f'worker first requests ({sys.argv[1]})'] = json.loads(os.read(read, 2**16))
+print(json.dumps(out))
+"""
+
+
+def startup(repeat=3):
+    """ best of repeat fresh interpreter runs of STARTUP, with and without
+    preloading """
+    report = {}
+    for mode in ('lazy', 'preload'):
+        for _ in range(repeat):
+            run = subprocess.run([sys.executable, '-c', STARTUP, mode], capture_output=True,
+                                 text=True, check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+            for case, out in json.loads(run.stdout.splitlines()[-1]).items():
+                if case not in report or out['seconds'] < report[case]['seconds']:
+                    report[case] = out
+    print('startup')
+    for case, out in report.items():
+        print(f'  {case:34} {out["seconds"]:9.4f}s  {out["peak_mb"]:8.1f} MB')
+    return report
+
+
+def regressions(report, baseline, tolerance):
+    """ (network, case, baseline seconds, seconds) of the cases slower than
+    in baseline by more than tolerance """
+    slower = []
+    for network, cases in report.items():
+        for case, out in cases.items():
+            before = baseline.get(network, {}).get(case, {})
+            if 'seconds' in out and 'seconds' in before and \
+                    out['seconds'] > before['seconds'] * (1 + tolerance):
+                slower.append((network, case, before['seconds'], out['seconds']))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the graph functions and endpoints')
+    parser.add_argument('--sizes', type=int, nargs='*', default=[2000, 20000],
+                        help='drop points of each synthetic network')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='results of an earlier --json run to check against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='slowdown allowed before a case counts as a regression')
+    args = parser.parse_args(argv)
+
+    # no answers from results of earlier runs
+    app.result_cache.disk = None
+
+    report = {'startup': startup(args.repeat),
+              'bundled': run_network('bundled', app.quick_graph(), args.repeat, bundled=True)}
+
+    import osmnx as ox
+    with tempfile.TemporaryDirectory() as tmp:
+        for size in args.sizes:
+            points, lines = synthetic.ftth_network(size, seed=args.seed)
+            # reverse_partial_reduction takes its streets from OSM_GRAPHML,
+            # a grid over the synthetic network stands in for OSM
+            streets.OSM_GRAPHML = os.path.join(tmp, f'osm-{size}.graphml')
+            ox.io.save_graphml(synthetic.street_graph(points), filepath=streets.OSM_GRAPHML)
+            label = f'synthetic-{size}'
+            report[label] = run_network(label, app.quick_graph(points, lines), args.repeat,
+                                        points=points, lines=lines, plr='NPLR0')
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.compare:
+        with open(args.compare) as f:
+            slower = regressions(report, json.load(f), args.tolerance)
+        for network, case, before, after in slower:
+            print(f'regression {network} {case}: {before:.4f}s -> {after:.4f}s')
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
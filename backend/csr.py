@@ -0,0 +1,284 @@
+""" compact array form of a network graph for the traversal hot paths:
+integer node ids and CSR adjacency. Attribute columns and edge geometry
+are read on first use, from the graph the arrays were made from or from
+graph_cache arrays, with shapely geometry only made for the nodes and
+edges that go out in a response """
+import weakref
+
+import numpy as np
+import shapely
+from scipy.sparse import csr_matrix
+from shapely import geometry
+
+import graph_cache
+from indexed_graph import IndexedGraph
+
+
+EARTH_RADIUS = 6371008.8
+
+
+def _adjacency(n, uv):
+    """ indptr, neighbours and edge ids of the CSR adjacency, each node's
+    neighbours in the order its edges were added """
+    src = uv.reshape(-1)
+    dst = uv[:, ::-1].reshape(-1)
+    order = np.argsort(src, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(src, minlength=n), out=indptr[1:])
+    return indptr, dst[order].astype(np.int32), (order // 2).astype(np.int32)
+
+
+class _GraphArrays(dict):
+    """ node.xy and edge.uv of a graph, its edge geometry as edge.offsets
+    and edge.coords made on first use """
+
+    def __init__(self, graph, xy, uv):
+        super().__init__({'node.xy': xy, 'edge.uv': uv})
+        # the CSRGraph lives in graph.derived, no reference cycle with it
+        self.graph = weakref.ref(graph)
+
+    def __missing__(self, key):
+        if key not in ('edge.offsets', 'edge.coords'):
+            raise KeyError(key)
+        lines = [line for _, _, line in self.graph().edges(data='geometry')]
+        coords, index = shapely.get_coordinates(lines, return_index=True)
+        offsets = np.zeros(len(lines) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(index, minlength=len(lines)), out=offsets[1:])
+        self.update({'edge.offsets': offsets, 'edge.coords': coords})
+        return self[key]
+
+
+class CSRGraph:
+    """ CSR adjacency over the arrays of graph_cache.graph_to_arrays, or
+    over those of graph when made from_graph """
+
+    def __init__(self, arrays, meta, adjacency=None, nodes=None, graph=None):
+        self.arrays = arrays
+        self.meta = meta
+        self._graph = weakref.ref(graph) if graph is not None else None
+        self.xy = np.asarray(arrays['node.xy'])
+        self.uv = np.asarray(arrays['edge.uv'])
+        self.indptr, self.indices, self.eids = adjacency or _adjacency(len(self.xy), self.uv)
+        self.nodes = nodes if nodes is not None else list(map(tuple, self.xy.tolist()))
+        self._index = None
+        self._ncols = {}
+        self._ecols = {}
+        self._lengths = None
+
+        ntypes = self.node_column('Type')
+        self.type_names = sorted({t for t in ntypes if t is not None})
+        codes = {t: i for i, t in enumerate(self.type_names)}
+        self.types = np.array([codes.get(t, -1) for t in ntypes], dtype=np.int8)
+
+    @classmethod
+    def from_graph(cls, graph):
+        """ the CSRGraph of graph, sharing its nodes and attributes rather
+        than copying them into columns. Edge ids follow graph.edges() and
+        neighbours the graph's own adjacency order, so searches visit them
+        as they would on the nx graph """
+        nodes = list(graph)
+        index = {n: i for i, n in enumerate(nodes)}
+        adjacency = list(graph.adjacency())
+        counts = np.fromiter((len(nbrs) for _, nbrs in adjacency), dtype=np.int64, count=len(nodes))
+        indptr = np.zeros(len(nodes) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        indices = np.fromiter((index[v] for _, nbrs in adjacency for v in nbrs),
+                              dtype=np.int64, count=int(indptr[-1]))
+        src = np.repeat(np.arange(len(nodes), dtype=np.int64), counts)
+
+        # graph.edges() yields an edge from the first of its ends in node
+        # order; the slot at the other end looks its id up by the end pair
+        first = indices >= src
+        uv = np.column_stack([src[first], indices[first]])
+        eids = np.empty(len(indices), dtype=np.int64)
+        eids[first] = np.arange(len(uv))
+        key = np.minimum(src, indices) * len(nodes) + np.maximum(src, indices)
+        order = np.argsort(key[first])
+        eids[~first] = order[np.searchsorted(key[first][order], key[~first])]
+
+        xy = np.array(nodes, dtype=np.float64).reshape(-1, 2)
+        csr = cls(_GraphArrays(graph, xy, uv), {'node_columns': [], 'edge_columns': []},
+                  adjacency=(indptr, indices.astype(np.int32), eids.astype(np.int32)),
+                  nodes=nodes, graph=graph)
+        csr._index = index
+        return csr
+
+    @property
+    def graph(self):
+        """ the graph this was made from_graph, None for arrays """
+        return self._graph() if self._graph is not None else None
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        meta, arrays = graph_cache.load_arrays(path, mmap=mmap)
+        return cls(arrays, meta)
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in self.arrays.values()) + \
+            self.indptr.nbytes + self.indices.nbytes + self.eids.nbytes + self.types.nbytes
+
+    def __len__(self):
+        return len(self.xy)
+
+    def index(self, node):
+        if self._index is None:
+            self._index = {n: i for i, n in enumerate(self.nodes)}
+        return self._index[node]
+
+    def node_column(self, key):
+        """ attribute key of every node, None where a node has none """
+        if key not in self._ncols:
+            if self.graph is not None:
+                self._ncols[key] = [v for _, v in self.graph.nodes(data=key)]
+            else:
+                columns = [c for c in self.meta['node_columns'] if c[0] == key]
+                self._ncols.update(graph_cache._read_columns('node', self.arrays, columns))
+        return self._ncols.get(key, [None] * len(self))
+
+    def edge_column(self, key):
+        """ attribute key of every edge, None where an edge has none """
+        if key not in self._ecols:
+            if self.graph is not None:
+                self._ecols[key] = [v for _, _, v in self.graph.edges(data=key)]
+            else:
+                columns = [c for c in self.meta['edge_columns'] if c[0] == key]
+                self._ecols.update(graph_cache._read_columns('edge', self.arrays, columns))
+        return self._ecols.get(key, [None] * len(self.uv))
+
+    def typed(self, ntype):
+        """ mask of the nodes of type ntype """
+        if ntype not in self.type_names:
+            return np.zeros(len(self), dtype=bool)
+        return self.types == self.type_names.index(ntype)
+
+    @property
+    def degree(self):
+        return np.diff(self.indptr)
+
+    def neighbours(self, nodes):
+        """ (neighbour, node) id pairs of every edge of the nodes, each
+        node's neighbours in adjacency order """
+        starts, ends = self.indptr[nodes], self.indptr[nodes + 1]
+        counts = ends - starts
+        slots = np.repeat(ends - counts.cumsum(), counts) + np.arange(counts.sum())
+        return self.indices[slots], np.repeat(nodes, counts)
+
+    def two_core(self):
+        """ mask of the nodes left after repeatedly removing those with
+        one edge or none: the nodes on cycles and on paths between them """
+        degree = self.degree.copy()
+        alive = np.ones(len(self), dtype=bool)
+        frontier = np.flatnonzero(degree <= 1)
+        while len(frontier):
+            alive[frontier] = False
+            nbrs, _ = self.neighbours(frontier)
+            np.subtract.at(degree, nbrs, 1)
+            nbrs = np.unique(nbrs)
+            frontier = nbrs[alive[nbrs] & (degree[nbrs] <= 1)]
+        return alive
+
+    def components(self):
+        """ connected component label of each node """
+        from scipy.sparse.csgraph import connected_components
+
+        matrix = csr_matrix((np.ones(len(self.indices), dtype=np.int8), self.indices, self.indptr),
+                            shape=(len(self), len(self)))
+        return connected_components(matrix, directed=False)[1]
+
+    def bfs(self, sources, through=None, targets=None):
+        """ breadth first search from all sources at once, moving on only
+        from sources and through nodes (all nodes when through is None).
+        Visits nodes in the order a node by node BFS does, returns the
+        owning source and the predecessor of each node, -1 if unreached.
+        Stops after the level where every targets node is reached """
+        owner = np.full(len(self), -1, dtype=np.int64)
+        pred = np.full(len(self), -1, dtype=np.int64)
+        claim = np.empty(len(self), dtype=np.int64)
+        frontier = np.asarray(sources, dtype=np.int64)
+        owner[frontier] = frontier
+        remaining = None
+        if targets is not None:
+            remaining = np.zeros(len(self), dtype=bool)
+            remaining[np.asarray(targets, dtype=np.int64)] = True
+            remaining[frontier] = False
+        while len(frontier) and (remaining is None or remaining.any()):
+            nbrs, froms = self.neighbours(frontier)
+            fresh = owner[nbrs] < 0
+            nbrs, froms = nbrs[fresh], froms[fresh]
+            # the first claim on a node wins, as in a sequential BFS. With
+            # repeated indices numpy keeps the last write, so write backwards
+            positions = np.arange(len(nbrs))
+            claim[nbrs[::-1]] = positions[::-1]
+            first = claim[nbrs] == positions
+            nbrs, froms = nbrs[first], froms[first]
+            owner[nbrs] = owner[froms]
+            pred[nbrs] = froms
+            if remaining is not None:
+                remaining[nbrs] = False
+            frontier = nbrs if through is None else nbrs[through[nbrs]]
+        return owner, pred
+
+    def edge_lengths(self):
+        """ metres along each edge's geometry """
+        if self._lengths is None:
+            offsets = np.asarray(self.arrays['edge.offsets'])
+            lon, lat = np.radians(np.asarray(self.arrays['edge.coords'], dtype=np.float64)).T
+            a = np.sin(np.diff(lat)/2)**2 + np.cos(lat[:-1]) * \
+                np.cos(lat[1:])*np.sin(np.diff(lon)/2)**2
+            seg = 2*EARTH_RADIUS*np.arcsin(np.sqrt(a))
+            # segments from one edge's last point to the next edge's first
+            seg[offsets[1:-1] - 1] = 0
+            total = np.concatenate([[0], np.cumsum(seg)])
+            self._lengths = total[offsets[1:] - 1] - total[offsets[:-1]]
+        return self._lengths
+
+    def dijkstra(self, source):
+        """ predecessors on the shortest paths by edge length from source """
+        from scipy.sparse.csgraph import dijkstra
+
+        weights = self.edge_lengths()[self.eids]
+        matrix = csr_matrix((weights, self.indices, self.indptr), shape=(len(self), len(self)))
+        _, pred = dijkstra(matrix, indices=source, return_predecessors=True)
+        return np.where(pred < 0, -1, pred).astype(np.int64)
+
+    def edge_id(self, u, v):
+        slots = np.arange(self.indptr[u], self.indptr[u + 1])
+        return int(self.eids[slots[self.indices[slots] == v][0]])
+
+    def node_data(self, i):
+        if self.graph is not None:
+            return dict(self.graph.nodes[self.nodes[i]])
+        d = {key: self.node_column(key)[i] for key, _ in self.meta['node_columns']}
+        d['geometry'] = geometry.Point(*self.nodes[i])
+        return d
+
+    def edge_data(self, e):
+        if self.graph is not None:
+            u, v = self.uv[e]
+            return dict(self.graph.edges[self.nodes[u], self.nodes[v]])
+        offsets = self.arrays['edge.offsets']
+        d = {key: self.edge_column(key)[e] for key, _ in self.meta['edge_columns']}
+        d['geometry'] = geometry.LineString(self.arrays['edge.coords'][offsets[e]:offsets[e + 1]])
+        return d
+
+    def to_graph(self, nodes=None, edges=None):
+        """ IndexedGraph of the node ids and (u, v) id pairs, all of them
+        by default, with attributes and geometry made for those only """
+        if nodes is None:
+            nodes = range(len(self))
+        if edges is None:
+            edges = self.uv.tolist()
+        G = IndexedGraph()
+        G.add_nodes_from((self.nodes[i], self.node_data(i)) for i in nodes)
+        G.add_edges_from((self.nodes[u], self.nodes[v], self.edge_data(self.edge_id(u, v)))
+                         for u, v in edges)
+        return G
+
+
+def csr_graph(graph):
+    """ the CSRGraph of graph, cached on IndexedGraphs until they change """
+    derived = getattr(graph, 'derived', {})
+    if 'csr' not in derived:
+        derived['csr'] = CSRGraph.from_graph(graph)
+    return derived['csr']
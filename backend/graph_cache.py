@@ -0,0 +1,228 @@
+from contextlib import contextmanager
+from io import BytesIO
+import gc
+import json
+import os
+
+import numpy as np
+import shapely
+
+from indexed_graph import IndexedGraph
+
+
+MAGIC = b'SGRAPH01'
+ALIGN = 64
+
+
+def _aligned(offset):
+    return (offset + ALIGN - 1) // ALIGN * ALIGN
+
+
+def write_arrays(f, arrays, meta=None):
+    """ write named numpy arrays to f, layout: magic | header length (8 byte
+    little endian) | json header | arrays, each at a 64 byte aligned offset
+    from the end of the header, as listed in the header """
+    arrays = {k: np.ascontiguousarray(v) for k, v in arrays.items()}
+    entries = {}
+    # offsets are relative to the first aligned byte after the header
+    offset = 0
+    for key, arr in arrays.items():
+        entries[key] = {'dtype': arr.dtype.str,
+                        'shape': list(arr.shape), 'offset': offset}
+        offset = _aligned(offset + arr.nbytes)
+    header = json.dumps({'meta': meta or {}, 'arrays': entries}).encode('utf-8')
+    start = _aligned(len(MAGIC) + 8 + len(header))
+
+    f.write(MAGIC)
+    f.write(len(header).to_bytes(8, 'little'))
+    f.write(header)
+    written = len(MAGIC) + 8 + len(header)
+    for key, arr in arrays.items():
+        pad = start + entries[key]['offset'] - written
+        f.write(b'\0' * pad)
+        f.write(arr.tobytes())
+        written += pad + arr.nbytes
+
+
+def save_arrays(path, arrays, meta=None):
+    """ write_arrays into a file that load_arrays can memory map """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        write_arrays(f, arrays, meta=meta)
+    os.replace(tmp, path)
+
+
+def read_meta(path):
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a graph cache file')
+        size = int.from_bytes(f.read(8), 'little')
+        header = json.loads(f.read(size))
+    return header, _aligned(len(MAGIC) + 8 + size)
+
+
+def load_arrays(path, mmap=True):
+    header, start = read_meta(path)
+    arrays = {}
+    for key, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        if int(np.prod(shape)) == 0:
+            arrays[key] = np.empty(shape, dtype=dtype)
+        elif mmap:
+            arrays[key] = np.memmap(path, dtype=dtype, mode='r',
+                                    offset=start + entry['offset'], shape=shape)
+        else:
+            with open(path, 'rb') as f:
+                f.seek(start + entry['offset'])
+                arrays[key] = np.fromfile(
+                    f, dtype=dtype, count=int(np.prod(shape))).reshape(shape)
+    return header['meta'], arrays
+
+
+def read_arrays(data):
+    """ load_arrays of a write_arrays buffer held in memory """
+    if data[:len(MAGIC)] != MAGIC:
+        raise ValueError('not a graph cache buffer')
+    size = int.from_bytes(data[len(MAGIC):len(MAGIC) + 8], 'little')
+    header = json.loads(data[len(MAGIC) + 8:len(MAGIC) + 8 + size])
+    start = _aligned(len(MAGIC) + 8 + size)
+    arrays = {}
+    for key, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        count = int(np.prod(shape))
+        if count == 0:
+            arrays[key] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[key] = np.frombuffer(data, dtype=dtype, count=count,
+                                        offset=start + entry['offset']).reshape(shape)
+    return header['meta'], arrays
+
+
+def _isnull(v):
+    return v is None or (isinstance(v, float) and np.isnan(v))
+
+
+def _isint(v):
+    return isinstance(v, (int, np.integer)) and not isinstance(v, (bool, np.bool_))
+
+
+def _column(values):
+    """ (kind, values, nulls) of a column: 'i' int64 if every value is an
+    integer, 'f' float64 if every value is a number, else 's' strings, with
+    the None values in the null mask. Numeric columns keep NaN as NaN, in
+    string columns NaN is null (fixed width arrays hold no None) """
+    present = [v for v in values if v is not None]
+    if all(_isint(v) and -2**63 <= v < 2**63 for v in present):
+        kind, dtype, blank = 'i', np.int64, 0
+    elif all(isinstance(v, (int, float, np.number)) and not isinstance(v, (bool, np.bool_))
+             for v in present):
+        kind, dtype, blank = 'f', np.float64, np.nan
+    else:
+        nulls = np.array([_isnull(v) for v in values], dtype=bool)
+        strs = np.array(['' if _isnull(v) else str(v) for v in values], dtype=np.str_)
+        return 's', strs, nulls
+    nulls = np.array([v is None for v in values], dtype=bool)
+    return kind, np.array([blank if v is None else v for v in values], dtype=dtype), nulls
+
+
+def _write_columns(prefix, records, keys, arrays, columns):
+    for key in keys:
+        kind, values, nulls = _column([r.get(key) for r in records])
+        arrays[f'{prefix}.{key}'] = values
+        arrays[f'{prefix}.{key}.null'] = nulls
+        columns.append([key, kind])
+
+
+def _read_columns(prefix, arrays, columns):
+    out = {}
+    for key, kind in columns:
+        values = arrays[f'{prefix}.{key}'].tolist()
+        # files from before numeric columns had a null mask have none
+        nulls = arrays.get(f'{prefix}.{key}.null')
+        if nulls is not None:
+            values = [None if null else v for v, null in zip(values, nulls.tolist())]
+        out[key] = values
+    return out
+
+
+def graph_to_arrays(graph):
+    nodes = list(graph.nodes)
+    index = {n: i for i, n in enumerate(nodes)}
+    arrays = {'node.xy': np.array(nodes, dtype=np.float64).reshape(-1, 2)}
+    node_columns, edge_columns = [], []
+
+    node_data = [d for _, d in graph.nodes(data=True)]
+    node_keys = sorted({k for d in node_data for k in d if k != 'geometry'})
+    _write_columns('node', node_data, node_keys, arrays, node_columns)
+
+    edges = list(graph.edges(data=True))
+    arrays['edge.uv'] = np.array([(index[u], index[v]) for u, v, _ in edges],
+                                 dtype=np.int64).reshape(-1, 2)
+    coords = [np.asarray(d['geometry'].coords, dtype=np.float64)
+              for _, _, d in edges]
+    arrays['edge.offsets'] = np.cumsum(
+        [0] + [len(c) for c in coords], dtype=np.int64)
+    arrays['edge.coords'] = (np.concatenate(coords) if coords
+                             else np.empty((0, 2), dtype=np.float64))
+    edge_data = [d for _, _, d in edges]
+    edge_keys = sorted({k for d in edge_data for k in d if k != 'geometry'})
+    _write_columns('edge', edge_data, edge_keys, arrays, edge_columns)
+
+    return arrays, {'node_columns': node_columns, 'edge_columns': edge_columns}
+
+
+@contextmanager
+def _gc_paused():
+    """ no cyclic garbage collection in the block: making millions of
+    attribute dicts otherwise sets off full collections again and again """
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def arrays_to_graph(arrays, meta):
+    """ IndexedGraph of the arrays, built in bulk with the geometry made by
+    one vectorized shapely call for the nodes and one for the edges """
+    with _gc_paused():
+        xy = np.asarray(arrays['node.xy'])
+        nodes = list(map(tuple, xy.tolist()))
+        ncols = _read_columns('node', arrays, meta['node_columns'])
+        rows = zip(*ncols.values()) if ncols else [()] * len(nodes)
+        points = shapely.points(xy).tolist() if len(nodes) else []
+        node_items = [(n, dict(zip(ncols, row), geometry=p)) for n, row, p in zip(nodes, rows, points)]
+
+        uv = np.asarray(arrays['edge.uv'])
+        ecols = _read_columns('edge', arrays, meta['edge_columns'])
+        rows = zip(*ecols.values()) if ecols else [()] * len(uv)
+        offsets = np.asarray(arrays['edge.offsets'])
+        lines = shapely.linestrings(np.asarray(arrays['edge.coords']),
+                                    indices=np.repeat(np.arange(len(uv)), np.diff(offsets))).tolist() \
+            if len(uv) else []
+        return IndexedGraph.from_items(
+            node_items, ((nodes[u], nodes[v], dict(zip(ecols, row), geometry=line))
+                         for (u, v), row, line in zip(uv.tolist(), rows, lines)))
+
+
+def graph_bytes(graph, meta=None):
+    """ the save_graph file contents, as served to clients asking for the
+    columnar format """
+    arrays, columns = graph_to_arrays(graph)
+    f = BytesIO()
+    write_arrays(f, arrays, meta={**(meta or {}), **columns})
+    return f.getvalue()
+
+
+def save_graph(path, graph, meta=None):
+    arrays, columns = graph_to_arrays(graph)
+    save_arrays(path, arrays, meta={**(meta or {}), **columns})
+
+
+def load_graph(path, mmap=True):
+    meta, arrays = load_arrays(path, mmap=mmap)
+    return arrays_to_graph(arrays, meta), meta
@@ -0,0 +1,23 @@
+""" gunicorn settings, read from the working directory: the app, the
+libraries it imports lazily and the base graph are loaded once in the
+master and shared copy-on-write with the workers """
+import gc
+import os
+
+# workers default to WEB_CONCURRENCY, the port to PORT
+preload_app = True
+# threaded workers, a job's event stream holds one thread of a worker
+# rather than the whole of it for as long as the job runs
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+# seconds a worker may go silent before the arbiter restarts it. The
+# worker's main thread keeps checking in while requests run on the others
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+
+
+def when_ready(server):
+    import app
+    app.preload()
+    # leave everything loaded so far out of the workers' garbage
+    # collections, whose bookkeeping writes would copy the shared pages
+    gc.freeze()
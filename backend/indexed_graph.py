@@ -0,0 +1,145 @@
+import networkx as nx
+
+
+class IndexedGraph(nx.Graph):
+    """ nx.Graph keeping Name -> nodes and Type -> nodes indexes in step
+    with node additions and removals. Attributes edited in place through
+    G.nodes[n] are not seen, call reindex() after doing so.
+
+    `derived` holds artifacts computed from the graph (e.g. its hierarchy)
+    and is emptied on every change to nodes or edges. """
+
+    def __init__(self, incoming_graph_data=None, **attr):
+        self._names = {}
+        self._types = {}
+        self._keys = {}
+        self.derived = {}
+        super().__init__(incoming_graph_data, **attr)
+        if incoming_graph_data is not None:
+            # conversion from other graphs fills _node without add_node
+            self.reindex()
+
+    def _unindex(self, n):
+        self.derived.clear()
+        if n not in self._keys:
+            return
+        name, ntype = self._keys.pop(n)
+        if name is not None:
+            self._names[name].remove(n)
+            if not self._names[name]:
+                del self._names[name]
+        if ntype is not None:
+            del self._types[ntype][n]
+
+    def _index(self, n):
+        self.derived.clear()
+        self._unindex(n)
+        d = self._node[n]
+        name, ntype = d.get('Name'), d.get('Type')
+        if name is not None:
+            self._names.setdefault(name, []).append(n)
+        if ntype is not None:
+            self._types.setdefault(ntype, {})[n] = None
+        self._keys[n] = (name, ntype)
+
+    def add_node(self, node_for_adding, **attr):
+        super().add_node(node_for_adding, **attr)
+        self._index(node_for_adding)
+
+    def add_nodes_from(self, nodes_for_adding, **attr):
+        nodes_for_adding = list(nodes_for_adding)
+        super().add_nodes_from(nodes_for_adding, **attr)
+        for n in nodes_for_adding:
+            try:
+                if n not in self._node:
+                    n = n[0]
+            except TypeError:
+                n = n[0]
+            self._index(n)
+
+    def remove_node(self, n):
+        self._unindex(n)
+        super().remove_node(n)
+
+    def remove_nodes_from(self, nodes):
+        nodes = list(nodes)
+        for n in nodes:
+            self._unindex(n)
+        super().remove_nodes_from(nodes)
+
+    def add_edge(self, u_of_edge, v_of_edge, **attr):
+        self.derived.clear()
+        super().add_edge(u_of_edge, v_of_edge, **attr)
+
+    def add_edges_from(self, ebunch_to_add, **attr):
+        self.derived.clear()
+        super().add_edges_from(ebunch_to_add, **attr)
+
+    def remove_edge(self, u, v):
+        self.derived.clear()
+        super().remove_edge(u, v)
+
+    def remove_edges_from(self, ebunch):
+        self.derived.clear()
+        super().remove_edges_from(ebunch)
+
+    def clear(self):
+        super().clear()
+        self.derived.clear()
+        self._names.clear()
+        self._types.clear()
+        self._keys.clear()
+
+    @classmethod
+    def from_items(cls, nodes, edges):
+        """ graph of (node, attribute dict) and (u, v, attribute dict) items
+        with distinct nodes and edges, e.g. read from a graph_cache file.
+        The dicts are kept as they are, without add_node's per item work """
+        G = cls()
+        for n, d in nodes:
+            G._node[n] = d
+            G._adj[n] = {}
+        adj = G._adj
+        for u, v, d in edges:
+            adj[u][v] = adj[v][u] = d
+        G.reindex()
+        return G
+
+    def fork(self):
+        """ copy whose node and edge attribute dicts are this graph's own,
+        for edits that replace attribute dicts and never change one """
+        G = self.__class__()
+        G.graph.update(self.graph)
+        G._node.update(self._node)
+        G._adj.update((n, dict(nbrs)) for n, nbrs in self._adj.items())
+        G._names.update((name, list(nodes)) for name, nodes in self._names.items())
+        G._types.update((ntype, dict(nodes)) for ntype, nodes in self._types.items())
+        G._keys.update(self._keys)
+        return G
+
+    def reindex(self, nodes=None):
+        for n in self._node if nodes is None else nodes:
+            self._index(n)
+
+    def node_named(self, name):
+        if name not in self._names:
+            raise nx.NodeNotFound(f'No node named {name}')
+        return self._names[name][0]
+
+    def nodes_typed(self, ntype):
+        return list(self._types.get(ntype, ()))
+
+
+def node_named(graph, name):
+    if isinstance(graph, IndexedGraph):
+        return graph.node_named(name)
+    for n, d in graph.nodes(data=True):
+        if d.get('Name') == name:
+            return n
+    raise nx.NodeNotFound(f'No node named {name}')
+
+
+def nodes_typed(graph, ntype):
+    if isinstance(graph, IndexedGraph):
+        return graph.nodes_typed(ntype)
+    return [n for n, d in graph.nodes(data=True) if d.get('Type') == ntype]
@@ -0,0 +1,323 @@
+""" background analysis jobs, each run in its own process with a time and
+memory limit. Job state lives in a registry every gunicorn worker can read
+(JSON files in a directory, or Redis when JOB_REDIS_URL is set) so any of
+them can answer for a job; inputs and results are files in that directory """
+import json
+import multiprocessing
+import os
+import resource
+import signal
+import socket
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+import fcntl
+
+import graph_cache
+import results
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+
+ACTIVE = ('queued', 'running')
+
+
+class JobTimeout(Exception):
+    pass
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class JobRegistry:
+    """ job states as <id>.json files in directory, next to each job's
+    <id>.graph input and <id>.result output """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, job_id, ext):
+        return os.path.join(self.directory, f'{job_id}.{ext}')
+
+    @contextmanager
+    def locked(self):
+        with open(os.path.join(self.directory, '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def get(self, job_id):
+        try:
+            with open(self.path(job_id, 'json')) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def put(self, job):
+        tmp = self.path(f"{job['id']}.{os.getpid()}", 'tmp')
+        with open(tmp, 'w') as f:
+            json.dump(job, f)
+        os.replace(tmp, self.path(job['id'], 'json'))
+
+    def remove(self, job_id):
+        for ext in ('json', 'graph', 'result'):
+            try:
+                os.remove(self.path(job_id, ext))
+            except FileNotFoundError:
+                pass
+
+    def list(self):
+        jobs = (self.get(name[:-5]) for name in os.listdir(self.directory)
+                if name.endswith('.json'))
+        return [job for job in jobs if job is not None]
+
+
+class RedisJobRegistry(JobRegistry):
+    """ JobRegistry keeping the job states in Redis (or anything speaking
+    its protocol), the input and result files stay in directory """
+
+    def __init__(self, directory, url):
+        super().__init__(directory)
+        self.url = url
+        self.redis = redis.Redis.from_url(url)
+
+    def __getstate__(self):
+        # a job process opens a connection of its own
+        return {'directory': self.directory, 'url': self.url}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @contextmanager
+    def locked(self):
+        with self.redis.lock('jobs:lock', timeout=60):
+            yield
+
+    def get(self, job_id):
+        data = self.redis.hget('jobs', job_id)
+        return json.loads(data) if data is not None else None
+
+    def put(self, job):
+        self.redis.hset('jobs', job['id'], json.dumps(job))
+
+    def remove(self, job_id):
+        self.redis.hdel('jobs', job_id)
+        super().remove(job_id)
+
+    def list(self):
+        return [json.loads(data) for data in self.redis.hvals('jobs')]
+
+
+def update_job(registry, job_id, **changes):
+    """ the job with changes applied, None if it is gone. Terminal states
+    are final """
+    with registry.locked():
+        job = registry.get(job_id)
+        if job is None or job['status'] not in ACTIVE:
+            return job
+        job.update(changes)
+        registry.put(job)
+        return job
+
+
+class JobQueue:
+    """ runs at most max_running jobs at a time, each in a process of its
+    own. runner(kind, params, graph) does the work in that process, graph
+    is None for jobs submitted without one. runner must be a module level
+    function, the job processes import its module """
+
+    def __init__(self, registry, runner, max_running=None, max_seconds=600, max_memory=2**31,
+                 keep_seconds=86400):
+        self.registry = registry
+        self.runner = runner
+        self.max_running = max_running or os.cpu_count() or 1
+        self.max_seconds = max_seconds
+        self.max_memory = max_memory
+        self.keep_seconds = keep_seconds
+        self.host = socket.gethostname()
+        # job processes fork from a server process holding the runner's
+        # module imported, not from a request thread with its sockets,
+        # locks and connections
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload([runner.__module__])
+
+    def update(self, job_id, **changes):
+        return update_job(self.registry, job_id, **changes)
+
+    def submit(self, kind, params, graph, timeout=None, max_memory=None):
+        job = {'id': uuid.uuid4().hex, 'kind': kind, 'params': params, 'status': 'queued',
+               'stage': 'queued', 'created': time.time(), 'started': None, 'finished': None,
+               'host': None, 'pid': None, 'error': None, 'result': None,
+               'timeout': min(timeout or self.max_seconds, self.max_seconds),
+               'max_memory': min(max_memory or self.max_memory, self.max_memory)}
+        if job['timeout'] <= 0 or job['max_memory'] <= 0:
+            raise ValueError('timeout and max_memory must be positive')
+        if graph is not None:
+            graph_cache.save_graph(self.registry.path(job['id'], 'graph'), graph)
+        with self.registry.locked():
+            self.registry.put(job)
+        self.dispatch()
+        return job
+
+    def get(self, job_id):
+        self.dispatch()
+        return self.registry.get(job_id)
+
+    def cancel(self, job_id):
+        with self.registry.locked():
+            job = self.registry.get(job_id)
+            if job is None or job['status'] not in ACTIVE:
+                return job
+            if job['pid'] is not None and job['host'] == self.host:
+                try:
+                    os.kill(job['pid'], signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            job.update(status='cancelled', stage='cancelled', finished=time.time())
+            self.registry.put(job)
+        self.dispatch()
+        return job
+
+    def dispatch(self):
+        """ start queued jobs while there are free slots, fail running ones
+        whose process is gone without saying why and forget finished ones
+        after keep_seconds """
+        now = time.time()
+        with self.registry.locked():
+            jobs = self.registry.list()
+            running = []
+            for job in jobs:
+                if job['status'] not in ACTIVE and now - job['finished'] > self.keep_seconds:
+                    self.registry.remove(job['id'])
+                if job['status'] != 'running':
+                    continue
+                # a just started job may not have written its pid yet, and
+                # the pids of jobs on other hosts (Redis registry) mean nothing here
+                if job['pid'] is None and now - job['started'] < 60 or \
+                        job['host'] != self.host and now - job['started'] < job['timeout'] + 60 or \
+                        job['host'] == self.host and job['pid'] is not None and _alive(job['pid']):
+                    running.append(job)
+                else:
+                    job.update(status='failed', stage='failed', finished=now,
+                               error='job process exited unexpectedly')
+                    self.registry.put(job)
+            queued = sorted((job for job in jobs if job['status'] == 'queued'),
+                            key=lambda job: job['created'])
+            starting = queued[:max(0, self.max_running - len(running))]
+            for job in starting:
+                job.update(status='running', stage='starting', started=now, host=self.host)
+                self.registry.put(job)
+        # outside the lock, the job process must not inherit it
+        for job in starting:
+            self._start(job)
+
+    def _start(self, job):
+        process = self.context.Process(target=_run, args=(self.registry, self.runner, job['id']))
+        process.start()
+        self.update(job['id'], pid=process.pid)
+
+        def watch():
+            # reap the process, kill it if it ignored its own time limit
+            process.join(job['timeout'] + 10)
+            if process.is_alive():
+                process.kill()
+                process.join()
+            self.update(job['id'], status='failed', stage='failed', finished=time.time(),
+                        error=f"job process exited with code {process.exitcode}")
+            self.dispatch()
+
+        threading.Thread(target=watch, daemon=True).start()
+
+
+def _limit_memory(budget):
+    # the budget is on top of what the process already maps (the imported app)
+    try:
+        with open('/proc/self/statm') as f:
+            mapped = int(f.read().split()[0]) * resource.getpagesize()
+    except OSError:
+        mapped = 0
+    resource.setrlimit(resource.RLIMIT_AS, (mapped + budget, mapped + budget))
+
+
+def _run(registry, runner, job_id):
+    """ body of the job process """
+    def timeout(signum, frame):
+        raise JobTimeout()
+
+    def cancelled(signum, frame):
+        raise JobCancelled()
+
+    job = update_job(registry, job_id, pid=os.getpid())
+    if job is None or job['status'] != 'running':
+        return
+    signal.signal(signal.SIGTERM, cancelled)
+    signal.signal(signal.SIGALRM, timeout)
+    signal.setitimer(signal.ITIMER_REAL, job['timeout'])
+    kind = None
+    try:
+        _limit_memory(job['max_memory'])
+        update_job(registry, job_id, stage='loading')
+        path = registry.path(job_id, 'graph')
+        graph = graph_cache.load_graph(path, mmap=False)[0] if os.path.isfile(path) else None
+        update_job(registry, job_id, stage='running')
+        value = runner(job['kind'], job['params'], graph)
+        update_job(registry, job_id, stage='saving')
+        kind, body = results._encode(value)
+        with open(registry.path(job_id, 'result'), 'wb') as f:
+            f.write(body)
+        status, error = 'done', None
+    except JobTimeout:
+        status, error = 'failed', f"time limit of {job['timeout']}s exceeded"
+    except MemoryError:
+        status, error = 'failed', f"memory limit of {job['max_memory'] // 2**20} MB exceeded"
+    except JobCancelled:
+        return
+    except Exception as e:
+        status, error = 'failed', f'{type(e).__name__}: {e}'
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    update_job(registry, job_id, status=status, stage=status, error=error,
+               result=kind, finished=time.time())
+
+
+def read_result(registry, job):
+    """ the value a finished job returned """
+    with open(registry.path(job['id'], 'result'), 'rb') as f:
+        return results._decode(job['result'], f.read())
+
+
+def job_queue_from_env(runner):
+    """ jobs under JOB_DIR (default database/jobs), state in Redis when
+    JOB_REDIS_URL is set. JOB_WORKERS processes at a time (default one
+    per CPU), each limited to JOB_MAX_SECONDS (default 600) and
+    JOB_MAX_MEMORY_MB (default 2048). Finished jobs are kept for
+    JOB_KEEP_SECONDS (default a day) """
+    directory = os.environ.get('JOB_DIR', 'database/jobs')
+    url = os.environ.get('JOB_REDIS_URL')
+    if url and redis is None:
+        raise RuntimeError('JOB_REDIS_URL is set but the redis package is not installed')
+    registry = RedisJobRegistry(directory, url) if url else JobRegistry(directory)
+    workers = os.environ.get('JOB_WORKERS')
+    return JobQueue(registry, runner, max_running=int(workers) if workers else None,
+                    max_seconds=int(os.environ.get('JOB_MAX_SECONDS', 600)),
+                    max_memory=int(os.environ.get('JOB_MAX_MEMORY_MB', 2048)) * 2**20,
+                    keep_seconds=int(os.environ.get('JOB_KEEP_SECONDS', 86400)))
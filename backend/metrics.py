@@ -0,0 +1,138 @@
+""" request latency, per stage timings and graph sizes as Prometheus
+histograms, kept per process """
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context, request
+
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = (10, 100, 1000, 10**4, 10**5, 10**6, 10**7)
+
+
+def _labels(names, values):
+    pairs = ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                     for k, v in zip(names, values))
+    return '{' + pairs + '}' if pairs else ''
+
+
+class Histogram:
+    """ cumulative bucket counts, sum and count per label values """
+
+    def __init__(self, name, help, labels, buckets):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(k, '') for k in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][i] += 1
+            series[1] += value
+
+    def lines(self):
+        yield f'# HELP {self.name} {self.help}'
+        yield f'# TYPE {self.name} histogram'
+        with self._lock:
+            series = [(key, list(counts), total) for key, (counts, total) in self._series.items()]
+        for key, counts, total in sorted(series):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                labels = _labels(self.labels + ('le',), key + (bound,))
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labels, key)} {total}'
+            yield f'{self.name}_count{_labels(self.labels, key)} {cumulative}'
+
+
+request_seconds = Histogram(
+    'softel_request_seconds', 'Time from the start of a request to its response.',
+    ('route', 'method', 'status'), LATENCY_BUCKETS)
+stage_seconds = Histogram(
+    'softel_stage_seconds', 'Time spent in each stage of a request: decode, parse, '
+    'read, join, algorithm, serialize.', ('route', 'stage'), LATENCY_BUCKETS)
+graph_nodes = Histogram(
+    'softel_graph_nodes', 'Nodes of the graphs requests take (in) and answer with (out).',
+    ('route', 'side'), SIZE_BUCKETS)
+graph_edges = Histogram(
+    'softel_graph_edges', 'Edges of the graphs requests take (in) and answer with (out).',
+    ('route', 'side'), SIZE_BUCKETS)
+
+HISTOGRAMS = (request_seconds, stage_seconds, graph_nodes, graph_edges)
+
+
+def route():
+    """ URL rule of the current request, 'none' outside of requests """
+    if not has_request_context():
+        return 'none'
+    return request.url_rule.rule if request.url_rule is not None else 'unknown'
+
+
+@contextmanager
+def stage(name):
+    """ time the block as stage name of the current request, also outside
+    of requests (route 'none') """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, route=route(), stage=name)
+        if has_request_context():
+            stages = g.setdefault('stages', {})
+            stages[name] = stages.get(name, 0.0) + elapsed
+
+
+def streamed(chunks, name):
+    """ chunks, the time spent making them timed as stage name of the
+    current request. They are made while the response streams out, after
+    its Server-Timing, so the stage only shows in the histogram """
+    rule = route()
+
+    def timed(chunks):
+        elapsed = 0.0
+        try:
+            while True:
+                start = time.perf_counter()
+                try:
+                    chunk = next(chunks)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - start
+                yield chunk
+        finally:
+            stage_seconds.observe(elapsed, route=rule, stage=name)
+    return timed(iter(chunks))
+
+
+def graph_size(graph, side):
+    rule = route()
+    graph_nodes.observe(graph.number_of_nodes(), route=rule, side=side)
+    graph_edges.observe(graph.number_of_edges(), route=rule, side=side)
+
+
+def server_timing(total):
+    """ Server-Timing header value of the current request's stages """
+    stages = g.get('stages', {})
+    return ', '.join([f'{name};dur={seconds * 1000:.1f}' for name, seconds in stages.items()] +
+                     [f'total;dur={total * 1000:.1f}'])
+
+
+def render(gauges=None, counters=None):
+    """ all histograms, and the {name: (help, value)} gauges and counters,
+    in the Prometheus text exposition format """
+    lines = [line for histogram in HISTOGRAMS for line in histogram.lines()]
+    for kind, samples in (('gauge', gauges), ('counter', counters)):
+        for name, (help, value) in (samples or {}).items():
+            lines += [f'# HELP {name} {help}', f'# TYPE {name} {kind}', f'{name} {value}']
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,136 @@
+""" memoized endpoint results, keyed by the content hash of the input graph,
+the endpoint and its parameters. An in-process LRU backed, optionally, by
+a SQLite file every gunicorn worker on the host shares """
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import networkx as nx
+
+import graph_cache
+from store import GraphStore, content_hash, graph_size
+
+
+def result_key(gid, endpoint, params):
+    return content_hash([gid, endpoint, params])
+
+
+def _encode(value):
+    if isinstance(value, nx.Graph):
+        return 'graph', graph_cache.graph_bytes(value, meta={'graph': value.graph})
+    return 'json', json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def _decode(kind, body):
+    if kind == 'graph':
+        meta, arrays = graph_cache.read_arrays(body)
+        G = graph_cache.arrays_to_graph(arrays, meta)
+        G.graph.update(meta.get('graph', {}))
+        return G
+    return json.loads(body)
+
+
+def _size(value):
+    if isinstance(value, nx.Graph):
+        return graph_size(value)
+    return len(json.dumps(value, separators=(',', ':')))
+
+
+class DiskResults:
+    """ results table in a SQLite file, trimmed to max_bytes oldest use
+    first """
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        with self._db() as db:
+            db.execute('create table if not exists results (key text primary key, kind text, '
+                       'body blob, size integer, used real)')
+            db.execute('create index if not exists results_used on results (used)')
+
+    def _db(self):
+        # a connection must not cross a fork (gunicorn preload_app)
+        pid, db = getattr(self._local, 'db', (None, None))
+        if pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('pragma journal_mode=wal')
+            self._local.db = (os.getpid(), db)
+        return db
+
+    def get(self, key):
+        with self._db() as db:
+            row = db.execute('select kind, body from results where key = ?', (key,)).fetchone()
+            if row is not None:
+                db.execute('update results set used = ? where key = ?', (time.time(), key))
+        return row
+
+    def put(self, key, kind, body):
+        with self._db() as db:
+            db.execute('insert or replace into results values (?, ?, ?, ?, ?)',
+                       (key, kind, body, len(body), time.time()))
+            total = db.execute('select coalesce(sum(size), 0) from results').fetchone()[0]
+            if total > self.max_bytes:
+                # drop the least recently used rows past the cap, newest kept
+                db.execute('delete from results where key in (select key from '
+                           '(select key, sum(size) over (order by used desc) as total '
+                           'from results) where total > ? and key != ?)', (self.max_bytes, key))
+
+    def stats(self):
+        with self._db() as db:
+            items, nbytes = db.execute(
+                'select count(*), coalesce(sum(size), 0) from results').fetchone()
+        return {'path': self.path, 'results': items, 'bytes': nbytes, 'max_bytes': self.max_bytes}
+
+
+class ResultCache:
+    """ memory LRU of result objects in front of an optional DiskResults """
+
+    def __init__(self, max_bytes, disk=None):
+        self.memory = GraphStore(max_bytes)
+        self.disk = disk
+        self.counts = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, key):
+        with self._lock:
+            self.counts[key] += 1
+
+    def get(self, key):
+        """ (value, 'memory' | 'disk'), or (None, None) on a miss """
+        value = self.memory.get(key)
+        if value is not None:
+            self._count('memory_hits')
+            return value, 'memory'
+        if self.disk is not None:
+            row = self.disk.get(key)
+            if row is not None:
+                value = _decode(*row)
+                self.memory.put(key, value, size=_size(value))
+                self._count('disk_hits')
+                return value, 'disk'
+        self._count('misses')
+        return None, None
+
+    def put(self, key, value):
+        self.memory.put(key, value, size=_size(value))
+        if self.disk is not None:
+            self.disk.put(key, *_encode(value))
+        return value
+
+    def stats(self):
+        stats = {**self.counts, 'memory': self.memory.stats()}
+        if self.disk is not None:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+def result_cache_from_env():
+    """ RESULT_CACHE_MAX_MB (default 256) of results in memory, and a disk
+    tier at RESULT_CACHE_DB capped at RESULT_CACHE_DB_MAX_MB (default 1024)
+    when that is set """
+    path = os.environ.get('RESULT_CACHE_DB')
+    disk = DiskResults(path, int(os.environ.get('RESULT_CACHE_DB_MAX_MB', 1024)) * 2**20) if path else None
+    return ResultCache(int(os.environ.get('RESULT_CACHE_MAX_MB', 256)) * 2**20, disk=disk)
@@ -0,0 +1,136 @@
+""" the network split into per Exchange shards, the connected component
+under each Exchange node, each a graph_cache file of its own named by its
+content hash. An index of node names to shards tells which one a request
+touches without loading any of them """
+import hashlib
+import os
+
+import numpy as np
+
+import graph_cache
+from csr import csr_graph
+from indexed_graph import IndexedGraph
+
+
+INDEX = 'index.cache'
+# the shard of the components holding no Exchange node
+UNASSIGNED = 'unassigned'
+
+
+def shard_nodes(graph):
+    """ {shard name: [nodes]}, each connected component named after its
+    Exchange, the first by name when it holds several. The components
+    without one go together into UNASSIGNED """
+    csr = csr_graph(graph)
+    labels = csr.components()
+    names = csr.node_column('Name')
+    exchanges = np.flatnonzero(csr.typed('Exchange')).tolist()
+    owner = {}
+    for i in sorted(exchanges, key=lambda i: str(names[i])):
+        owner.setdefault(labels[i], str(names[i]))
+    keys = [owner.get(label, UNASSIGNED) for label in range(labels.max() + 1 if len(labels) else 0)]
+
+    order = np.argsort(labels, kind='stable')
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    shards = {}
+    for members in np.split(order, bounds) if len(order) else []:
+        shards.setdefault(keys[labels[members[0]]], []).extend(csr.nodes[i] for i in members.tolist())
+    return shards
+
+
+class ShardSet:
+    """ the shards in directory: INDEX holds the sorted node names with
+    the shard of each as arrays and the shard list as its meta, every
+    shard is <id>.cache with id the sha1 of its bytes """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._index = None
+        self._mtime = None
+
+    def path(self, sid):
+        return os.path.join(self.directory, f'{sid}.cache')
+
+    def index(self):
+        """ (meta, arrays) of INDEX, reread when it changes, None before
+        the first build """
+        path = os.path.join(self.directory, INDEX)
+        try:
+            mtime = os.path.getmtime(path)
+        except FileNotFoundError:
+            return None
+        if mtime != self._mtime:
+            self._index = graph_cache.load_arrays(path)
+            self._mtime = mtime
+        return self._index
+
+    @property
+    def meta(self):
+        index = self.index()
+        return index[0] if index is not None else {}
+
+    def shards(self):
+        """ {name: {'id', 'nodes', 'edges', 'exchanges', 'bbox'}} """
+        return {s['name']: s for s in self.meta.get('shards', [])}
+
+    def locate(self, name):
+        """ name of the shard holding the node named name, None if no
+        node is """
+        index = self.index()
+        if index is None:
+            return None
+        meta, arrays = index
+        names = arrays['name']
+        i = int(np.searchsorted(names, str(name)))
+        if i == len(names) or names[i] != str(name):
+            return None
+        return meta['shards'][int(arrays['shard'][i])]['name']
+
+    def load(self, sid):
+        G, _ = graph_cache.load_graph(self.path(sid))
+        return G
+
+    def build(self, graph, meta=None):
+        """ split graph into shards and write them, then the index over
+        them, then remove the files of an earlier build. Readers of the
+        old index keep finding their shards until it is replaced """
+        os.makedirs(self.directory, exist_ok=True)
+        entries, names, owners = [], [], []
+        for k, (name, nodes) in enumerate(sorted(shard_nodes(graph).items())):
+            # in the graph's own order, searches on a shard visit nodes as
+            # they would on the whole network
+            sub = IndexedGraph()
+            sub.add_nodes_from((n, graph.nodes[n]) for n in nodes)
+            sub.add_edges_from(graph.edges(nodes, data=True))
+            body = graph_cache.graph_bytes(sub)
+            sid = hashlib.sha1(body).hexdigest()
+            if not os.path.isfile(self.path(sid)):
+                tmp = f'{self.path(sid)}.{os.getpid()}.tmp'
+                with open(tmp, 'wb') as f:
+                    f.write(body)
+                os.replace(tmp, self.path(sid))
+            xy = np.array(nodes, dtype=np.float64).reshape(-1, 2)
+            entries.append({'name': name, 'id': sid, 'nodes': sub.number_of_nodes(),
+                            'edges': sub.number_of_edges(),
+                            'exchanges': sorted(str(d['Name']) for _, d in sub.nodes(data=True)
+                                                if d.get('Type') == 'Exchange'),
+                            'bbox': [*xy.min(axis=0).tolist(), *xy.max(axis=0).tolist()]})
+            named = [str(d['Name']) for _, d in sub.nodes(data=True) if d.get('Name') is not None]
+            names += named
+            owners += [k] * len(named)
+
+        # sorted for searchsorted, the first of duplicate names wins
+        names = np.array(names, dtype=np.str_)
+        order = np.argsort(names, kind='stable')
+        graph_cache.save_arrays(os.path.join(self.directory, INDEX),
+                                {'name': names[order],
+                                 'shard': np.array(owners, dtype=np.int32)[order]},
+                                meta={**(meta or {}), 'shards': entries})
+        keep = {f"{e['id']}.cache" for e in entries} | {INDEX}
+        for f in os.listdir(self.directory):
+            if f.endswith('.cache') and f not in keep:
+                try:
+                    os.remove(os.path.join(self.directory, f))
+                except FileNotFoundError:
+                    pass
+        return self.shards()
@@ -0,0 +1,75 @@
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+
+# rough per node / per edge footprint of a graph built by quick_graph
+# (attribute dicts plus shapely geometry), used for the memory cap
+ITEM_BYTES = 1024
+
+
+def content_hash(jdata):
+    payload = json.dumps(jdata, sort_keys=True,
+                         separators=(',', ':')).encode('utf-8')
+    return hashlib.sha1(payload).hexdigest()
+
+
+def graph_size(graph):
+    return (graph.number_of_nodes() + graph.number_of_edges()) * ITEM_BYTES
+
+
+class GraphStore:
+    """In-memory LRU of graphs keyed by the content hash of their JSON."""
+
+    def __init__(self, max_bytes, max_items=None):
+        self.max_bytes = max_bytes
+        self.max_items = max_items
+        self.nbytes = 0
+        self._graphs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._graphs
+
+    def __len__(self):
+        return len(self._graphs)
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._graphs:
+                return None
+            self._graphs.move_to_end(key)
+            return self._graphs[key][0]
+
+    def put(self, key, graph, size=None):
+        if size is None:
+            size = graph_size(graph)
+        with self._lock:
+            if key in self._graphs:
+                self.nbytes -= self._graphs.pop(key)[1]
+            self._graphs[key] = (graph, size)
+            self.nbytes += size
+            self._evict()
+        return key
+
+    def discard(self, key):
+        with self._lock:
+            if key in self._graphs:
+                self.nbytes -= self._graphs.pop(key)[1]
+                return True
+            return False
+
+    def _evict(self):
+        # the most recent graph is always kept, even if it alone exceeds the cap
+        while len(self._graphs) > 1 and (
+                self.nbytes > self.max_bytes or
+                (self.max_items is not None and len(self._graphs) > self.max_items)):
+            _, (_, size) = self._graphs.popitem(last=False)
+            self.nbytes -= size
+
+    def stats(self):
+        with self._lock:
+            return {'graphs': len(self._graphs), 'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes, 'max_items': self.max_items}
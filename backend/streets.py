@@ -0,0 +1,84 @@
+""" street graph used by reverse_partial_reduction, loaded once per process
+
+    python streets.py import <file.osm | file.graphml> [-o database/osm.graphml]
+"""
+import argparse
+import os
+import threading
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+OSM_GRAPHML = 'database/osm.graphml'
+
+_loaded = {}
+_lock = threading.Lock()
+
+
+class StreetGraph:
+    """ osmnx graph with a KD-tree on its node coordinates """
+
+    def __init__(self, graph):
+        self.graph = graph
+        self.ids = list(graph.nodes)
+        xy = np.array([[d['x'], d['y']] for _, d in graph.nodes(data=True)],
+                      dtype=np.float64).reshape(-1, 2)
+        # lon/lat degrees are scaled to equal length around the graph's mean
+        # latitude, close enough to metres for picking the nearest node
+        self.scale = np.array([np.cos(np.radians(xy[:, 1].mean())), 1.0]) if len(xy) else np.ones(2)
+        self.tree = cKDTree(xy * self.scale)
+
+    def nearest_nodes(self, points):
+        """ ids of the street nodes nearest to each (x, y) point """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        if len(points) == 0:
+            return []
+        _, idx = self.tree.query(points * self.scale)
+        return [self.ids[i] for i in idx.tolist()]
+
+
+def street_graph(path=None):
+    """ the StreetGraph of path (OSM_GRAPHML by default), read again only
+    when the file changes, None when there is no such file """
+    path = path or OSM_GRAPHML
+    if not os.path.isfile(path):
+        return None
+    mtime = os.path.getmtime(path)
+    cached = _loaded.get(path)
+    if cached is None or cached[0] != mtime:
+        with _lock:
+            cached = _loaded.get(path)
+            if cached is None or cached[0] != mtime:
+                import osmnx as ox
+                cached = (mtime, StreetGraph(ox.load_graphml(path)))
+                _loaded[path] = cached
+    return cached[1]
+
+
+def import_streets(source, target=OSM_GRAPHML):
+    import osmnx as ox
+
+    if source.endswith('.graphml'):
+        graph = ox.load_graphml(source)
+    else:
+        graph = ox.graph_from_xml(source, simplify=True, retain_all=False)
+    ox.io.save_graphml(graph, filepath=target, gephi=False, encoding='utf-8')
+    return graph
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Build the offline street graph cache')
+    sub = parser.add_subparsers(dest='command', required=True)
+    imp = sub.add_parser('import', help='import a local .osm or .graphml file')
+    imp.add_argument('source')
+    imp.add_argument('-o', '--output', default=OSM_GRAPHML)
+    args = parser.parse_args(argv)
+
+    graph = import_streets(args.source, args.output)
+    print(f'{args.output}: {graph.number_of_nodes()} nodes, {graph.number_of_edges()} edges')
+
+
+if __name__ == "__main__":
+    main()
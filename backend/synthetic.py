@@ -0,0 +1,247 @@
+""" synthetic Exchange -> PRM -> SEC -> PLR -> Drop point networks for
+benchmarking, laid out as database/points.shp and lines.shp are, plus a
+street graph of the same area standing in for OSM
+
+    python synthetic.py <drop points> [-o directory] [--seed 0] [--exchanges 1]
+"""
+import argparse
+import math
+import os
+
+import geopandas as gpd
+import networkx as nx
+import numpy as np
+from scipy.spatial import cKDTree
+from shapely import geometry
+
+
+ORIGIN = (46.68, 24.66)
+# lattice spacing of the cable routes in degrees, about 20 m
+STEP = 2e-4
+EARTH_RADIUS = 6371008.8
+
+# children per parent, at most the capacities optimal_centrality plans for
+# (PRM 2, SEC 4, PLR 60). A PLR splitter serves 32 drop points
+FANOUT = {'PRM': 2, 'SEC': 4, 'PLR': 32}
+# spread of the children around their parent, in lattice steps
+SPREAD = {'PRM': 40, 'SEC': 15, 'PLR': 8, 'Drop point': 5}
+LEVELS = ('Exchange', 'PRM', 'SEC', 'PLR', 'Drop point')
+CABLES = {'PRM': 'C1', 'SEC': 'C2', 'PLR': 'C3', 'Drop point': 'C4'}
+
+
+def _lattice(level):
+    """ lattice point (i, j) of the level as lon / lat, each level's routes
+    on a lattice of their own so cables of different levels never share
+    a junction """
+    offset = level * STEP / 5
+
+    def point(i, j):
+        return (ORIGIN[0] + i * STEP + offset, ORIGIN[1] + j * STEP + offset)
+    return point
+
+
+def _route(child, parent, point):
+    """ vertices from child to parent along the lattice: across, then up """
+    (ci, cj), (pi, pj) = child, parent
+    di = 1 if pi >= ci else -1
+    dj = 1 if pj >= cj else -1
+    cells = [(i, cj) for i in range(ci, pi + di, di)] + \
+        [(pi, j) for j in range(cj + dj, pj + dj, dj)]
+    return [point(i, j) for i, j in cells]
+
+
+def _nearest_home(tree, homes, cells, parent):
+    """ mask of the cells with their parent's home the one nearest along
+    the lattice, and no other as near """
+    nearest, _ = tree.query(cells, p=1)
+    nearest = np.atleast_1d(nearest)
+    return (np.abs(cells - homes[parent]).sum(axis=1) == nearest) & \
+        (tree.query_ball_point(cells, nearest, p=1, return_length=True) == 1)
+
+
+def _place(homes, rivals, cell, p, taken, reach):
+    """ cell for a child of home p: cell or the one nearest to it, by
+    lattice distance, that is not taken and has p for nearest home (the
+    lowest of equally near ones). Every cell of a route from a cell to its
+    nearest home (_route) has that nearest home too, so routes to two
+    homes never meet. rivals are the indices of the homes that can be
+    nearer than p within reach of cell, home p's own cell is the last
+    resort """
+    ci, cj = cell
+    others = homes[rivals]
+    near, far = 0, 1
+    while near <= reach:
+        far = min(far, reach + 1)
+        # rings of cells around cell, a few at a time
+        rings = [cell] if near == 0 else []
+        rings += [c for r in range(max(near, 1), far) for k in range(r)
+                  for c in ((ci + r - k, cj + k), (ci - k, cj + r - k),
+                            (ci - r + k, cj - k), (ci + k, cj - r + k))]
+        rings = [c for c in rings if c not in taken]
+        if rings:
+            d = np.abs(np.array(rings)[:, None, :] - others[None]).sum(axis=2)
+            nearest = rivals[np.argmin(d * len(homes) + rivals, axis=1)]
+            mine = np.flatnonzero(nearest == p)
+            if len(mine):
+                return rings[mine[0]]
+        near, far = far, 2 * far
+    return tuple(homes[p].tolist())
+
+
+def ftth_network(drop_points=2000, seed=0, exchanges=1):
+    """ (points, lines) GeoDataFrames in the layout of database/*.shp with
+    about drop_points drop points, split evenly between exchanges Exchange
+    networks side by side. Parents sit amid their children, every child is
+    cabled to its parent through junctions on a street lattice, siblings
+    share the cable runs where their routes meet. Each child is placed in
+    the cells nearest to its parent, so the routes under one parent never
+    meet those under another and the network is a tree with every child
+    under the parent it was made for """
+    rng = np.random.default_rng(seed)
+    plrs = max(exchanges, math.ceil(drop_points / FANOUT['PLR']))
+    secs = max(exchanges, math.ceil(plrs / FANOUT['SEC']))
+    prms = max(exchanges, math.ceil(secs / FANOUT['PRM']))
+    counts = {'Exchange': exchanges, 'PRM': prms, 'SEC': secs, 'PLR': plrs,
+              'Drop point': drop_points}
+
+    # nodes as integer cells, each level spread around its parents. No
+    # cell of an Exchange's network is further than reach from it, the
+    # exchanges are far enough apart for their networks not to meet
+    prm_spread = SPREAD['PRM'] * math.sqrt(prms / exchanges)
+    reach = math.ceil(prm_spread) + sum(SPREAD[t] for t in LEVELS[2:]) + len(LEVELS)
+    cells = {'Exchange': np.column_stack([np.arange(exchanges) * (2 * reach + 2),
+                                          np.zeros(exchanges)]).astype(np.int64)}
+    parents = {}
+    for level, ltype in enumerate(LEVELS[1:], start=1):
+        above = cells[LEVELS[level - 1]]
+        parent = np.arange(counts[ltype]) * len(above) // counts[ltype]
+        spread = prm_spread if ltype == 'PRM' else SPREAD[ltype]
+        angle = rng.uniform(0, 2 * np.pi, counts[ltype])
+        radius = spread * np.sqrt(rng.uniform(0.1, 1, counts[ltype]))
+        offsets = np.column_stack([np.cos(angle), np.sin(angle)]) * radius[:, None]
+        drawn = above[parent] + np.rint(offsets).astype(np.int64)
+
+        # one child to a cell, in the cells nearest to its parent. Children
+        # drawn nearer to another parent are drawn again closer to theirs,
+        # a few times, then moved to the nearest cell that will do
+        tree = cKDTree(above)
+        mine = _nearest_home(tree, above, drawn, parent)
+        for shrink in (0.7, 0.5, 0.35):
+            redo = np.flatnonzero(~mine)
+            if not len(redo):
+                break
+            angle = rng.uniform(0, 2 * np.pi, len(redo))
+            radius = shrink * spread * np.sqrt(rng.uniform(0, 1, len(redo)))
+            offsets = np.column_stack([np.cos(angle), np.sin(angle)]) * radius[:, None]
+            drawn[redo] = above[parent[redo]] + np.rint(offsets).astype(np.int64)
+            mine[redo] = _nearest_home(tree, above, drawn[redo], parent[redo])
+        reach = 4 * math.ceil(spread) + 4
+        rivals = {}
+        taken = set()
+        placed = []
+        for cell, p, ok in zip(map(tuple, drawn.tolist()), parent.tolist(), mine.tolist()):
+            if not ok or cell in taken:
+                if p not in rivals:
+                    # homes nearer than p to a cell within reach of one
+                    # drawn for p are at most twice that far from p
+                    rivals[p] = np.array(sorted(tree.query_ball_point(
+                        above[p], 2 * (reach + math.ceil(spread) + 1), p=1)))
+                cell = _place(above, rivals[p], cell, p, taken, reach)
+            taken.add(cell)
+            placed.append(cell)
+        cells[ltype] = np.array(placed, dtype=np.int64).reshape(-1, 2)
+        parents[ltype] = parent
+
+    points = []
+    names = {'Exchange': lambda i: f'E{i}', 'PRM': lambda i: f'NPRM{i}', 'SEC': lambda i: f'NSEC{i}',
+             'PLR': lambda i: f'NPLR{i}', 'Drop point': lambda i: str(1000 + i)}
+    coords = {}
+    for level, ltype in enumerate(LEVELS):
+        point = _lattice(level)
+        coords[ltype] = []
+        shared = {}
+        for i, (ci, cj) in enumerate(cells[ltype].tolist()):
+            # half a step off the lattices, away from every cable route.
+            # Drop points sharing a cell spread across it, a node on top of
+            # another one would merge the two. Up to 37 of them stay 0.7 m
+            # apart and 2 m from the routes
+            k = shared[ci, cj] = shared.get((ci, cj), -1) + 1
+            d = (-1) ** k * ((k + 1) // 2) * STEP / 40
+            x, y = point(ci, cj)
+            xy = (x + STEP / 2 + d, y + STEP / 2 - d)
+            coords[ltype].append(xy)
+            points.append({'Type': ltype, 'Name': names[ltype](i),
+                           'ECC': str(rng.integers(0, 5)), 'PS': str(rng.integers(0, 3)),
+                           'geometry': geometry.Point(xy)})
+
+    segments = {}
+    for level, ltype in enumerate(LEVELS[1:], start=1):
+        point = _lattice(level)
+        ptype = LEVELS[level - 1]
+        for i, p in enumerate(parents[ltype].tolist()):
+            route = _route(tuple(cells[ltype][i]), tuple(cells[ptype][p]), point)
+            route = [coords[ltype][i]] + route + [coords[ptype][p]]
+            route = list(dict.fromkeys(route))
+            for a, b in zip(route[:-1], route[1:]):
+                segments.setdefault(frozenset((a, b)), (a, b, CABLES[ltype]))
+
+    lines = [{'Type': t, 'geometry': geometry.LineString([a, b])} for a, b, t in segments.values()]
+    return (gpd.GeoDataFrame(points, geometry='geometry', crs='EPSG:4326'),
+            gpd.GeoDataFrame(lines, geometry='geometry', crs='EPSG:4326'))
+
+
+def street_graph(points, spacing=2 * STEP, reach=4 * STEP):
+    """ osmnx style street grid over the network, only the streets within
+    reach degrees of one of its points """
+    xy = np.column_stack([points.geometry.x.to_numpy(), points.geometry.y.to_numpy()])
+    minx, miny = xy.min(axis=0) - reach
+    maxx, maxy = xy.max(axis=0) + reach
+    ii, jj = np.meshgrid(np.arange(int((maxx - minx) / spacing) + 1),
+                         np.arange(int((maxy - miny) / spacing) + 1), indexing='ij')
+    grid = np.column_stack([minx + ii.ravel() * spacing, miny + jj.ravel() * spacing])
+    dist, _ = cKDTree(xy).query(grid, distance_upper_bound=reach)
+    keep = set(map(tuple, np.column_stack([ii.ravel(), jj.ravel()])[np.isfinite(dist)].tolist()))
+
+    G = nx.MultiDiGraph(crs='epsg:4326')
+    for i, j in keep:
+        G.add_node(len(G), x=minx + i * spacing, y=miny + j * spacing)
+    ids = {cell: n for n, cell in zip(G.nodes, keep)}
+    lat = np.radians(miny + (maxy - miny) / 2)
+    for (i, j), u in ids.items():
+        for di, dj in ((1, 0), (0, 1)):
+            v = ids.get((i + di, j + dj))
+            if v is None:
+                continue
+            length = EARTH_RADIUS * np.radians(spacing) * (np.cos(lat) if di else 1.0)
+            G.add_edge(u, v, length=float(length))
+            G.add_edge(v, u, length=float(length))
+    return G
+
+
+def write_network(directory, drop_points=2000, seed=0, exchanges=1):
+    """ points.shp, lines.shp and osm.graphml of a synthetic network """
+    import osmnx as ox
+
+    os.makedirs(directory, exist_ok=True)
+    points, lines = ftth_network(drop_points, seed=seed, exchanges=exchanges)
+    points.to_file(os.path.join(directory, 'points.shp'))
+    lines.to_file(os.path.join(directory, 'lines.shp'))
+    ox.io.save_graphml(street_graph(points), filepath=os.path.join(directory, 'osm.graphml'))
+    return points, lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Write a synthetic FTTH network')
+    parser.add_argument('drop_points', type=int)
+    parser.add_argument('-o', '--output', default='synthetic')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--exchanges', type=int, default=1)
+    args = parser.parse_args(argv)
+
+    points, lines = write_network(args.output, args.drop_points, seed=args.seed,
+                                  exchanges=args.exchanges)
+    print(f'{args.output}: {len(points)} points, {len(lines)} lines')
+
+
+if __name__ == "__main__":
+    main()
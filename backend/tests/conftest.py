@@ -0,0 +1,8 @@
+""" the tests import the backend modules as gunicorn does, from backend/ as
+the working directory the database/ paths are relative to """
+import os
+import sys
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND)
+os.chdir(BACKEND)
@@ -0,0 +1,26 @@
+from collections import Counter
+
+import pytest
+
+import app
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def reduced():
+    return app.reduce(app.quick_graph(*synthetic.ftth_network(200, seed=1)))
+
+
+def loads(G):
+    parent = {n: m for n in app.nodes_typed(G, 'Drop point') for m in G[n]
+              if G.nodes[m]['Type'] == 'PLR'}
+    return Counter(parent.values())
+
+
+@pytest.mark.parametrize('capacity', [30, 500])
+def test_capacity_clusters_hold_at_most_capacity(reduced, capacity):
+    G = app.optimal_centrality(max_attachments=capacity, ngraph=reduced.copy(), method='capacity')
+    drops = len(app.nodes_typed(G, 'Drop point'))
+    assert len(app.nodes_typed(G, 'PLR')) == -(-drops // capacity)
+    assert max(loads(G).values()) <= capacity
+    assert sum(loads(G).values()) == drops
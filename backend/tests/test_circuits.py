@@ -0,0 +1,56 @@
+import networkx as nx
+import pytest
+
+import app
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def network():
+    return app.quick_graph(*synthetic.ftth_network(200, seed=6))
+
+
+def scanned_connections(graph, name):
+    """ node_connections as it was: the shortest path to every node one
+    level down, kept when no other typed node lies on it """
+    ntypes = nx.get_node_attributes(graph, 'Type')
+    onode = app.node_named(graph, name)
+    level = app.type_levels[ntypes[onode]]
+    from_type = list(app.type_levels)[min(level + 1, 4)]
+    nodes = set()
+    for n in app.nodes_typed(graph, from_type):
+        try:
+            path = nx.shortest_path(graph, onode, n)
+        except nx.NetworkXNoPath:
+            continue
+        if all(ntypes[m] == 'JUNC' or m == onode or app.type_levels[ntypes[m]] == level + 1 for m in path) \
+                and sum(ntypes[m] != 'JUNC' for m in path) == 2:
+            nodes.update(path)
+    edges = {frozenset(e) for e in graph.subgraph(nodes).edges}
+    return nodes | {onode}, edges
+
+
+def test_node_connections_match_the_scan(network):
+    for ntype in ('Exchange', 'PRM', 'SEC', 'PLR'):
+        for n in app.nodes_typed(network, ntype):
+            name = network.nodes[n]['Name']
+            v, e = app.node_connections(network, name)
+            assert ({m for m, _ in v}, {frozenset((a, b)) for a, b, _ in e}) == scanned_connections(network, name)
+
+
+def test_circuits_down_and_up(network):
+    h = app.hierarchy(network)
+    sec = app.nodes_typed(network, 'SEC')[0]
+    name = network.nodes[sec]['Name']
+    G = app.circuits(network, name, 'Drop point', return_graph=True)
+    expected = set()
+    for plr in h['children'][sec]:
+        expected |= {m for m, _ in app.node_connections(network, network.nodes[plr]['Name'])[0]}
+        expected |= set(app.link_path(h, plr))
+    assert set(G) == expected
+    assert nx.is_tree(G)
+
+    drop = h['children'][h['children'][sec][0]][0]
+    up = app.circuits(network, network.nodes[drop]['Name'], 'Drop point', upto='E0', return_graph=True)
+    assert nx.has_path(up, drop, app.node_named(network, 'E0'))
+    assert set(nx.shortest_path(network, drop, app.node_named(network, 'E0'))) <= set(up)
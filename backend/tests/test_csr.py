@@ -0,0 +1,59 @@
+import networkx as nx
+import numpy as np
+import pytest
+
+import app
+import synthetic
+from csr import csr_graph
+from indexed_graph import IndexedGraph
+
+
+def lattice(seed):
+    """ a grid with random node types, full of equally near sources """
+    rng = np.random.default_rng(seed)
+    G = IndexedGraph()
+    grid = nx.grid_2d_graph(40, 40)
+    kinds = ['JUNC'] * 6 + list(app.type_levels)
+    nodes = list(grid)
+    G.add_nodes_from((nodes[i], {'Type': kinds[rng.integers(len(kinds))]})
+                     for i in rng.permutation(len(nodes)).tolist())
+    G.add_edges_from(grid.edges(), Type='C4')
+    return G
+
+
+@pytest.fixture(params=['synthetic', 'lattice'])
+def graph(request):
+    if request.param == 'synthetic':
+        return app.quick_graph(*synthetic.ftth_network(400, seed=3))
+    return lattice(1)
+
+
+def test_bfs_matches_nearest_typed(graph):
+    csr = csr_graph(graph)
+    ntypes = nx.get_node_attributes(graph, 'Type')
+    for mtype, _ in app.untypes.values():
+        sources = app.nodes_typed(graph, mtype)
+        expected_owner, expected_pred = app.nearest_typed(graph, sources, ntypes)
+        owner, pred = csr.bfs([csr.index(s) for s in sources], through=csr.typed('JUNC'))
+
+        reached = np.flatnonzero(owner >= 0).tolist()
+        assert {csr.nodes[i] for i in reached} == set(expected_owner)
+        for i in reached:
+            n = csr.nodes[i]
+            assert csr.nodes[owner[i]] == expected_owner[n]
+            assert (csr.nodes[pred[i]] if pred[i] >= 0 else None) == expected_pred[n]
+
+
+def test_csr_path_tree_matches_shortest_path_tree(graph):
+    rng = np.random.default_rng(0)
+    source = next(iter(graph))
+    reachable = list(nx.node_connected_component(graph, source))
+    targets = [reachable[i] for i in rng.choice(len(reachable), 30, replace=False).tolist()]
+
+    pred = app.csr_path_tree(graph, source, targets)
+    expected = app.shortest_path_tree(graph, source, targets)
+    for t in targets:
+        n = t
+        while n is not None:
+            assert pred[n] == expected[n]
+            n = expected[n]
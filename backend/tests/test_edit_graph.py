@@ -0,0 +1,93 @@
+import random
+
+import pytest
+
+import app
+import synthetic
+from indexed_graph import IndexedGraph
+
+
+@pytest.fixture(scope='module')
+def network():
+    return app.quick_graph(*synthetic.ftth_network(400, seed=3))
+
+
+def random_ops(G, rng, size):
+    """ a batch of edits touching nodes of every type, each op valid on
+    the graph as the ones before it leave it """
+    G = G.copy()
+    ops = []
+    while len(ops) < size:
+        kind = rng.choice(['remove_node', 'remove_edge', 'add_edge', 'move_node'])
+        nodes = list(G)
+        if kind == 'remove_edge':
+            u, v = rng.choice(list(G.edges))
+            ops.append({'op': kind, 'from': list(u), 'to': list(v)})
+            G.remove_edge(u, v)
+        elif kind == 'add_edge':
+            u, v = rng.sample(nodes, 2)
+            if G.has_edge(u, v):
+                continue
+            ops.append({'op': kind, 'from': list(u), 'to': list(v), 'Type': 'C4'})
+            G.add_edge(u, v)
+        elif kind == 'remove_node':
+            n = rng.choice(nodes)
+            ops.append({'op': kind, 'node': list(n)})
+            G.remove_node(n)
+        else:
+            n = rng.choice(nodes)
+            to = (n[0] + synthetic.STEP / 3, n[1] + synthetic.STEP / 3)
+            if to in G:
+                continue
+            ops.append({'op': kind, 'node': list(n), 'to': list(to)})
+            G = app.nx.relabel_nodes(G, {n: to})
+    return ops
+
+
+def test_edit_graph_hierarchy_matches_rebuild(network):
+    rng = random.Random(0)
+    G = IndexedGraph(network)
+    for _ in range(60):
+        app.edit_graph(G, random_ops(G, rng, rng.randint(1, 6)))
+        patched = app.hierarchy(G)
+        derived = dict(G.derived)
+        G.derived.clear()
+        rebuilt = app.hierarchy(G)
+        G.derived.update(derived)
+        assert patched['parent'] == rebuilt['parent']
+        assert {p: sorted(c) for p, c in patched['children'].items() if c} == \
+            {p: sorted(c) for p, c in rebuilt['children'].items()}
+        assert all(app.link_path(patched, c) == app.link_path(rebuilt, c) for c in rebuilt['parent'])
+
+
+def snapshot(G):
+    return ({n: dict(d) for n, d in G.nodes(data=True)},
+            {frozenset((u, v)): dict(d) for u, v, d in G.edges(data=True)})
+
+
+def test_patch_leaves_the_stored_graph_alone(network, monkeypatch):
+    monkeypatch.setattr(app, 'graph_store', app.GraphStore(2**30))
+    client = app.app.test_client()
+    gid = client.post('/api/graph/session', json=app.graph_to_json(network)).get_json()['graph_id']
+    stored = app.graph_store.get(gid)
+    h = app.hierarchy(stored)
+    parents = dict(h['parent'])
+    before = snapshot(stored)
+
+    rng = random.Random(1)
+    ids = [gid]
+    for _ in range(10):
+        response = client.patch(f'/api/graph/session/{ids[-1]}', json={'ops': random_ops(
+            app.graph_store.get(ids[-1]), rng, rng.randint(1, 6))})
+        assert response.status_code == 200
+        ids.append(response.get_json()['graph_id'])
+
+    # readers of gid saw nothing change, not even its cached hierarchy
+    assert app.graph_store.get(gid) is stored
+    assert snapshot(stored) == before
+    assert stored.derived['hierarchy'] is h and h['parent'] == parents
+
+    edited = app.graph_store.get(ids[-1])
+    patched = app.hierarchy(edited)
+    edited.derived.clear()
+    assert patched['parent'] == app.hierarchy(edited)['parent']
@@ -0,0 +1,60 @@
+import math
+
+from shapely import geometry
+
+import graph_cache
+import results
+from indexed_graph import IndexedGraph
+
+
+def graph():
+    G = IndexedGraph()
+    G.add_node((0.0, 0.0), Type='PLR', Name='P1', count=3, ratio=1.5, empty=None, some=None,
+               nan=float('nan'), geometry=geometry.Point(0, 0))
+    G.add_node((1.0, 0.0), Type='JUNC', Name=None, count=None, ratio=2.5, empty=None, some=7,
+               nan=1.0, geometry=geometry.Point(1, 0))
+    G.add_edge((0.0, 0.0), (1.0, 0.0), Type='C3', fibres=12,
+               geometry=geometry.LineString([(0, 0), (0.5, 0.1), (1, 0)]))
+    return G
+
+
+def same(a, b):
+    return a == b and type(a) is type(b) or \
+        isinstance(a, float) and isinstance(b, float) and math.isnan(a) and math.isnan(b)
+
+
+def assert_same_graph(G, H):
+    assert list(G.nodes) == list(H.nodes)
+    for n, d in G.nodes(data=True):
+        e = H.nodes[n]
+        assert d.keys() == e.keys()
+        for k in d:
+            if k == 'geometry':
+                assert d[k].equals(e[k])
+            else:
+                assert same(d[k], e[k]), (n, k, d[k], e[k])
+    for u, v, d in G.edges(data=True):
+        e = H.edges[u, v]
+        assert d['geometry'].equals(e['geometry'])
+        assert all(same(d[k], e[k]) for k in d if k != 'geometry')
+
+
+def test_columns_keep_ints_none_and_nan(tmp_path):
+    G = graph()
+    graph_cache.save_graph(tmp_path / 'g.cache', G)
+    H, _ = graph_cache.load_graph(tmp_path / 'g.cache')
+    assert_same_graph(G, H)
+    # built in bulk, the Name and Type indexes still hold every node
+    assert H.node_named('P1') == (0.0, 0.0)
+    assert H.nodes_typed('JUNC') == [(1.0, 0.0)]
+
+
+def test_result_round_trip_matches_fresh_graph():
+    G = graph()
+    assert_same_graph(G, results._decode(*results._encode(G)))
+
+
+def test_files_without_numeric_null_masks_still_load():
+    kind, values, _ = graph_cache._column([1.5, 2.5])
+    assert kind == 'f'
+    assert graph_cache._read_columns('node', {'node.x': values}, [['x', 'f']]) == {'x': [1.5, 2.5]}
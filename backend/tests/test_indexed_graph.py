@@ -0,0 +1,69 @@
+import random
+
+import networkx as nx
+import pytest
+
+import app
+import synthetic
+from indexed_graph import IndexedGraph, node_named, nodes_typed
+
+
+def assert_indexes_match_scan(G):
+    plain = nx.Graph(G)
+    for ntype in {d.get('Type') for _, d in plain.nodes(data=True)}:
+        assert G.nodes_typed(ntype) == [n for n, d in plain.nodes(data=True) if d.get('Type') == ntype]
+        assert nodes_typed(plain, ntype) == G.nodes_typed(ntype)
+    for name in {d.get('Name') for _, d in plain.nodes(data=True)} - {None}:
+        assert G.node_named(name) == node_named(plain, name)
+
+
+@pytest.fixture(scope='module')
+def network():
+    return app.quick_graph(*synthetic.ftth_network(200, seed=1))
+
+
+def test_indexes_follow_changes(network):
+    G = IndexedGraph(network)
+    assert_indexes_match_scan(G)
+    rng = random.Random(0)
+    for n in rng.sample(list(G), 50):
+        G.remove_node(n)
+    G.remove_nodes_from(rng.sample(list(G), 50))
+    G.add_node((0.0, 0.0), Type='PLR', Name='new PLR')
+    G.add_nodes_from([((1.0, 0.0), {'Type': 'Drop point', 'Name': 'new drop'}), (2.0, 0.0)], Type='JUNC')
+    # replacing a node's attributes moves it between the indexes
+    G.add_node((0.0, 0.0), Type='SEC', Name='new SEC')
+    assert_indexes_match_scan(G)
+    assert G.nodes_typed('SEC')[-1] == (0.0, 0.0)
+    with pytest.raises(nx.NodeNotFound):
+        G.node_named('new PLR')
+
+    G.nodes[(2.0, 0.0)]['Name'] = 'renamed'
+    G.reindex([(2.0, 0.0)])
+    assert G.node_named('renamed') == (2.0, 0.0)
+
+    G.clear()
+    assert G.nodes_typed('PLR') == [] and 'new SEC' not in G._names
+
+
+def test_from_items(network):
+    G = IndexedGraph.from_items(network.nodes(data=True), network.edges(data=True))
+    assert_indexes_match_scan(G)
+    assert list(G) == list(network)
+
+
+def test_duplicate_names_resolve_to_the_first():
+    G = IndexedGraph()
+    G.add_node((0, 0), Name='P', Type='PLR')
+    G.add_node((1, 0), Name='P', Type='PLR')
+    assert G.node_named('P') == (0, 0)
+    G.remove_node((0, 0))
+    assert G.node_named('P') == (1, 0)
+
+
+def test_derived_cleared_on_change(network):
+    G = IndexedGraph(network)
+    h = app.hierarchy(G)
+    assert app.hierarchy(G) is h
+    G.add_edge(*list(G)[:2])
+    assert 'hierarchy' not in G.derived
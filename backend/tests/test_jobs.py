@@ -0,0 +1,99 @@
+import time
+
+import pytest
+
+import jobs
+
+
+def runner(kind, params, graph):
+    if kind == 'sleep':
+        time.sleep(params['seconds'])
+    elif kind == 'allocate':
+        return len(bytearray(params['mb'] * 2**20))
+    elif kind == 'raise':
+        raise KeyError(params['key'])
+    return {'kind': kind, 'params': params}
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return jobs.JobQueue(jobs.JobRegistry(str(tmp_path)), runner, max_running=2, max_seconds=30,
+                         max_memory=2**30)
+
+
+def finished(queue, job, seconds=30):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        job = queue.get(job['id'])
+        if job['status'] not in jobs.ACTIVE:
+            return job
+        time.sleep(0.05)
+    raise AssertionError(f'job still {job["status"]}')
+
+
+def test_registry_put_get_list_remove(tmp_path):
+    registry = jobs.JobRegistry(str(tmp_path))
+    registry.put({'id': 'a', 'status': 'queued'})
+    registry.put({'id': 'b', 'status': 'done'})
+    assert registry.get('a') == {'id': 'a', 'status': 'queued'}
+    assert sorted(job['id'] for job in registry.list()) == ['a', 'b']
+    registry.remove('a')
+    assert registry.get('a') is None
+    assert [job['id'] for job in registry.list()] == ['b']
+
+
+def test_update_job_keeps_terminal_states(tmp_path):
+    registry = jobs.JobRegistry(str(tmp_path))
+    registry.put({'id': 'a', 'status': 'running'})
+    assert jobs.update_job(registry, 'a', status='done')['status'] == 'done'
+    assert jobs.update_job(registry, 'a', status='failed')['status'] == 'done'
+    assert jobs.update_job(registry, 'missing', status='done') is None
+
+
+def test_job_result(queue):
+    job = finished(queue, queue.submit('echo', {'x': 1}, None))
+    assert job['status'] == 'done'
+    assert jobs.read_result(queue.registry, job) == {'kind': 'echo', 'params': {'x': 1}}
+
+
+def test_job_error(queue):
+    job = finished(queue, queue.submit('raise', {'key': 'k'}, None))
+    assert job['status'] == 'failed' and job['error'] == "KeyError: 'k'"
+
+
+def test_timeout_under_a_second(queue):
+    job = finished(queue, queue.submit('sleep', {'seconds': 20}, None, timeout=0.5))
+    assert job['status'] == 'failed' and 'time limit' in job['error']
+    assert job['finished'] - job['started'] < 10
+
+
+def test_memory_limit(queue):
+    job = finished(queue, queue.submit('allocate', {'mb': 512}, None, max_memory=64 * 2**20))
+    assert job['status'] == 'failed' and 'memory limit' in job['error']
+
+
+def test_limits_capped_and_positive(queue):
+    job = queue.submit('echo', {}, None, timeout=10**6, max_memory=2**40)
+    assert job['timeout'] == 30 and job['max_memory'] == 2**30
+    with pytest.raises(ValueError):
+        queue.submit('echo', {}, None, timeout=-1)
+
+
+def test_cancel(queue):
+    job = queue.submit('sleep', {'seconds': 20}, None)
+    deadline = time.time() + 30
+    while queue.get(job['id'])['pid'] is None and time.time() < deadline:
+        time.sleep(0.05)
+    pid = queue.get(job['id'])['pid']
+    assert queue.cancel(job['id'])['status'] == 'cancelled'
+    deadline = time.time() + 10
+    while jobs._alive(pid) and time.time() < deadline:
+        time.sleep(0.05)
+    assert queue.get(job['id'])['status'] == 'cancelled'
+
+
+def test_max_running(queue):
+    started = [queue.submit('sleep', {'seconds': 1}, None) for _ in range(3)]
+    states = [queue.get(job['id'])['status'] for job in started]
+    assert states.count('running') == 2 and states.count('queued') == 1
+    assert all(finished(queue, job)['status'] == 'done' for job in started)
@@ -0,0 +1,60 @@
+import copy
+import io
+import json
+
+import geopandas as gpd
+import pytest
+
+import app
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def jdata():
+    return app.graph_to_json(app.quick_graph(*synthetic.ftth_network(200, seed=10)))
+
+
+def test_matches_the_geopandas_path(jdata):
+    G = app.json_to_graph(jdata)
+    frames = [gpd.read_file(io.BytesIO(json.dumps(jdata[key]).encode('utf-8'))).drop('id', axis=1)
+              for key in ('nodes', 'edges')]
+    H = app.quick_graph(*frames)
+    assert set(G) == set(H) and set(map(frozenset, G.edges)) == set(map(frozenset, H.edges))
+    for n, d in H.nodes(data=True):
+        assert {k: G.nodes[n][k] for k in ('Type', 'Name')} == {k: d[k] for k in ('Type', 'Name')}
+    for u, v, d in H.edges(data=True):
+        assert G.edges[u, v]['Type'] == d['Type']
+        assert G.edges[u, v]['geometry'].equals(d['geometry'])
+
+
+def broken(jdata, change):
+    jdata = copy.deepcopy(jdata)
+    change(jdata)
+    return jdata
+
+
+def set_first(key, path, value):
+    def change(jdata):
+        target = jdata[key]['features'][0]
+        for k in path[:-1]:
+            target = target[k]
+        target[path[-1]] = value
+    return change
+
+
+@pytest.mark.parametrize('change, message', [
+    (lambda j: j.pop('nodes'), "'nodes' must be a GeoJSON FeatureCollection"),
+    (lambda j: j['edges'].update(features={}), "'edges' must be a GeoJSON FeatureCollection"),
+    (set_first('nodes', ['geometry', 'type'], 'LineString'), 'nodes feature 0 is not a Point'),
+    (set_first('edges', ['geometry'], None), 'edges feature 0 is not a LineString'),
+    (set_first('edges', ['geometry', 'coordinates'], [[0, 0]]), 'edges feature 0 has invalid coordinates'),
+    (set_first('nodes', ['geometry', 'coordinates'], [1]), 'nodes feature 0 has invalid coordinates'),
+    (set_first('nodes', ['properties'], [1]), 'nodes feature 0 has invalid properties'),
+    (set_first('edges', ['geometry', 'coordinates'], [['a', 0], [1, 1]]), 'Coordinates must be numbers'),
+])
+def test_bad_graphs_answered_with_400(jdata, change, message):
+    bad = broken(jdata, change)
+    with pytest.raises(app.InvalidGraph, match=message):
+        app.json_to_graph(bad)
+    response = app.app.test_client().post('/api/graph/reduce', json=bad)
+    assert response.status_code == 400 and response.get_json() == {'error': message}
@@ -0,0 +1,54 @@
+import re
+
+import app
+import metrics
+import results
+import synthetic
+
+
+def test_histogram_lines():
+    h = metrics.Histogram('t_seconds', 'Test.', ('route',), (0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        h.observe(value, route='/a"b')
+    h.observe(0.2, route='/c')
+    assert list(h.lines()) == [
+        '# HELP t_seconds Test.',
+        '# TYPE t_seconds histogram',
+        't_seconds_bucket{route="/a\\"b",le="0.1"} 2',
+        't_seconds_bucket{route="/a\\"b",le="1"} 3',
+        't_seconds_bucket{route="/a\\"b",le="+Inf"} 4',
+        't_seconds_sum{route="/a\\"b"} 3.65',
+        't_seconds_count{route="/a\\"b"} 4',
+        't_seconds_bucket{route="/c",le="0.1"} 0',
+        't_seconds_bucket{route="/c",le="1"} 1',
+        't_seconds_bucket{route="/c",le="+Inf"} 1',
+        't_seconds_sum{route="/c"} 0.2',
+        't_seconds_count{route="/c"} 1',
+    ]
+
+
+def test_server_timing_and_metrics(monkeypatch):
+    monkeypatch.setattr(app, 'result_cache', results.ResultCache(2**24))
+    client = app.app.test_client()
+    jdata = app.graph_to_json(app.quick_graph(*synthetic.ftth_network(100, seed=11)))
+    response = client.post('/api/graph/reduce', json=jdata)
+    assert response.status_code == 200 and response.get_json()
+    timing = dict(re.fullmatch(r'(\w+);dur=(\d+\.\d)', part).groups()
+                  for part in response.headers['Server-Timing'].split(', '))
+    assert {'decode', 'parse', 'join', 'algorithm', 'total'} <= set(timing)
+    assert sum(float(v) for k, v in timing.items() if k != 'total') <= float(timing['total']) + 0.5
+
+    text = client.get('/metrics').get_data(as_text=True)
+    assert text.endswith('\n')
+    for line in [
+            '# TYPE softel_request_seconds histogram',
+            'softel_request_seconds_count{route="/api/graph/reduce",method="POST",status="200"}',
+            'softel_stage_seconds_count{route="/api/graph/reduce",stage="algorithm"}',
+            # timed while the response streamed out
+            'softel_stage_seconds_count{route="/api/graph/reduce",stage="serialize"}',
+            'softel_graph_nodes_count{route="/api/graph/reduce",side="in"}',
+            '# TYPE softel_graph_store_graphs gauge',
+            '# TYPE softel_result_cache_misses_total counter']:
+        assert line in text
+    samples = [line for line in text.splitlines() if not line.startswith('#')]
+    assert all(re.fullmatch(r'[a-z_]+(\{.*\})? [-+.\deInf]+', line) for line in samples)
@@ -0,0 +1,63 @@
+import random
+
+import networkx as nx
+import pytest
+from shapely import geometry
+
+import app
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def network():
+    """ a synthetic network with chords added, so there are many routes """
+    G = app.quick_graph(*synthetic.ftth_network(300, seed=5))
+    rng = random.Random(0)
+    nodes = list(G)
+    for _ in range(60):
+        u, v = rng.sample(nodes, 2)
+        if not G.has_edge(u, v):
+            G.add_edge(u, v, Type='C4', geometry=geometry.LineString([u, v]))
+    return G
+
+
+def names(G, ntype, k, seed=0):
+    return [G.nodes[n]['Name'] for n in random.Random(seed).sample(app.nodes_typed(G, ntype), k)]
+
+
+@pytest.mark.parametrize('weight', [None, 'length'])
+def test_one_tree_for_all_destinations(network, weight):
+    dests = names(network, 'Drop point', 40)
+    origin = app.node_named(network, 'E0')
+    T = app.shortest_path(network, dests, 'E0', return_graph=True, weight=weight)
+    assert nx.is_tree(T) and origin in T
+    assert all(network.has_edge(u, v) for u, v in T.edges)
+    if weight is None:
+        expected = nx.single_source_shortest_path_length(network, origin)
+        got = nx.single_source_shortest_path_length(T, origin)
+    else:
+        def length(u, v, d):
+            return app.edge_length(d)
+        expected = nx.single_source_dijkstra_path_length(network, origin, weight=length)
+        got = nx.single_source_dijkstra_path_length(T, origin, weight=length)
+    for name in dests:
+        n = app.node_named(network, name)
+        assert got[n] == pytest.approx(expected[n])
+
+
+def test_e2e_marks_a_copy_of_the_path(network):
+    caller, reciever = names(network, 'Drop point', 2, seed=1)
+    types = {e: d['Type'] for e, d in network.edges.items()}
+    P = app.e2e(network, caller, reciever, weight='length')
+    u, v = app.node_named(network, caller), app.node_named(network, reciever)
+    assert nx.has_path(P, u, v) and nx.is_tree(P)
+    assert {d['Type'] for _, _, d in P.edges(data=True)} == {'Call'}
+    assert {e: d['Type'] for e, d in network.edges.items()} == types
+
+
+def test_unreachable_destination(network):
+    G = network.copy()
+    drop = app.nodes_typed(G, 'Drop point')[0]
+    G.remove_edges_from(list(G.edges(drop)))
+    with pytest.raises(nx.NetworkXNoPath):
+        app.shortest_path(G, [G.nodes[drop]['Name']], 'E0')
@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+from conftest import BACKEND
+
+
+# a gunicorn master in short: gunicorn.conf.py's when_ready, then a fork
+# serving requests from what the master loaded
+MASTER = '''
+import gc, os, runpy, sys
+import app
+lazy = ('geopandas', 'osmnx', 'sklearn', 'scipy.sparse.csgraph')
+assert not [m for m in lazy if m in sys.modules], 'imported by app'
+runpy.run_path('gunicorn.conf.py')['when_ready'](None)
+assert all(m in sys.modules for m in lazy), 'not preloaded'
+assert gc.get_freeze_count() > 0
+pid = os.fork()
+if pid == 0:
+    client = app.app.test_client()
+    quick = client.get('/api/graph/quick_graph')
+    gid = quick.headers['X-Graph-Id']
+    reduced = client.post('/api/graph/reduce', json={'graph_id': gid})
+    shards = client.get('/api/graph/shards')
+    gc.collect()
+    ok = quick.status_code == reduced.status_code == shards.status_code == 200 and \\
+        quick.get_json()['nodes']['features'] and reduced.get_json()['edges']['features']
+    os._exit(0 if ok else 1)
+sys.exit(os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]))
+'''
+
+
+def test_forked_worker_serves_from_the_preloaded_master():
+    done = subprocess.run([sys.executable, '-c', MASTER], cwd=BACKEND, capture_output=True, text=True,
+                          env={**os.environ, 'PYTHONPATH': BACKEND}, timeout=600)
+    assert done.returncode == 0, done.stderr
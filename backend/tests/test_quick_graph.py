@@ -0,0 +1,16 @@
+import numpy as np
+
+import app
+
+
+def test_match_points_takes_the_nearest_point():
+    points = np.array([[0.9, 0], [5, 5], [0, 0]])
+    assert app.match_points([(0, 0)], points, tolerance=1.0).tolist() == [2]
+    assert app.match_points([(0, 0)], points).tolist() == [2]
+
+
+def test_match_points_ties_go_to_the_first_row():
+    points = np.array([[0, 0.5], [0.5, 0], [3, 3], [0, 0], [0, 0]])
+    nodes = [(0, 0), (0.25, 0.25), (9, 9)]
+    assert app.match_points(nodes, points, tolerance=1.0).tolist() == [3, 0, -1]
+    assert app.match_points(nodes, points).tolist() == [3, -1, -1]
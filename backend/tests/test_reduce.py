@@ -0,0 +1,49 @@
+import networkx as nx
+import pytest
+
+import app
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def network():
+    return app.quick_graph(*synthetic.ftth_network(300, seed=4))
+
+
+def pairwise_reduce(graph):
+    """ reduce() as it was: each child linked to the first parent whose
+    shortest path to it has no other typed node """
+    vertices, _ = app.simplify(graph)
+    ntypes = nx.get_node_attributes(graph, 'Type')
+    edges = set()
+    for key, (mtype, ctype) in app.untypes.items():
+        masters = [n for n, d in vertices if d['Type'] == mtype]
+        for sn in [n for n, d in vertices if d['Type'] == key]:
+            for mn in masters:
+                try:
+                    path = nx.shortest_path(graph, source=mn, target=sn)
+                except nx.NetworkXNoPath:
+                    continue
+                if len([n for n in path if ntypes[n] != 'JUNC']) == 2:
+                    edges.add((frozenset((mn, sn)), ctype))
+                    break
+    return {n for n, _ in vertices}, edges
+
+
+def test_reduce_matches_pairwise_search(network):
+    G = app.reduce(network)
+    nodes, edges = pairwise_reduce(network)
+    assert set(G) == nodes
+    assert {(frozenset((u, v)), d['Type']) for u, v, d in G.edges(data=True)} == edges
+    assert G.number_of_edges() == len(app.nodes_typed(network, 'Drop point')) + sum(
+        len(app.nodes_typed(network, t)) for t in ('PLR', 'SEC', 'PRM'))
+
+
+def test_cut_cables_leave_children_unlinked(network):
+    cut = network.copy()
+    cut.remove_edges_from(list(cut.edges(app.nodes_typed(cut, 'SEC')[0])) +
+                          list(cut.edges(app.nodes_typed(cut, 'Drop point')[:20])))
+    G = app.reduce(cut)
+    _, edges = pairwise_reduce(cut)
+    assert {(frozenset((u, v)), d['Type']) for u, v, d in G.edges(data=True)} == edges
+    assert len(edges) < app.reduce(network).number_of_edges() - 20
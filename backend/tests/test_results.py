@@ -0,0 +1,74 @@
+import pytest
+
+import app
+import results
+import synthetic
+from test_graph_cache import assert_same_graph, graph
+
+
+def test_memory_then_disk_hits(tmp_path):
+    path = str(tmp_path / 'results.db')
+    cache = results.ResultCache(2**20, disk=results.DiskResults(path, 2**20))
+    G = graph()
+    assert cache.get('g') == (None, None)
+    cache.put('g', G)
+    cache.put('j', {'count': 3, 'names': ['P1', None]})
+    assert cache.get('g') == (G, 'memory')
+
+    # another worker finds the results in the shared file only
+    other = results.ResultCache(2**20, disk=results.DiskResults(path, 2**20))
+    H, tier = other.get('g')
+    assert tier == 'disk'
+    assert_same_graph(G, H)
+    assert other.get('j') == ({'count': 3, 'names': ['P1', None]}, 'disk')
+    assert other.get('j')[1] == 'memory'
+    assert other.counts == {'memory_hits': 1, 'disk_hits': 2, 'misses': 0}
+    assert cache.counts == {'memory_hits': 1, 'disk_hits': 0, 'misses': 1}
+
+
+def test_disk_trimmed_oldest_use_first(tmp_path):
+    disk = results.DiskResults(str(tmp_path / 'results.db'), 2500)
+    for key in 'abc':
+        disk.put(key, 'json', b'x' * 1000)
+    assert disk.get('a') is None
+    assert disk.get('b') is not None
+    disk.put('d', 'json', b'x' * 1000)
+    # b was read after c was written, so c goes
+    assert disk.get('c') is None
+    assert disk.stats()['results'] == 2 and disk.stats()['bytes'] == 2000
+
+    disk.put('e', 'json', b'x' * 5000)
+    assert disk.get('e') is not None and disk.stats()['results'] == 1
+
+
+def test_memory_tier_evicts_to_max_bytes():
+    cache = results.ResultCache(2500)
+    for key in 'abc':
+        cache.put(key, 'x' * 1000)
+    assert cache.get('a') == (None, None)
+    assert cache.get('c') == ('x' * 1000, 'memory')
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'result_cache', results.ResultCache(2**24))
+    monkeypatch.setattr(app, 'graph_store', app.GraphStore(2**24))
+    return app.app.test_client()
+
+
+def test_endpoint_answers_from_the_cache(client):
+    jdata = app.graph_to_json(app.quick_graph(*synthetic.ftth_network(200, seed=1)))
+    first = client.post('/api/graph/reduce', json=jdata)
+    second = client.post('/api/graph/reduce', json=jdata)
+    assert first.status_code == second.status_code == 200
+    assert first.headers['X-Result-Cache'] == 'miss'
+    assert second.headers['X-Result-Cache'] == 'memory'
+    assert first.get_json() == second.get_json()
+
+
+def test_request_graph_hashed_once_on_a_miss(client, monkeypatch):
+    jdata = app.graph_to_json(app.quick_graph(*synthetic.ftth_network(200, seed=1)))
+    hashed = []
+    monkeypatch.setattr(app, 'content_hash', lambda value: hashed.append(value) or results.content_hash(value))
+    assert client.post('/api/graph/reduce', json=jdata).headers['X-Result-Cache'] == 'miss'
+    assert hashed == [jdata]
@@ -0,0 +1,60 @@
+from collections import Counter
+
+import pytest
+
+import app
+import results
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def graph():
+    return app.quick_graph(*synthetic.ftth_network(300, seed=4, exchanges=2))
+
+
+def descendants(h, n):
+    """ every node below n in the hierarchy, walked one child at a time """
+    stack, found = list(h['children'].get(n, ())), []
+    while stack:
+        c = stack.pop()
+        found.append(c)
+        stack.extend(h['children'].get(c, ()))
+    return found
+
+
+def test_rollups_match_a_subtree_walk(graph):
+    h = app.hierarchy(graph)
+    report = app.rollups(graph)['nodes']
+    typed = [n for n, d in graph.nodes(data=True) if d.get('Type') in app.type_levels]
+    assert len(report) == len(typed)
+    for n in typed:
+        d = graph.nodes[n]
+        r = report[d['Name']]
+        below = [graph.nodes[c] for c in descendants(h, n)]
+        parent = h['parent'].get(n)
+        assert r['Type'] == d['Type']
+        assert r['parent'] == (graph.nodes[parent]['Name'] if parent is not None else None)
+        assert r['children'] == len(h['children'].get(n, ()))
+        assert r['capacity'] == app.capacities.get(d['Type'])
+        counts = Counter(c['Type'] for c in below)
+        assert r['subtree'] == {t: counts[t] for t in app.type_levels
+                                if app.type_levels[t] > app.type_levels[d['Type']]}
+        for key in ('ECC', 'PS'):
+            assert r[key] == dict(Counter(str(c[key]) for c in below if c.get(key) is not None))
+
+
+def test_overloaded_against_capacity(graph, monkeypatch):
+    monkeypatch.setitem(app.capacities, 'PLR', 25)
+    G = graph.copy()
+    r = app.rollups(G)
+    expected = [name for name, v in r['nodes'].items() if v['Type'] == 'PLR' and v['children'] > 25]
+    assert expected and sorted(r['overloaded']) == sorted(expected)
+    assert r['capacities']['PLR'] == 25
+
+
+def test_rollups_route(graph, monkeypatch):
+    monkeypatch.setattr(app, 'result_cache', results.ResultCache(2**24))
+    monkeypatch.setattr(app, 'graph_store', app.GraphStore(2**30))
+    response = app.app.test_client().post('/api/graph/rollups', json=app.graph_to_json(graph))
+    assert response.status_code == 200
+    assert response.get_json() == app.rollups(graph)
@@ -0,0 +1,92 @@
+import networkx as nx
+import numpy as np
+import osmnx as ox
+import pytest
+from shapely import geometry
+
+import app
+import streets
+import synthetic
+
+
+def test_snap_to_segments_matches_brute_force():
+    rng = np.random.default_rng(0)
+    starts = rng.uniform(0, 1, (300, 2))
+    ends = starts + rng.normal(0, 0.05, (300, 2))
+    points = rng.uniform(-0.1, 1.1, (500, 2))
+    near, t = app.snap_to_segments(points, starts, ends)
+
+    lines = [geometry.LineString([a, b]) for a, b in zip(starts.tolist(), ends.tolist())]
+    for p, i, f in zip(points.tolist(), near.tolist(), t.tolist()):
+        point = geometry.Point(p)
+        best = min(line.distance(point) for line in lines)
+        assert np.isclose(lines[i].distance(point), best)
+        # the foot at fraction t is the point of the segment nearest to p
+        foot = starts[i] + f * (ends[i] - starts[i])
+        assert 0 <= f <= 1 and np.isclose(np.hypot(*(foot - p)), best)
+
+
+@pytest.fixture(scope='module')
+def network(tmp_path_factory):
+    """ a synthetic network and a street grid over all of it as the street
+    graph """
+    points, lines = synthetic.ftth_network(2000, seed=2)
+    path = str(tmp_path_factory.mktemp('streets') / 'osm.graphml')
+    ox.io.save_graphml(synthetic.street_graph(points, reach=60 * synthetic.STEP), filepath=path)
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(streets, 'OSM_GRAPHML', path)
+        yield app.quick_graph(points, lines)
+
+
+def street_length(u, v, d):
+    return min(app.edge_length(k) for k in d.values())
+
+
+@pytest.mark.parametrize('weight', [None, 'length'])
+def test_shortest_path_tree_matches_networkx(network, weight):
+    S = streets.street_graph().graph
+    nodes = list(S)
+    rng = np.random.default_rng(1)
+    source = nodes[0]
+    targets = [nodes[i] for i in rng.choice(len(nodes), 50, replace=False)]
+    pred = app.shortest_path_tree(S, source, targets, weight=weight)
+    if weight is None:
+        expected = nx.single_source_shortest_path_length(S, source)
+    else:
+        expected = nx.single_source_dijkstra_path_length(S, source, weight=street_length)
+    for t in targets:
+        path = [t]
+        while pred[path[-1]] is not None:
+            path.append(pred[path[-1]])
+        assert path[-1] == source
+        if weight is None:
+            assert len(path) - 1 == expected[t]
+        else:
+            assert np.isclose(sum(street_length(v, u, S[v][u]) for u, v in zip(path, path[1:])),
+                              expected[t])
+
+
+def test_steiner_paths_is_a_tree_over_the_targets(network):
+    S = streets.street_graph().graph
+    nodes = list(S)
+    source, targets = nodes[0], nodes[100:3000:97]
+    v, e = app.steiner_paths(S, source, targets)
+    T = nx.Graph(e)
+    assert nx.is_tree(T) and set(T) == set(v) and {source, *targets} <= set(v)
+    assert all(S.has_edge(a, b) for a, b in e)
+
+
+def test_reverse_reduction_modes(network):
+    h = app.hierarchy(network)
+    for plr in app.nodes_typed(network, 'PLR')[3:6]:
+        name = network.nodes[plr]['Name']
+        lengths = {}
+        for routing in ('hops', 'tree', 'steiner'):
+            rG = app.reverse_partial_reduction(network, name, return_graph=True, routing=routing)
+            origin = app.node_named(rG, name)
+            # every drop point reaches its PLR over the new cables only
+            assert all(nx.has_path(rG, origin, c) and not rG.has_edge(origin, c)
+                       for c in h['children'][plr])
+            lengths[routing] = rG.graph['cable_length']
+        # on these PLRs the Steiner tree alone lays more cable than the tree
+        assert lengths['steiner'] <= lengths['tree']
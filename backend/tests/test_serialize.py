@@ -0,0 +1,50 @@
+import gzip
+import hashlib
+import json
+
+import pytest
+
+import app
+import graph_cache
+import synthetic
+from store import GraphStore, content_hash
+from test_graph_cache import assert_same_graph
+
+
+@pytest.fixture(scope='module')
+def network():
+    return app.quick_graph(*synthetic.ftth_network(200, seed=9))
+
+
+def test_streamed_json_is_the_canonical_dump(network):
+    extra = {'cable_length': 12.5, 'shards': ['E0']}
+    chunks = list(app.iter_graph_json(network, extra=extra, chunk_size=4096))
+    body = b''.join(chunks)
+    assert len(chunks) > 10
+    assert json.loads(body) == {**app.graph_to_json(network), **extra}
+    # the bytes are the ones store.content_hash hashes
+    assert hashlib.sha1(body).hexdigest() == content_hash({**app.graph_to_json(network), **extra})
+    assert gzip.decompress(b''.join(app.gzip_chunks(iter(chunks)))) == body
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'graph_store', GraphStore(2**30))
+    return app.app.test_client()
+
+
+def test_response_formats(client, network):
+    jdata = app.graph_to_json(network)
+    gid = client.post('/api/graph/session', json=jdata).get_json()['graph_id']
+    plain = client.get(f'/api/graph/session/{gid}')
+    assert plain.headers['X-Graph-Id'] == gid and plain.is_streamed
+    assert json.loads(plain.data) == json.loads(json.dumps(app.graph_to_json(app.graph_store.get(gid))))
+
+    zipped = client.get(f'/api/graph/session/{gid}', headers={'Accept-Encoding': 'gzip'})
+    assert zipped.headers['Content-Encoding'] == 'gzip'
+    assert gzip.decompress(zipped.data) == plain.data
+
+    arrays = client.get(f'/api/graph/session/{gid}', headers={'Accept': app.GRAPH_ARRAYS})
+    assert arrays.mimetype == app.GRAPH_ARRAYS
+    meta, columns = graph_cache.read_arrays(arrays.data)
+    assert_same_graph(app.graph_store.get(gid), graph_cache.arrays_to_graph(columns, meta))
@@ -0,0 +1,25 @@
+from collections import Counter
+
+import app
+import synthetic
+from shards import ShardSet
+
+
+def type_counts(G):
+    return (Counter(d.get('Type') for _, d in G.nodes(data=True)),
+            Counter(d.get('Type') for _, _, d in G.edges(data=True)))
+
+
+def test_sharded_op_cen_matches_whole_network(tmp_path, monkeypatch):
+    G = app.quick_graph(*synthetic.ftth_network(1500, seed=0, exchanges=3))
+    network = ShardSet(str(tmp_path))
+    shards = network.build(G)
+    monkeypatch.setattr(app, 'network_shards', network)
+
+    whole = app.optimal_centrality(ngraph=app.reduce(G))
+    sharded = app.run_sharded('op_cen', {'shards': list(shards.values())})
+
+    assert type_counts(sharded) == type_counts(whole)
+    assert sharded.graph['shards'] == sorted(shards)
+    names = [d['Name'] for _, d in sharded.nodes(data=True) if d.get('Type') == 'PLR']
+    assert len(set(names)) == len(names)
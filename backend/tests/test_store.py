@@ -0,0 +1,71 @@
+import pytest
+
+import app
+import synthetic
+from store import GraphStore, content_hash
+
+
+def test_least_recently_used_evicted_first():
+    store = GraphStore(max_bytes=300)
+    for key in 'abc':
+        store.put(key, key, size=100)
+    assert store.get('a') == 'a'
+    store.put('d', 'd', size=100)
+    assert 'b' not in store and all(key in store for key in 'acd')
+    assert store.stats()['bytes'] == 300
+
+    store.put('a', 'A', size=250)
+    assert [key for key in 'abcd' if key in store] == ['a']
+    assert store.get('a') == 'A' and store.nbytes == 250
+
+
+def test_largest_graph_kept_alone_and_item_cap():
+    store = GraphStore(max_bytes=100, max_items=2)
+    store.put('big', 'big', size=1000)
+    assert 'big' in store
+    store.put('a', 'a', size=10)
+    assert 'big' not in store
+    store.put('b', 'b', size=10)
+    store.put('c', 'c', size=10)
+    assert len(store) == 2 and 'a' not in store
+    assert store.discard('b') and not store.discard('b')
+    assert store.nbytes == 10
+
+
+def test_content_hash_ignores_key_order():
+    assert content_hash({'a': 1, 'b': [1, 2]}) == content_hash({'b': [1, 2], 'a': 1})
+    assert content_hash({'a': 1}) != content_hash({'a': 2})
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'graph_store', GraphStore(2**30))
+    return app.app.test_client()
+
+
+def test_session_flow(client):
+    network = app.quick_graph(*synthetic.ftth_network(200, seed=1))
+    jdata = app.graph_to_json(network)
+    upload = client.post('/api/graph/session', json=jdata).get_json()
+    gid = upload['graph_id']
+    assert gid == content_hash(jdata)
+    assert (upload['nodes'], upload['edges']) == (network.number_of_nodes(), network.number_of_edges())
+    assert client.post('/api/graph/session', json=jdata).get_json()['graph_id'] == gid
+
+    # endpoints take the id in place of the graph
+    assert client.post('/api/graph/reduce', json={'graph_id': gid}).get_json() == \
+        client.post('/api/graph/reduce', json=jdata).get_json()
+
+    drop = next(n for n in network if network.nodes[n]['Type'] == 'Drop point')
+    edited = client.patch(f'/api/graph/session/{gid}', json={'ops': [{'op': 'remove_node', 'node': list(drop)}]})
+    new_gid = edited.get_json()['graph_id']
+    assert new_gid != gid
+    before = app.json_to_graph(client.get(f'/api/graph/session/{gid}').get_json())
+    after = app.json_to_graph(client.get(f'/api/graph/session/{new_gid}').get_json())
+    assert set(before) - set(after) == {drop}
+    assert after.number_of_edges() == before.number_of_edges() - network.degree(drop)
+
+    assert client.delete(f'/api/graph/session/{gid}').status_code == 200
+    assert client.get(f'/api/graph/session/{gid}').status_code == 404
+    assert client.delete(f'/api/graph/session/{gid}').status_code == 404
+    assert client.get('/api/graph/session').get_json()['graphs'] >= 1
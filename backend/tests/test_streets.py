@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import osmnx as ox
+import pytest
+
+import app
+import streets
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def graphml(tmp_path_factory):
+    points, _ = synthetic.ftth_network(300, seed=7)
+    path = str(tmp_path_factory.mktemp('streets') / 'osm.graphml')
+    ox.io.save_graphml(synthetic.street_graph(points), filepath=path)
+    return path
+
+
+def test_nearest_nodes_match_a_scan(graphml):
+    sg = streets.street_graph(graphml)
+    xy = np.array([[d['x'], d['y']] for _, d in sg.graph.nodes(data=True)])
+    rng = np.random.default_rng(0)
+    points = rng.uniform(xy.min(axis=0), xy.max(axis=0), (200, 2))
+    found = sg.nearest_nodes(points)
+    for p, n in zip(points, found):
+        d = np.hypot(*((xy - p) * sg.scale).T)
+        assert np.isclose(d[sg.ids.index(n)], d.min())
+    assert sg.nearest_nodes([]) == []
+
+
+def test_loaded_once_until_the_file_changes(graphml, tmp_path):
+    assert streets.street_graph(graphml) is streets.street_graph(graphml)
+    copy = str(tmp_path / 'copy.graphml')
+    streets.main(['import', graphml, '-o', copy])
+    first = streets.street_graph(copy)
+    assert first.graph.number_of_nodes() == streets.street_graph(graphml).graph.number_of_nodes()
+    os.utime(copy, (0, 0))
+    assert streets.street_graph(copy) is not first
+    assert streets.street_graph(str(tmp_path / 'missing.graphml')) is None
+
+
+def test_offline_without_a_street_graph(tmp_path, monkeypatch):
+    monkeypatch.setattr(streets, 'OSM_GRAPHML', str(tmp_path / 'missing.graphml'))
+    monkeypatch.setenv('OSM_OFFLINE', '1')
+    with pytest.raises(FileNotFoundError):
+        app.osm([], [])
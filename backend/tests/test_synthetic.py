@@ -0,0 +1,32 @@
+import pytest
+
+import app
+import synthetic
+
+
+def test_fanout_within_capacities():
+    assert all(synthetic.FANOUT[t] <= app.capacities[t] for t in synthetic.FANOUT)
+
+
+@pytest.mark.parametrize('drop_points, exchanges, seed', [(2000, 1, 0), (1500, 3, 1)])
+def test_network_validates_clean(drop_points, exchanges, seed):
+    points, lines = synthetic.ftth_network(drop_points, seed=seed, exchanges=exchanges)
+    G = app.quick_graph(points, lines)
+    for e in range(exchanges):
+        exchange = G.subgraph(app.nx.node_connected_component(G, app.node_named(G, f'E{e}')))
+        report = app.validate(exchange.copy(), origin=f'E{e}')
+        assert {check: found['count'] for check, found in report['checks'].items()
+                if found['count']} == {}
+
+
+def test_children_under_the_parents_made_for():
+    points, lines = synthetic.ftth_network(1000, seed=2)
+    G = app.quick_graph(points, lines)
+    h = app.hierarchy(G)
+    names = {n: d['Name'] for n, d in G.nodes(data=True) if d['Type'] != 'JUNC'}
+    made = {}
+    for level, ltype in enumerate(synthetic.LEVELS[1:], start=1):
+        children = points[points.Type == ltype].Name.tolist()
+        above = points[points.Type == synthetic.LEVELS[level - 1]].Name.tolist()
+        made.update({c: above[i * len(above) // len(children)] for i, c in enumerate(children)})
+    assert {names[c]: names[p] for c, p in h['parent'].items()} == made
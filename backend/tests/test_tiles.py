@@ -0,0 +1,101 @@
+import math
+from collections import Counter
+
+import pytest
+
+import app
+import results
+import synthetic
+from tiles import valid_tile
+
+
+@pytest.fixture(scope='module')
+def graph():
+    return app.quick_graph(*synthetic.ftth_network(300, seed=2))
+
+
+def tile_of(n, z):
+    """ tile x, y holding point n at zoom z """
+    lon, lat = n
+    t = 2 ** z
+    y = (1 - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2 * t
+    return int((lon + 180) / 360 * t), int(y)
+
+
+def covering_tiles(graph, z):
+    """ every tile at zoom z holding a node, and the ring around them """
+    xy = [tile_of(n, z) for n in graph]
+    xs, ys = [x for x, _ in xy], [y for _, y in xy]
+    return [(z, x, y) for x in range(min(xs) - 1, max(xs) + 2)
+            for y in range(min(ys) - 1, max(ys) + 2) if valid_tile(z, x, y)]
+
+
+def tile_nodes(graph, z):
+    features = [f for t in covering_tiles(graph, z) for f in app.graph_tile(graph, *t)['nodes']['features']]
+    return [(tuple(f['geometry']['coordinates']), f['properties']) for f in features]
+
+
+def test_drops_match_the_hierarchy(graph):
+    h = app.hierarchy(graph)
+    overview = app.overview_graph(graph)
+    for plr in app.nodes_typed(graph, 'PLR'):
+        drops = sum(h['types'][c] == 'Drop point' for c in h['children'].get(plr, ()))
+        assert overview.nodes[plr].get('Drops', 0) == drops
+
+    linked = {n for n in app.nodes_typed(graph, 'Drop point') if n in h['parent']}
+    assert sum(drops for _, drops in overview.nodes(data='Drops', default=0)) == len(linked)
+    for mtype in ('Exchange', 'PRM', 'SEC', 'PLR'):
+        assert set(app.nodes_typed(overview, mtype)) == set(app.nodes_typed(graph, mtype))
+
+
+def test_detail_tiles_hold_every_typed_node_once(graph):
+    nodes = tile_nodes(graph, app.OVERVIEW_ZOOM + 1)
+    typed = {n for n, d in graph.nodes(data=True) if d.get('Type') != 'JUNC'}
+    assert Counter(n for n, _ in nodes) == Counter(typed)
+    assert all('Drops' not in p for _, p in nodes)
+
+
+def test_overview_tiles_count_the_folded_drops(graph):
+    h = app.hierarchy(graph)
+    nodes = tile_nodes(graph, app.OVERVIEW_ZOOM - 2)
+    assert len({n for n, _ in nodes}) == len(nodes)
+    assert sum(p.get('Drops', 0) for _, p in nodes) == \
+        sum(n in h['parent'] for n in app.nodes_typed(graph, 'Drop point'))
+    assert {n for n, p in nodes if p['Type'] == 'PLR'} == set(app.nodes_typed(graph, 'PLR'))
+
+
+def test_tile_lod_and_ids(graph):
+    n = next(iter(app.nodes_typed(graph, 'PLR')))
+    for z, lod, prefix in ((app.OVERVIEW_ZOOM - 1, 'overview', 'o'), (app.OVERVIEW_ZOOM, 'detail', '')):
+        tile = app.graph_tile(graph, z, *tile_of(n, z))
+        assert tile['lod'] == lod and tile['tile'] == [z, *tile_of(n, z)]
+        features = tile['nodes']['features'] + tile['edges']['features']
+        assert features and all(f['id'].startswith(prefix) and f['id'][len(prefix):].isdigit()
+                                for f in features)
+    # far away tiles are empty
+    far = app.graph_tile(graph, app.OVERVIEW_ZOOM, 0, 0)
+    assert far['nodes']['features'] == far['edges']['features'] == []
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(app, 'result_cache', results.ResultCache(2**24))
+    monkeypatch.setattr(app, 'graph_store', app.GraphStore(2**30))
+    return app.app.test_client()
+
+
+def test_route_caching_headers(client, graph):
+    app.graph_store.put('g1', graph)
+    z = app.OVERVIEW_ZOOM
+    x, y = tile_of(next(iter(app.nodes_typed(graph, 'PLR'))), z)
+    url = f'/api/graph/tiles/{z}/{x}/{y}?graph_id=g1'
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.get_json() == app.graph_tile(graph, z, x, y)
+    assert response.headers['ETag'] == f'"g1-{z}-{x}-{y}"'
+    assert response.headers['Cache-Control'] == 'max-age=86400'
+
+    again = client.get(url, headers={'If-None-Match': response.headers['ETag']})
+    assert again.status_code == 304 and not again.data
+    assert client.get(f'/api/graph/tiles/{z}/{2**z}/0').status_code == 404
+    assert client.get('/api/graph/tiles/23/0/0').status_code == 404
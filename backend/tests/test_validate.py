@@ -0,0 +1,133 @@
+from itertools import combinations
+
+import networkx as nx
+import numpy as np
+import pytest
+from scipy.spatial import cKDTree
+from shapely import geometry
+
+import app
+import synthetic
+
+
+def test_near_pairs_counts_all_and_lists_limit():
+    rng = np.random.default_rng(0)
+    xy = rng.uniform(0, 200, (2000, 2))
+    uv = np.array([(i, i + 1) for i in range(0, 2000, 2)])
+    expected = {tuple(p) for p in cKDTree(xy).query_pairs(10, output_type='ndarray').tolist()} - set(map(tuple, uv.tolist()))
+
+    pairs, count = app._near_pairs(xy, uv, 10, limit=len(expected) + 1)
+    assert count == len(expected)
+    assert set(pairs) == expected and all(a < b for a, b in pairs)
+
+    pairs, count = app._near_pairs(xy, uv, 10, limit=25)
+    assert count == len(expected)
+    assert len(pairs) == 25 and set(pairs) <= expected
+
+
+def add_node(G, n, ntype, name=None):
+    G.add_node(n, Type=ntype, Name=name, geometry=geometry.Point(n))
+
+
+def add_cable(G, u, v, ctype):
+    G.add_edge(u, v, Type=ctype, geometry=geometry.LineString([u, v]))
+
+
+@pytest.fixture(scope='module')
+def graph():
+    """ a clean synthetic network with a few of each fault put in """
+    G = app.quick_graph(*synthetic.ftth_network(300, seed=5))
+    rng = np.random.default_rng(0)
+    drops = app.nodes_typed(G, 'Drop point')
+    junctions = app.nodes_typed(G, 'JUNC')
+    pick = rng.permutation(len(drops)).tolist()
+    for i in pick[:3]:
+        add_cable(G, drops[i], junctions[rng.integers(len(junctions))], 'C4')
+    for i in pick[3:5]:
+        G.remove_edges_from(list(G.edges(drops[i])))
+    add_cable(G, drops[pick[5]], drops[pick[6]], 'C1')
+    c4 = [(u, v) for u, v, d in G.edges(data=True) if d['Type'] == 'C4']
+    for i in rng.choice(len(c4), 3, replace=False).tolist():
+        G.edges[c4[i]]['Type'] = 'C2'
+
+    # a PLR and its drop point away from the rest
+    x, y = drops[0]
+    add_node(G, (x + 0.01, y), 'PLR', 'island PLR')
+    add_node(G, (x + 0.0101, y), 'Drop point', 'island drop')
+    add_cable(G, (x + 0.01, y), (x + 0.0101, y), 'C4')
+    # junctions a few centimetres off other nodes, one of them cabled to its twin
+    for k, i in enumerate(rng.choice(len(junctions), 4, replace=False).tolist()):
+        x, y = junctions[i]
+        add_node(G, (x + 2e-6, y), 'JUNC')
+        if k == 0:
+            add_cable(G, junctions[i], (x + 2e-6, y), 'C3')
+    return G
+
+
+def pairwise_checks(graph, origin, tolerance):
+    """ the checks worked out node by node and pair by pair """
+    types = nx.get_node_attributes(graph, 'Type')
+    names = nx.get_node_attributes(graph, 'Name')
+    drops = [n for n in graph if types[n] == 'Drop point']
+
+    def reaches_parent(n):
+        seen, stack = {n}, [n]
+        while stack:
+            for m in graph[stack.pop()]:
+                if m in seen:
+                    continue
+                seen.add(m)
+                if types[m] == app.untypes[types[n]][0]:
+                    return True
+                if types[m] == 'JUNC':
+                    stack.append(m)
+        return False
+
+    wrong = set()
+    for u, v, d in graph.edges(data=True):
+        fits = [(child, parent, 'JUNC') for child, (parent, ctype) in app.untypes.items() if ctype == d['Type']]
+        if not fits or types[u] not in fits[0] or types[v] not in fits[0]:
+            wrong.add(app._edge_key(u, v))
+
+    xy = np.radians(np.array(list(graph), dtype=np.float64)) * app.EARTH_RADIUS
+    xy[:, 0] *= np.cos(np.radians(np.array(list(graph))[:, 1].mean()))
+    nodes = list(graph)
+    near = [(a, b) for a, b in combinations(range(len(nodes)), 2)
+            if np.hypot(*(xy[a] - xy[b])) <= tolerance and not graph.has_edge(nodes[a], nodes[b])]
+
+    parts = list(nx.connected_components(graph))
+    start = app.node_named(graph, origin)
+    return {
+        'duplicates': sorted(names[n] for n in drops if len(list(graph.edges(n))) > 1),
+        'disconnected': sorted(names[n] for n in drops if len(list(graph.edges(n))) < 1),
+        'orphans': sorted(n for n in graph if types[n] in app.untypes and not reaches_parent(n)),
+        'cycles': sorted(graph.subgraph(p).number_of_edges() - len(p) + 1 for p in parts
+                         if graph.subgraph(p).number_of_edges() >= len(p)),
+        'wrong_level': wrong,
+        'near_duplicates': len(near),
+        'unreachable': sorted(len(p) for p in parts if start not in p),
+    }
+
+
+def test_validate_matches_the_pairwise_checks(graph):
+    expected = pairwise_checks(graph, 'E0', 0.5)
+    checks = app.validate(graph, 'E0', 0.5, limit=10**6)['checks']
+
+    assert sorted(checks['duplicates']['items']) == expected['duplicates']
+    assert sorted(checks['disconnected']['items']) == expected['disconnected']
+    assert sorted(tuple(i['coords']) for i in checks['orphans']['items']) == expected['orphans']
+    assert sorted(i['loops'] for i in checks['cycles']['items']) == expected['cycles']
+    assert {app._edge_key(*(tuple(e['coords']) for e in i['ends']))
+            for i in checks['wrong_level']['items']} == expected['wrong_level']
+    assert checks['near_duplicates']['count'] == expected['near_duplicates'] == 3
+    assert sorted(i['nodes'] for i in checks['unreachable']['items']) == expected['unreachable']
+    for key in ('duplicates', 'disconnected', 'orphans', 'cycles', 'wrong_level', 'unreachable'):
+        assert checks[key]['count'] == len(expected[key]) > 0
+
+
+def test_validate_limits_items_not_counts(graph):
+    full = app.validate(graph, 'E0', 0.5, limit=10**6)['checks']
+    short = app.validate(graph, 'E0', 0.5, limit=1)['checks']
+    for key, found in short.items():
+        assert found['count'] == full[key]['count']
+        assert found['items'] == full[key]['items'][:1]
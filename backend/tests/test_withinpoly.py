@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+from shapely import geometry
+
+import app
+import synthetic
+
+
+@pytest.fixture(scope='module')
+def network():
+    return app.quick_graph(*synthetic.ftth_network(300, seed=8))
+
+
+def typed_names(G, keep):
+    return [d['Name'] for n, d in G.nodes(data=True) if d['Type'] != 'JUNC' and keep(n)]
+
+
+def test_polygons_match_shapely(network):
+    xy = np.array(list(network))
+    (minx, miny), (maxx, maxy) = xy.min(axis=0), xy.max(axis=0)
+    cx, cy = (minx + maxx) / 2, (miny + maxy) / 2
+    triangle = [[minx, miny], [maxx, miny], [cx, maxy]]
+    square = [[cx, cy], [maxx, cy], [maxx, maxy], [cx, maxy]]
+    assert app.withinpoly(network, triangle) == \
+        typed_names(network, lambda n: geometry.Point(n).within(geometry.Polygon(triangle)))
+    # a list of polygons gives the nodes inside any of them, in graph order
+    assert app.withinpoly(network, [triangle, square]) == typed_names(
+        network, lambda n: any(geometry.Point(n).within(geometry.Polygon(p)) for p in (triangle, square)))
+
+
+def test_bbox(network):
+    xy = np.array(list(network))
+    lo, hi = np.percentile(xy, 30, axis=0), np.percentile(xy, 60, axis=0)
+    bbox = [*lo.tolist(), *hi.tolist()]
+    expected = typed_names(network, lambda n: lo[0] <= n[0] <= hi[0] and lo[1] <= n[1] <= hi[1])
+    assert expected and app.withinpoly(network, bbox=bbox) == expected
+
+
+def test_radius_in_metres(network):
+    center = list(app.node_named(network, 'E0'))
+    radius = 150.0
+    found = set(app.withinpoly(network, center=center, radius=radius))
+    metres = {d['Name']: app.line_length([n, center]) for n, d in network.nodes(data=True)
+              if d['Type'] != 'JUNC'}
+    assert 0 < len(found) < len(metres)
+    assert {name for name, m in metres.items() if m < radius * 0.99} <= found
+    assert all(metres[name] <= radius * 1.01 for name in found)
+    # an area of several kinds takes the nodes in any of them
+    assert set(app.withinpoly(network, bbox=[0, 0, 0, 0], center=center, radius=radius)) == found
@@ -0,0 +1,60 @@
+""" XYZ (slippy map) tiles of a graph: the tile bounds in lon / lat and an
+index of node points and edge bounding boxes answering which features a
+tile holds """
+import math
+
+import numpy as np
+
+
+MAX_ZOOM = 22
+TILE_SIZE = 256
+
+
+def tile_bounds(z, x, y):
+    """ (west, south, east, north) of tile x, y at zoom z """
+    n = 2 ** z
+
+    def lat(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+    return x / n * 360 - 180, lat(y + 1), (x + 1) / n * 360 - 180, lat(y)
+
+
+def valid_tile(z, x, y):
+    return 0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def pixel_degrees(z):
+    """ width of a tile pixel at zoom z, in degrees of longitude """
+    return 360 / (TILE_SIZE * 2 ** z)
+
+
+class TileIndex:
+    """ node points and edge bounding boxes of a csr.CSRGraph """
+
+    def __init__(self, csr):
+        self.nodes = csr.nodes
+        self.uv = csr.uv
+        self.xy = csr.xy
+        offsets = np.asarray(csr.arrays['edge.offsets'])
+        coords = np.asarray(csr.arrays['edge.coords'])
+        if len(self.uv):
+            starts = offsets[:-1]
+            self.boxes = np.column_stack([np.minimum.reduceat(coords, starts),
+                                          np.maximum.reduceat(coords, starts)])
+        else:
+            self.boxes = np.empty((0, 4))
+
+    def edge(self, i):
+        u, v = self.uv[i]
+        return self.nodes[u], self.nodes[v]
+
+    def query(self, west, south, east, north):
+        """ indices of the nodes inside the bounds, points on the east and
+        south border belong to the next tile, and of the edges whose
+        bounding box meets them """
+        x, y = self.xy[:, 0], self.xy[:, 1]
+        nodes = np.flatnonzero((x >= west) & (x < east) & (y > south) & (y <= north))
+        b = self.boxes
+        edges = np.flatnonzero((b[:, 0] <= east) & (b[:, 2] >= west) &
+                               (b[:, 1] <= north) & (b[:, 3] >= south))
+        return nodes, edges